@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     bench_decode
+   Description :  parse time and allocations per work of the works decoders
+-------------------------------------------------
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openalex_io  # noqa: E402
+from benchmarks.synthetic import make_lines  # noqa: E402
+
+
+def measure(decode, lines, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            decode(line)
+    seconds = time.perf_counter() - start
+
+    # peak traced memory while decoding one work, averaged over a sample
+    peaks = []
+    for line in lines[:200]:
+        tracemalloc.start()
+        decode(line)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        'us_per_work': seconds / (repeat * len(lines)) * 1e6,
+        'alloc_bytes_per_work': sum(peaks) / len(peaks),
+    }
+
+
+def decoders():
+    def decode_work_stdlib(line):
+        loads, openalex_io.loads = openalex_io.loads, json.loads
+        try:
+            return openalex_io.decode_work(line)
+        finally:
+            openalex_io.loads = loads
+
+    candidates = {'json.loads': json.loads, 'decode_work (json)': decode_work_stdlib}
+    if openalex_io.orjson is not None:
+        candidates['orjson.loads'] = openalex_io.orjson.loads
+        candidates['decode_work (orjson)'] = openalex_io.decode_work
+    return candidates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bench_decode")
+    parser.add_argument("--works", type=int, default=5000, help="number of synthetic works")
+    parser.add_argument("--abstract_words", type=int, default=180, help="words per abstract")
+    parser.add_argument("--repeat", type=int, default=3, help="timed passes over the works")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this json file")
+    args = parser.parse_args()
+
+    lines = make_lines('works', args.works, abstract_words=args.abstract_words)
+    print(f"{len(lines)} works, {sum(map(len, lines)) / len(lines):.0f} bytes per line")
+    results = {}
+    for name, decode in decoders().items():
+        results[name] = result = measure(decode, lines, args.repeat)
+        print(f"{name:24s} {result['us_per_work']:8.1f} us/work  "
+              f"{result['alloc_bytes_per_work']:10.0f} B allocated/work")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'works': len(lines), 'results': results}, f, indent=2)
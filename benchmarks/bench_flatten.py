@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     bench_flatten
+   Description :  throughput of the flatten scripts on a synthetic snapshot
+-------------------------------------------------
+"""
+import argparse
+import glob
+import gzip
+import os
+import shutil
+import tempfile
+
+from harness import summarize, timed, write_results
+
+import openalex_io
+from benchmarks.synthetic import ENTITIES, WORK_SHAPE, make_lines, write_snapshot
+
+works_script = openalex_io.load_script('flatten-openalex-works-to-csv.py', 'flatten_openalex_works_to_csv')
+other_script = openalex_io.load_script('flatten-openalex-other-jsonl.py', 'flatten_openalex_other_jsonl')
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(fp) for fp in glob.glob(os.path.join(path, '*')))
+
+
+def bench_process_work(lines, repeat, abstracts=False):
+    """process_work alone, on works decoded beforehand."""
+    works = []
+
+    def setup():
+        works[:] = [openalex_io.decode_work(line, with_abstract=abstracts) for line in lines]
+
+    def run():
+        for work in works:
+            works_script.process_work(work, abstracts)
+
+    seconds, _ = timed(run, repeat, setup)
+    name = 'process_work (abstracts)' if abstracts else 'process_work'
+    return summarize(name, seconds, len(lines), 'works')
+
+
+def bench_process_file(jsonl_file_name, works, out_dir, repeat, fmt, options=None):
+    """process_file on one works file: decode, flatten, encode and compress."""
+    seconds, _ = timed(lambda: works_script.process_file(0, jsonl_file_name, out_dir, False, fmt=fmt,
+                                                         options=options),
+                       repeat, lambda: reset(out_dir))
+    return summarize(f'process_file ({fmt})', seconds, works, 'works',
+                     bytes_in=os.path.getsize(jsonl_file_name), bytes_out=directory_bytes(out_dir))
+
+
+def bench_process_entity_file(entity, jsonl_file_name, records, out_dir, repeat, fmt, options=None):
+    """process_entity_file, the flatten of one file of the other entities."""
+    seconds, _ = timed(lambda: other_script.process_entity_file(entity, 0, jsonl_file_name, out_dir, fmt=fmt,
+                                                                options=options),
+                       repeat, lambda: reset(out_dir))
+    return summarize(f'process_entity_file {entity} ({fmt})', seconds, records, 'records',
+                     bytes_in=os.path.getsize(jsonl_file_name), bytes_out=directory_bytes(out_dir))
+
+
+def snapshot_lines(snapshot_dir, entity):
+    """The lines of the files of ``entity``, its records and their repeated copies."""
+    lines = 0
+    for jsonl_file_name in glob.glob(os.path.join(snapshot_dir, 'data', entity, '*', '*.gz')):
+        with gzip.open(jsonl_file_name, 'rb') as jsonl:
+            lines += sum(1 for _ in jsonl)
+    return lines
+
+
+def bench_pools(snapshot_dir, out_dir, workers, repeat, fmt, options=None, dedup=True):
+    """run_pool and flatten_entities, the whole snapshot on ``workers`` processes.
+
+    The rates count every line read, so the runs with and without ``dedup``
+    compare on the same input.
+    """
+    label = fmt if dedup else f'{fmt}, no_dedup'
+    works_files = sorted(glob.glob(os.path.join(snapshot_dir, 'data', 'works', '*', '*.gz')))
+    seconds, _ = timed(lambda: works_script.run_pool(works_files, out_dir, workers, fmt=fmt, options=options,
+                                                     dedup=dedup),
+                       repeat, lambda: reset(out_dir))
+    results = [summarize(f'run_pool works x{workers} ({label})', seconds, snapshot_lines(snapshot_dir, 'works'),
+                         'works')]
+
+    others = [entity for entity in ENTITIES if entity != 'works']
+    seconds, _ = timed(lambda: other_script.flatten_entities(others, snapshot_dir, out_dir, workers, fmt=fmt,
+                                                             options=options, dedup=dedup),
+                       repeat, lambda: reset(out_dir))
+    results.append(summarize(f'flatten_entities x{workers} ({label})', seconds,
+                             sum(snapshot_lines(snapshot_dir, entity) for entity in others), 'records'))
+    return results
+
+
+def reset(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bench_flatten")
+    parser.add_argument("--works", type=int, default=5000, help="number of synthetic works")
+    parser.add_argument("--others", type=int, default=2000, help="number of records of every other entity")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="workers of the pool benchmarks")
+    parser.add_argument("--partitions", type=int, default=2,
+                        help="updated_date partitions of the snapshot of the pool benchmarks")
+    parser.add_argument("--duplicate_rate", type=float, default=0.1,
+                        help="fraction of the records of a partition repeated, updated, in the next one")
+    parser.add_argument("--formats", type=str, nargs='+', choices=list(openalex_io.FORMATS), default=['csv'],
+                        help="output formats to benchmark")
+    parser.add_argument("--codec", type=str, choices=list(openalex_io.CODECS), default='gzip',
+                        help="compression of the csv and binary output")
+    parser.add_argument("--level", type=int, default=None, help="compression level of --codec")
+    parser.add_argument("--compress_offload", type=str, choices=['thread', 'process'], default=None,
+                        help="compress on a thread or an external process")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of every benchmark, the best one counts")
+    parser.add_argument("--work_dir", type=str, default=None, help="scratch directory, a temporary one by default")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this json file")
+    for shape_name, shape_default in WORK_SHAPE.items():
+        parser.add_argument(f"--{shape_name}", type=int, default=shape_default, help=f"{shape_name} per work")
+    args = parser.parse_args()
+
+    shape = {name: getattr(args, name) for name in WORK_SHAPE}
+    codec_options = {'codec': args.codec, 'level': args.level, 'offload': args.compress_offload}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='openalex-bench-')
+    snapshot_dir = os.path.join(work_dir, 'snapshot')
+    out_dir = os.path.join(work_dir, 'out')
+    records = {entity: args.works if entity == 'works' else args.others for entity in ENTITIES}
+    try:
+        # one file per entity for the single file benchmarks, split over the workers for the pools, with
+        # repeated records the pools flatten once with and once without the deduplication
+        write_snapshot(snapshot_dir, records, partitions=args.partitions, files=max(1, args.workers),
+                       duplicate_rate=args.duplicate_rate, **shape)
+        single_dir = os.path.join(work_dir, 'single')
+        os.makedirs(single_dir, exist_ok=True)
+
+        results = []
+        lines = make_lines('works', min(args.works, 2000), **shape)
+        results.append(bench_process_work(lines, args.repeat))
+        results.append(bench_process_work(lines, args.repeat, abstracts=True))
+
+        for entity in ENTITIES:
+            jsonl_file_name = os.path.join(single_dir, f'{entity}.gz')
+            with gzip.open(jsonl_file_name, 'wb') as jsonl:
+                jsonl.writelines(make_lines(entity, records[entity], **shape))
+            for fmt in args.formats:
+                options = None if fmt == 'parquet' else codec_options
+                if entity == 'works':
+                    results.append(bench_process_file(jsonl_file_name, records[entity], out_dir, args.repeat, fmt,
+                                                      options))
+                else:
+                    results.append(bench_process_entity_file(entity, jsonl_file_name, records[entity], out_dir,
+                                                             args.repeat, fmt, options))
+
+        for fmt in args.formats:
+            options = None if fmt == 'parquet' else codec_options
+            for dedup in (True, False):
+                results.extend(bench_pools(snapshot_dir, out_dir, args.workers, args.repeat, fmt, options, dedup))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        write_results(args.json, 'flatten', args, results)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     bench_import
+   Description :  throughput of the import path against a local postgresql,
+                  in a dedicated database that is dropped and rebuilt
+-------------------------------------------------
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from harness import summarize, timed, write_results
+
+import import_csv_to_postgresql
+import openalex_io
+import stream_jsonl_to_postgresql
+from benchmarks.synthetic import ENTITIES, WORK_SHAPE, write_snapshot
+from import_csv_to_postgresql import DB_CONFIG, COPY_FORMATS, import_files
+
+works_script = openalex_io.load_script('flatten-openalex-works-to-csv.py', 'flatten_openalex_works_to_csv')
+other_script = openalex_io.load_script('flatten-openalex-other-jsonl.py', 'flatten_openalex_other_jsonl')
+
+
+def create_database(database):
+    conn = psycopg2.connect(**{**DB_CONFIG, 'database': 'postgres'})
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (database,))
+            if cur.fetchone() is None:
+                cur.execute(f'CREATE DATABASE "{database}"')
+    finally:
+        conn.close()
+
+
+def create_schema():
+    """Drop and recreate the ``openalex`` schema of the benchmark database, without indexes."""
+    with open(openalex_io.SCHEMA_SQL, encoding='utf-8') as f:
+        schema_sql = f.read()
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA IF EXISTS openalex CASCADE")
+            cur.execute(schema_sql)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def truncate_tables():
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            tables = ', '.join(f'openalex.{table}' for table in openalex_io.load_column_types())
+            cur.execute(f"TRUNCATE {tables}")
+            cur.execute("CHECKPOINT")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def flatten_snapshot(snapshot_dir, out_dir, workers, fmt):
+    works_files = sorted(glob.glob(os.path.join(snapshot_dir, 'data', 'works', '*', '*.gz')))
+    failures = works_script.run_pool(works_files, out_dir, workers, fmt=fmt)
+    failures += other_script.flatten_entities([entity for entity in ENTITIES if entity != 'works'],
+                                              snapshot_dir, out_dir, workers, fmt=fmt)
+    if failures:
+        raise RuntimeError(f"flatten failed: {failures}")
+    return sorted(fp for fp in glob.glob(os.path.join(out_dir, '*')) if openalex_io.file_format(fp) == fmt)
+
+
+def bench_import_files(files, workers, repeat, fmt):
+    """import_csv_to_postgresql.import_files into empty tables, without the manifest."""
+    def run():
+        stats, failures = import_files(files, workers, manifest=False)
+        if failures:
+            raise RuntimeError(f"import failed: {failures}")
+        return sum(worker['rows'] for worker in stats.values())
+
+    seconds, rows = timed(run, repeat, truncate_tables)
+    return summarize(f'import_files x{workers} ({fmt})', seconds, rows, 'rows',
+                     bytes_in=sum(os.path.getsize(fp) for fp in files))
+
+
+def bench_stream(snapshot_dir, buffer_bytes, repeat):
+    """stream_jsonl_to_postgresql.plan_tasks and load_files, every entity on one connection."""
+    def run():
+        rows = 0
+        with ThreadPoolExecutor() as pool:
+            tasks = stream_jsonl_to_postgresql.plan_tasks(snapshot_dir, ENTITIES, pool)
+        for entity, files, skip_lines in tasks:
+            row_counts, failures = stream_jsonl_to_postgresql.load_files(entity, files, buffer_bytes,
+                                                                         skip_lines=skip_lines)
+            if failures:
+                raise RuntimeError(f"stream load failed: {failures}")
+            rows += sum(row_counts.values())
+        return rows
+
+    seconds, rows = timed(run, repeat, truncate_tables)
+    return summarize('stream load_files x1', seconds, rows, 'rows')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bench_import")
+    parser.add_argument("--database", type=str, default="openalex_bench",
+                        help="database the benchmark creates and owns, its openalex schema is dropped")
+    parser.add_argument("--works", type=int, default=20000, help="number of synthetic works")
+    parser.add_argument("--others", type=int, default=5000, help="number of records of every other entity")
+    parser.add_argument("--workers", type=int, default=4, help="COPY connections of import_files")
+    parser.add_argument("--formats", type=str, nargs='+', choices=COPY_FORMATS, default=COPY_FORMATS,
+                        help="flattened formats to import")
+    parser.add_argument("--buffer_mb", type=float, default=8, help="COPY buffer of the stream loader, in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of every benchmark, the best one counts")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this json file")
+    for shape_name, shape_default in WORK_SHAPE.items():
+        parser.add_argument(f"--{shape_name}", type=int, default=shape_default, help=f"{shape_name} per work")
+    args = parser.parse_args()
+
+    if args.database == import_csv_to_postgresql.DB_CONFIG['database']:
+        parser.error("use a database of its own for the benchmark, its openalex schema is dropped")
+    DB_CONFIG['database'] = args.database
+
+    shape = {name: getattr(args, name) for name in WORK_SHAPE}
+    records = {entity: args.works if entity == 'works' else args.others for entity in ENTITIES}
+    work_dir = tempfile.mkdtemp(prefix='openalex-bench-')
+    try:
+        snapshot_dir = os.path.join(work_dir, 'snapshot')
+        write_snapshot(snapshot_dir, records, files=max(1, args.workers), **shape)
+        create_database(args.database)
+        create_schema()
+
+        results = []
+        for fmt in args.formats:
+            out_dir = os.path.join(work_dir, fmt)
+            os.makedirs(out_dir)
+            files = flatten_snapshot(snapshot_dir, out_dir, args.workers, fmt)
+            results.append(bench_import_files(files, args.workers, args.repeat, fmt))
+        results.append(bench_stream(snapshot_dir, int(args.buffer_mb * 1024 * 1024), args.repeat))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        write_results(args.json, 'import', args, results)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     check_hash_partition
+   Description :  check the hash_partition port against the leaf tables
+                  PostgreSQL picked for a fixed set of text and bigint keys
+-------------------------------------------------
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openalex_io import hash_partition  # noqa: E402
+
+VECTORS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hash_partition_vectors.json')
+
+MODULI = [1, 2, 3, 4, 5, 7, 8, 10, 16, 17, 31, 32, 64, 100]
+
+# scratch schema of --capture, dropped at the end
+CAPTURE_SCHEMA = 'hash_partition_vectors'
+
+
+def make_keys(count=200, seed=0):
+    """Return ``{'text': [...], 'bigint': [...]}``, OpenAlex ids and the edge cases of both hash functions.
+
+    The text keys cover every length from 0 to 40 bytes around the 12-byte
+    blocks of lookup3 and a few multi-byte utf-8 ones, the bigint keys the
+    sign and 32-bit boundaries.
+    """
+    rng = random.Random(seed)
+    numbers = [rng.randrange(1, 5_000_000_000) for _ in range(count)]
+    text = [f"https://openalex.org/{rng.choice('WASIC')}{number}" for number in numbers]
+    text += ['x' * length for length in range(41)]
+    text += ['Zürich', 'København', '東京大学', 'naïve café ☕', 'W1\ttab']
+    bigint = numbers + [0, 1, -1, 2, 2 ** 31 - 1, 2 ** 31, 2 ** 32 - 1, 2 ** 32, 2 ** 32 + 1, -2 ** 31,
+                        -2 ** 32, 2 ** 63 - 1, -2 ** 63, 2741809807]
+    bigint += [rng.randrange(-2 ** 63, 2 ** 63) for _ in range(count // 4)]
+    return {'text': list(dict.fromkeys(text)), 'bigint': list(dict.fromkeys(bigint))}
+
+
+def capture(conn, keys, moduli):
+    """Insert ``keys`` into ``PARTITION BY HASH`` tables of every modulus and read back the leaf of each.
+
+    Returns the vectors, ``{'moduli': [...], '<type>': [[key, [remainder per
+    modulus]], ...]}``, and the server version.
+    """
+    vectors = {'moduli': list(moduli)}
+    with conn.cursor() as cur:
+        cur.execute("SHOW server_encoding")
+        if cur.fetchone()[0] != 'UTF8':
+            raise RuntimeError("capture into a UTF8 database, the text keys are hashed as stored")
+        cur.execute("SHOW server_version")
+        version = cur.fetchone()[0]
+        cur.execute(f"DROP SCHEMA IF EXISTS {CAPTURE_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {CAPTURE_SCHEMA}")
+        for key_type, values in keys.items():
+            remainders = {value: [] for value in values}
+            for modulus in moduli:
+                parent = f"{CAPTURE_SCHEMA}.{key_type}_m{modulus}"
+                cur.execute(f"CREATE TABLE {parent} (key {key_type}) PARTITION BY HASH (key)")
+                for remainder in range(modulus):
+                    cur.execute(f"CREATE TABLE {parent}_p{remainder} PARTITION OF {parent} "
+                                f"FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})")
+                cur.execute(f"INSERT INTO {parent} SELECT unnest(%s::{key_type}[])", (values,))
+                cur.execute(f"SELECT key, tableoid::regclass::text FROM {parent}")
+                for value, leaf in cur.fetchall():
+                    remainders[value].append(int(leaf.rpartition('_p')[2]))
+            vectors[key_type] = [[value, remainders[value]] for value in values]
+        cur.execute(f"DROP SCHEMA {CAPTURE_SCHEMA} CASCADE")
+    conn.commit()
+    return vectors, version
+
+
+def write_vectors(f, version, vectors):
+    """Write the vectors as json with one key per line, so a recapture diffs by key."""
+    f.write(f'{{"postgresql": {json.dumps(version)},\n"moduli": {json.dumps(vectors["moduli"])}')
+    for key_type in ('text', 'bigint'):
+        entries = ',\n'.join(json.dumps(entry, ensure_ascii=False) for entry in vectors[key_type])
+        f.write(f',\n"{key_type}": [\n{entries}\n]')
+    f.write('}\n')
+
+
+def check(vectors):
+    """Return the ``(key type, key, modulus, expected, got)`` of every key ``hash_partition`` routes elsewhere."""
+    mismatches = []
+    for key_type in ('text', 'bigint'):
+        for value, remainders in vectors[key_type]:
+            for modulus, expected in zip(vectors['moduli'], remainders):
+                got = hash_partition(value, modulus)
+                if got != expected:
+                    mismatches.append((key_type, value, modulus, expected, got))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check_hash_partition")
+    parser.add_argument("--vectors", type=str, default=VECTORS,
+                        help="json file of the keys and the remainders PostgreSQL gave them")
+    parser.add_argument("--capture", action="store_true",
+                        help="rebuild --vectors from the local postgresql of DB_CONFIG before checking, in a "
+                             f"scratch schema {CAPTURE_SCHEMA}")
+    parser.add_argument("--database", type=str, default=None,
+                        help="database of --capture instead of the one of DB_CONFIG, it must be UTF8 encoded")
+    args = parser.parse_args()
+
+    if args.capture:
+        import psycopg2
+
+        from import_csv_to_postgresql import DB_CONFIG
+
+        conn = psycopg2.connect(**{**DB_CONFIG, 'database': args.database or DB_CONFIG['database']})
+        try:
+            vectors, version = capture(conn, make_keys(), MODULI)
+        finally:
+            conn.close()
+        with open(args.vectors, 'w', encoding='utf-8') as f:
+            write_vectors(f, version, vectors)
+        print(f"captured from PostgreSQL {version} into {args.vectors}")
+
+    with open(args.vectors, encoding='utf-8') as f:
+        vectors = json.load(f)
+    mismatches = check(vectors)
+    checked = sum(len(vectors[key_type]) for key_type in ('text', 'bigint')) * len(vectors['moduli'])
+    print(f"{checked} (key, modulus) pairs of PostgreSQL {vectors['postgresql']}, {len(mismatches)} mismatches")
+    for key_type, value, modulus, expected, got in mismatches[:20]:
+        print(f"  {key_type} {value!r} modulus {modulus}: PostgreSQL {expected}, hash_partition {got}")
+    if mismatches:
+        raise SystemExit(1)
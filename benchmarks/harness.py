@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     harness
+   Description :  timing and result files shared by the benchmarks
+-------------------------------------------------
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """What the results depend on besides the code: revision, interpreter and optional packages."""
+    import openalex_io
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'orjson': openalex_io.orjson is not None,
+        'pyarrow': openalex_io.pyarrow is not None,
+        'date': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def timed(run, repeat, setup=None):
+    """Call ``run()`` ``repeat`` times, after ``setup()`` if given, and return the wall times.
+
+    ``setup`` is not timed, use it to reset the state ``run`` consumes.
+    """
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = run()
+        seconds.append(time.perf_counter() - start)
+    return seconds, result
+
+
+def summarize(name, seconds, records, unit='records', **extra):
+    """One result entry, throughput is taken from the best run."""
+    best = min(seconds)
+    result = {
+        'name': name,
+        'records': records,
+        'unit': unit,
+        'best_s': best,
+        'median_s': statistics.median(seconds),
+        'runs': len(seconds),
+        'per_s': records / best if best else None,
+        **extra,
+    }
+    print(f"{name:40s} {result['per_s']:12.0f} {unit}/s  best {best:8.3f} s  median {result['median_s']:8.3f} s")
+    return result
+
+
+def write_results(path, suite, args, results):
+    """Write the results of a benchmark run as json, to compare runs between revisions."""
+    with open(path, 'w') as f:
+        json.dump({'suite': suite, 'environment': environment(), 'args': vars(args), 'results': results},
+                  f, indent=2)
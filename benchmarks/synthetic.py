@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     synthetic
+   Description :  deterministic synthetic openalex snapshot for the benchmarks
+-------------------------------------------------
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+
+ENTITIES = ['works', 'authors', 'concepts', 'institutions', 'publishers', 'sources']
+
+# shape of a generated work, override any of them with make_work(..., **shape)
+WORK_SHAPE = {
+    'authorships': 5,
+    'references': 30,
+    'related': 10,
+    'concepts': 8,
+    'locations': 2,
+    'mesh': 1,
+    'abstract_words': 180,
+}
+
+# ids are drawn from pools of this size, so the child tables reference realistic ids
+ID_POOLS = {'W': 4000000000, 'A': 5000000000, 'C': 65000, 'I': 110000, 'P': 10000, 'S': 250000}
+
+
+def openalex_id(letter, number):
+    return f"https://openalex.org/{letter}{number}"
+
+
+def random_id(rng, letter):
+    return openalex_id(letter, rng.randrange(ID_POOLS[letter]))
+
+
+def make_vocabulary(rng, size=5000):
+    return [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 12)))
+            for _ in range(size)]
+
+
+def make_abstract(rng, vocabulary, words):
+    inverted_index = {}
+    for position in range(words):
+        # skewed draw so frequent words get long position lists, like real abstracts
+        word = vocabulary[int(len(vocabulary) * rng.random() ** 3)]
+        inverted_index.setdefault(word, []).append(position)
+    return inverted_index
+
+
+def make_counts_by_year(rng, works=True):
+    counts = []
+    for year in range(2023, 2012, -1):
+        count = {'year': year, 'cited_by_count': rng.randrange(200)}
+        if works:
+            count['works_count'] = rng.randrange(50)
+            count['oa_works_count'] = rng.randrange(20)
+        counts.append(count)
+    return counts
+
+
+def make_location(rng, i, is_oa):
+    return {
+        'is_oa': is_oa,
+        'landing_page_url': f"https://doi.org/10.1000/{i}",
+        'pdf_url': f"https://example.org/{i}.pdf" if is_oa else None,
+        'source': {'id': random_id(rng, 'S'), 'display_name': 'Journal of Things', 'issn_l': '1234-5678',
+                   'host_organization': random_id(rng, 'P'), 'type': 'journal'},
+        'license': 'cc-by' if is_oa else None,
+        'version': 'publishedVersion',
+    }
+
+
+def make_work(rng, i, vocabulary, **shape):
+    """A work with the fields and sizes of the snapshot, ``shape`` overrides ``WORK_SHAPE``."""
+    shape = {**WORK_SHAPE, **shape}
+    work_id = openalex_id('W', i)
+    is_oa = rng.random() < 0.4
+    locations = [make_location(rng, i, is_oa and n == 0) for n in range(shape['locations'])]
+    return {
+        'id': work_id,
+        'doi': f"https://doi.org/10.1000/{i}",
+        'title': f"On the synthetic properties of work {i}",
+        'display_name': f"On the synthetic properties of work {i}",
+        'publication_year': 1950 + i % 74,
+        'publication_date': f"{1950 + i % 74}-0{1 + i % 9}-1{i % 10}",
+        'ids': {'openalex': work_id, 'doi': f"https://doi.org/10.1000/{i}", 'mag': str(rng.randrange(10 ** 10)),
+                'pmid': f"https://pubmed.ncbi.nlm.nih.gov/{i}" if i % 3 == 0 else None,
+                'pmcid': f"https://www.ncbi.nlm.nih.gov/pmc/articles/{i}" if i % 9 == 0 else None},
+        'language': 'en',
+        'primary_location': locations[0] if locations else None,
+        'type': 'article',
+        'open_access': {'is_oa': is_oa, 'oa_status': 'gold' if is_oa else 'closed',
+                        'oa_url': locations[0]['pdf_url'] if is_oa and locations else None,
+                        'any_repository_has_fulltext': False},
+        'authorships': [{
+            'author_position': 'first' if a == 0 else 'last' if a == shape['authorships'] - 1 else 'middle',
+            'author': {'id': random_id(rng, 'A'), 'display_name': f"Author {a}", 'orcid': None},
+            'institutions': [{'id': random_id(rng, 'I'), 'display_name': 'University of Things', 'ror': None,
+                              'country_code': 'US', 'type': 'education'} for _ in range(1 + a % 2)],
+            'is_corresponding': a == 0,
+            'raw_affiliation_string': 'Department of Things, University of Things, Somewhere',
+        } for a in range(shape['authorships'])],
+        'cited_by_count': rng.randrange(500),
+        'biblio': {'volume': str(rng.randrange(1, 80)), 'issue': str(rng.randrange(1, 12)),
+                   'first_page': '100', 'last_page': '110'},
+        'is_retracted': False,
+        'is_paratext': False,
+        'concepts': [{'id': random_id(rng, 'C'), 'wikidata': 'https://www.wikidata.org/wiki/Q1',
+                      'display_name': 'Thing', 'level': c % 4, 'score': round(rng.random(), 6)}
+                     for c in range(shape['concepts'])],
+        'mesh': [{'descriptor_ui': f"D{m:06d}", 'descriptor_name': 'Thing', 'qualifier_ui': '',
+                  'qualifier_name': None, 'is_major_topic': m == 0} for m in range(shape['mesh'])],
+        'locations_count': len(locations),
+        'locations': locations,
+        'best_oa_location': locations[0] if is_oa and locations else None,
+        'referenced_works': [random_id(rng, 'W') for _ in range(shape['references'])],
+        'related_works': [random_id(rng, 'W') for _ in range(shape['related'])],
+        'abstract_inverted_index': make_abstract(rng, vocabulary, shape['abstract_words'])
+        if shape['abstract_words'] and i % 5 else None,
+        'cited_by_api_url': f"https://api.openalex.org/works?filter=cites:W{i}",
+        'counts_by_year': make_counts_by_year(rng, works=False),
+        'updated_date': '2023-05-01T12:00:00.123456',
+        'created_date': '2016-06-24',
+    }
+
+
+def make_author(rng, i, vocabulary=None):
+    author_id = openalex_id('A', i)
+    return {
+        'id': author_id,
+        'orcid': f"https://orcid.org/0000-0002-{i % 10000:04d}-0000" if i % 2 else None,
+        'display_name': f"Author Number {i}",
+        'display_name_alternatives': [f"A. Number {i}", f"Author N. {i}"],
+        'works_count': rng.randrange(300),
+        'cited_by_count': rng.randrange(5000),
+        'ids': {'openalex': author_id, 'orcid': None, 'mag': str(rng.randrange(10 ** 10))},
+        'last_known_institution': {'id': random_id(rng, 'I'), 'display_name': 'University of Things',
+                                   'country_code': 'US', 'type': 'education'},
+        'x_concepts': [{'id': random_id(rng, 'C'), 'display_name': 'Thing', 'level': 1, 'score': 50.0}],
+        'counts_by_year': make_counts_by_year(rng),
+        'works_api_url': f"https://api.openalex.org/works?filter=author.id:A{i}",
+        'updated_date': '2023-05-01T12:00:00.123456',
+        'created_date': '2016-06-24',
+    }
+
+
+def make_concept(rng, i, vocabulary=None):
+    concept_id = openalex_id('C', i)
+    return {
+        'id': concept_id,
+        'wikidata': f"https://www.wikidata.org/wiki/Q{i}",
+        'display_name': f"Concept {i}",
+        'level': i % 6,
+        'description': 'a synthetic field of study',
+        'works_count': rng.randrange(10 ** 6),
+        'cited_by_count': rng.randrange(10 ** 7),
+        'ids': {'openalex': concept_id, 'wikidata': f"https://www.wikidata.org/wiki/Q{i}",
+                'wikipedia': f"https://en.wikipedia.org/wiki/Concept_{i}", 'umls_aui': [], 'umls_cui': ['C0001'],
+                'mag': str(i)},
+        'image_url': None,
+        'image_thumbnail_url': None,
+        'ancestors': [{'id': random_id(rng, 'C'), 'display_name': 'Thing', 'level': 0} for _ in range(3)],
+        'related_concepts': [{'id': random_id(rng, 'C'), 'display_name': 'Thing', 'level': 1,
+                              'score': round(rng.random() * 5, 4)} for _ in range(10)],
+        'counts_by_year': make_counts_by_year(rng),
+        'works_api_url': f"https://api.openalex.org/works?filter=concepts.id:C{i}",
+        'updated_date': '2023-05-01T12:00:00.123456',
+        'created_date': '2016-06-24',
+    }
+
+
+def make_institution(rng, i, vocabulary=None):
+    institution_id = openalex_id('I', i)
+    return {
+        'id': institution_id,
+        'ror': f"https://ror.org/0{i:08d}",
+        'display_name': f"University of Thing {i}",
+        'country_code': 'US',
+        'type': 'education',
+        'homepage_url': f"https://thing{i}.edu",
+        'image_url': None,
+        'image_thumbnail_url': None,
+        'display_name_acroynyms': [f"UT{i}"],
+        'display_name_alternatives': [f"Thing {i} University"],
+        'works_count': rng.randrange(10 ** 5),
+        'cited_by_count': rng.randrange(10 ** 6),
+        'ids': {'openalex': institution_id, 'ror': f"https://ror.org/0{i:08d}", 'grid': f"grid.{i}.0",
+                'wikipedia': None, 'wikidata': None, 'mag': str(i)},
+        'geo': {'city': 'Somewhere', 'geonames_city_id': str(i), 'region': None, 'country_code': 'US',
+                'country': 'United States', 'latitude': 40.0 + rng.random(), 'longitude': -70.0 - rng.random()},
+        'associated_institutions': [{'id': random_id(rng, 'I'), 'display_name': 'Hospital', 'ror': None,
+                                     'country_code': 'US', 'type': 'healthcare', 'relationship': 'related'}
+                                    for _ in range(2)],
+        'counts_by_year': make_counts_by_year(rng),
+        'works_api_url': f"https://api.openalex.org/works?filter=institutions.id:I{i}",
+        'updated_date': '2023-05-01T12:00:00.123456',
+        'created_date': '2016-06-24',
+    }
+
+
+def make_publisher(rng, i, vocabulary=None):
+    publisher_id = openalex_id('P', i)
+    return {
+        'id': publisher_id,
+        'display_name': f"Publisher {i}",
+        'alternate_titles': [f"Pub {i}"],
+        'country_codes': ['US', 'GB'],
+        'hierarchy_level': i % 2,
+        'parent_publisher': random_id(rng, 'P') if i % 2 else None,
+        'works_count': rng.randrange(10 ** 6),
+        'cited_by_count': rng.randrange(10 ** 7),
+        'ids': {'openalex': publisher_id, 'ror': None, 'wikidata': f"https://www.wikidata.org/entity/Q{i}"},
+        'counts_by_year': make_counts_by_year(rng),
+        'sources_api_url': f"https://api.openalex.org/sources?filter=host_organization.id:P{i}",
+        'updated_date': '2023-05-01T12:00:00.123456',
+        'created_date': '2016-06-24',
+    }
+
+
+def make_source(rng, i, vocabulary=None):
+    source_id = openalex_id('S', i)
+    return {
+        'id': source_id,
+        'issn_l': f"{i % 10000:04d}-0000",
+        'issn': [f"{i % 10000:04d}-0000", f"{i % 10000:04d}-0001"],
+        'display_name': f"Journal of Thing {i}",
+        'publisher': f"Publisher {i % 100}",
+        'works_count': rng.randrange(10 ** 5),
+        'cited_by_count': rng.randrange(10 ** 6),
+        'is_oa': i % 3 == 0,
+        'is_in_doaj': i % 6 == 0,
+        'homepage_url': f"https://journal{i}.org",
+        'ids': {'openalex': source_id, 'issn_l': f"{i % 10000:04d}-0000", 'issn': [f"{i % 10000:04d}-0000"],
+                'mag': str(i), 'wikidata': None, 'fatcat': None},
+        'counts_by_year': make_counts_by_year(rng),
+        'works_api_url': f"https://api.openalex.org/works?filter=primary_location.source.id:S{i}",
+        'updated_date': '2023-05-01T12:00:00.123456',
+        'created_date': '2016-06-24',
+    }
+
+
+GENERATORS = {
+    'works': make_work,
+    'authors': make_author,
+    'concepts': make_concept,
+    'institutions': make_institution,
+    'publishers': make_publisher,
+    'sources': make_source,
+}
+
+
+def make_lines(entity, count, seed=0, start=0, version=0, **shape):
+    """``count`` encoded jsonl lines of ``entity``, the same ones for the same arguments.
+
+    A later ``version`` gives the same ids other values, an updated copy of the records.
+    """
+    rng = random.Random(f"{entity}-{seed}-{start}-{version}" if version else f"{entity}-{seed}-{start}")
+    vocabulary = make_vocabulary(random.Random(seed))
+    make = GENERATORS[entity]
+    if entity == 'works':
+        return [json.dumps(make(rng, start + i, vocabulary, **shape)).encode('utf-8') + b'\n'
+                for i in range(count)]
+    return [json.dumps(make(rng, start + i)).encode('utf-8') + b'\n' for i in range(count)]
+
+
+def write_snapshot(snapshot_dir, records, entities=ENTITIES, partitions=1, files=1, seed=0, duplicate_rate=0.0,
+                   **shape):
+    """Write a snapshot tree ``data/<entity>/updated_date=.../part_NNN.gz`` under ``snapshot_dir``.
+
+    ``records`` maps each entity to its number of distinct records, spread
+    evenly over ``partitions`` x ``files`` files. With ``duplicate_rate`` every
+    file of a later partition also holds an updated copy of that fraction of
+    the records of the same file of the previous partition, the way the
+    snapshot repeats a record in the partition of its last update. Returns
+    the written file names per entity.
+    """
+    written = {}
+    for entity in entities:
+        written[entity] = []
+        per_file = max(1, records[entity] // (partitions * files))
+        duplicates = round(per_file * duplicate_rate)
+        start = 0
+        for partition in range(partitions):
+            partition_dir = os.path.join(snapshot_dir, 'data', entity, f"updated_date=2023-{partition + 1:02d}-01")
+            os.makedirs(partition_dir, exist_ok=True)
+            for part in range(files):
+                jsonl_file_name = os.path.join(partition_dir, f"part_{part:03d}.gz")
+                lines = make_lines(entity, per_file, seed, start, **shape)
+                if partition and duplicates:
+                    lines += make_lines(entity, duplicates, seed, start - files * per_file, partition, **shape)
+                with gzip.open(jsonl_file_name, 'wb') as jsonl:
+                    jsonl.writelines(lines)
+                written[entity].append(jsonl_file_name)
+                start += per_file
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="synthetic")
+    parser.add_argument("--snapshot_dir", type=str, default="./data/openalex/synthetic-snapshot",
+                        help="directory of the generated snapshot")
+    parser.add_argument("--works", type=int, default=20000, help="number of works")
+    parser.add_argument("--others", type=int, default=5000, help="number of records of every other entity")
+    parser.add_argument("--partitions", type=int, default=1, help="updated_date partitions per entity")
+    parser.add_argument("--files", type=int, default=2, help="files per partition")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--duplicate_rate", type=float, default=0.0,
+                        help="fraction of the records of a partition repeated, updated, in the next partition")
+    for name, default in WORK_SHAPE.items():
+        parser.add_argument(f"--{name}", type=int, default=default, help=f"{name} per work")
+    args = parser.parse_args()
+
+    records = {entity: args.works if entity == 'works' else args.others for entity in ENTITIES}
+    shape = {name: getattr(args, name) for name in WORK_SHAPE}
+    written = write_snapshot(args.snapshot_dir, records, ENTITIES, args.partitions, args.files, args.seed,
+                             args.duplicate_rate, **shape)
+    for entity, files in written.items():
+        print(f"{entity}: {len(files)} files")
@@ -1,579 +1,430 @@
-import csv
 import glob
-import gzip
-import json
 import os
 import argparse
-import threading
-import tqdm
-
-MAX_CONCURRENT_THREADS = 16
-# Create a semaphore to control the number of concurrent threads
-thread_semaphore = threading.Semaphore(MAX_CONCURRENT_THREADS)
-
-parser = argparse.ArgumentParser(description="flatten-openalex-works-to-csv")
-parser.add_argument("--snapshot_dir", type=str, default="./data/openalex/openalex-snapshot",
-                    help="snapshot_dir")
-parser.add_argument("--csv_dir", type=str, default="./data/openalex/csv-files",
-                    help="csv_dir")
-args = parser.parse_args()
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-SNAPSHOT_DIR = args.snapshot_dir
-CSV_DIR = args.csv_dir
+import tqdm
 
+from openalex_io import (CODECS, FORMATS, NO_DEDUP_WARNING, READERS, TableWriters, init_memory_budget, input_number,
+                         loads, memory_budget, open_jsonl, parse_shard, plan_latest, planned_skip_lines,
+                         read_dedup_plan, shard_of, write_dedup_plan, write_shard_manifest)
+from openalex_metrics import Metrics, MetricsDump, StageClock
+from openalex_tables import TABLES, file_spec, row_extractors, select_tables, table_keys
 
 FILES_PER_ENTITY = int(os.environ.get('OPENALEX_DEMO_FILES_PER_ENTITY', '0'))
 
-max_threads = 12
-semaphore = threading.Semaphore(max_threads)
-lock = threading.Lock()
-
-csv_files = {
-    'authors': {
-        'authors': {
-            'name': os.path.join(CSV_DIR, 'authors.csv.gz'),
-            'columns': [
-                'id', 'orcid', 'display_name', 'display_name_alternatives', 'works_count',
-                'cited_by_count',
-                'last_known_institution', 'works_api_url', 'updated_date'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'authors_ids.csv.gz'),
-            'columns': [
-                'author_id', 'openalex', 'orcid', 'scopus', 'twitter', 'wikipedia', 'mag',
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'authors_counts_by_year.csv.gz'),
-            'columns': [
-                'author_id', 'year', 'works_count', 'cited_by_count', 'oa_works_count'
-            ]
-        }
-    },
-    'concepts': {
-        'concepts': {
-            'name': os.path.join(CSV_DIR, 'concepts.csv.gz'),
-            'columns': [
-                'id', 'wikidata', 'display_name', 'level', 'description', 'works_count', 'cited_by_count', 'image_url',
-                'image_thumbnail_url', 'works_api_url', 'updated_date'
-            ]
-        },
-        'ancestors': {
-            'name': os.path.join(CSV_DIR, 'concepts_ancestors.csv.gz'),
-            'columns': ['concept_id', 'ancestor_id']
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'concepts_counts_by_year.csv.gz'),
-            'columns': ['concept_id', 'year', 'works_count', 'cited_by_count', 'oa_works_count']
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'concepts_ids.csv.gz'),
-            'columns': ['concept_id', 'openalex', 'wikidata', 'wikipedia', 'umls_aui', 'umls_cui', 'mag']
-        },
-        'related_concepts': {
-            'name': os.path.join(CSV_DIR, 'concepts_related_concepts.csv.gz'),
-            'columns': ['concept_id', 'related_concept_id', 'score']
-        }
-    },
-    'institutions': {
-        'institutions': {
-            'name': os.path.join(CSV_DIR, 'institutions.csv.gz'),
-            'columns': [
-                'id', 'ror', 'display_name', 'country_code', 'type', 'homepage_url', 'image_url', 'image_thumbnail_url',
-                'display_name_acroynyms', 'display_name_alternatives', 'works_count', 'cited_by_count', 'works_api_url',
-                'updated_date'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'institutions_ids.csv.gz'),
-            'columns': [
-                'institution_id', 'openalex', 'ror', 'grid', 'wikipedia', 'wikidata', 'mag'
-            ]
-        },
-        'geo': {
-            'name': os.path.join(CSV_DIR, 'institutions_geo.csv.gz'),
-            'columns': [
-                'institution_id', 'city', 'geonames_city_id', 'region', 'country_code', 'country', 'latitude',
-                'longitude'
-            ]
-        },
-        'associated_institutions': {
-            'name': os.path.join(CSV_DIR, 'institutions_associated_institutions.csv.gz'),
-            'columns': [
-                'institution_id', 'associated_institution_id', 'relationship'
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'institutions_counts_by_year.csv.gz'),
-            'columns': [
-                'institution_id', 'year', 'works_count', 'cited_by_count', 'oa_works_count'
-            ]
-        }
-    },
-    'publishers': {
-        'publishers': {
-            'name': os.path.join(CSV_DIR, 'publishers.csv.gz'),
-            'columns': [
-                'id', 'display_name', 'alternate_titles', 'country_codes', 'hierarchy_level', 'parent_publisher',
-                'works_count', 'cited_by_count', 'sources_api_url', 'updated_date'
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'publishers_counts_by_year.csv.gz'),
-            'columns': ['publisher_id', 'year', 'works_count', 'cited_by_count', 'oa_works_count']
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'publishers_ids.csv.gz'),
-            'columns': ['publisher_id', 'openalex', 'ror', 'wikidata']
-        },
-    },
-    'sources': {
-        'sources': {
-            'name': os.path.join(CSV_DIR, 'sources.csv.gz'),
-            'columns': [
-                'id', 'issn_l', 'issn', 'display_name', 'publisher', 'works_count', 'cited_by_count', 'is_oa',
-                'is_in_doaj', 'homepage_url', 'works_api_url', 'updated_date'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'sources_ids.csv.gz'),
-            'columns': ['source_id', 'openalex', 'issn_l', 'issn', 'mag', 'wikidata', 'fatcat']
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'sources_counts_by_year.csv.gz'),
-            'columns': ['source_id', 'year', 'works_count', 'cited_by_count', 'oa_works_count']
-        },
-    },
-    'works': {
-        'works': {
-            'name': os.path.join(CSV_DIR, 'works.csv.gz'),
-            'columns': [
-                'id', 'doi', 'title', 'display_name', 'publication_year', 'publication_date', 'type', 'cited_by_count',
-                'is_retracted', 'is_paratext', 'cited_by_api_url',
-                # 'abstract_inverted_index' # we don't need abstract_inverted_index
-            ]
-        },
-        'primary_locations': {
-            'name': os.path.join(CSV_DIR, 'works_primary_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa', 'version', 'license'
-            ]
-        },
-        'locations': {
-            'name': os.path.join(CSV_DIR, 'works_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa', 'version', 'license'
-            ]
-        },
-        'best_oa_locations': {
-            'name': os.path.join(CSV_DIR, 'works_best_oa_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa', 'version', 'license'
-            ]
-        },
-        'authorships': {
-            'name': os.path.join(CSV_DIR, 'works_authorships.csv.gz'),
-            'columns': [
-                'work_id', 'author_position', 'author_id', 'institution_id', 'raw_affiliation_string'
-            ]
-        },
-        'biblio': {
-            'name': os.path.join(CSV_DIR, 'works_biblio.csv.gz'),
-            'columns': [
-                'work_id', 'volume', 'issue', 'first_page', 'last_page'
-            ]
-        },
-        'concepts': {
-            'name': os.path.join(CSV_DIR, 'works_concepts.csv.gz'),
-            'columns': [
-                'work_id', 'concept_id', 'score'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'works_ids.csv.gz'),
-            'columns': [
-                'work_id', 'openalex', 'doi', 'mag', 'pmid', 'pmcid'
-            ]
-        },
-        'mesh': {
-            'name': os.path.join(CSV_DIR, 'works_mesh.csv.gz'),
-            'columns': [
-                'work_id', 'descriptor_ui', 'descriptor_name', 'qualifier_ui', 'qualifier_name', 'is_major_topic'
-            ]
-        },
-        'open_access': {
-            'name': os.path.join(CSV_DIR, 'works_open_access.csv.gz'),
-            'columns': [
-                'work_id', 'is_oa', 'oa_status', 'oa_url', 'any_repository_has_fulltext'
-            ]
-        },
-        'referenced_works': {
-            'name': os.path.join(CSV_DIR, 'works_referenced_works.csv.gz'),
-            'columns': [
-                'work_id', 'referenced_work_id'
-            ]
-        },
-        'related_works': {
-            'name': os.path.join(CSV_DIR, 'works_related_works.csv.gz'),
-            'columns': [
-                'work_id', 'related_work_id'
-            ]
-        },
-    },
-}
-
+# the generated row tuple extractors of every table, see openalex_tables
+ENTITY_ROWS = {entity: row_extractors(entity) for entity in TABLES}
+
+
+def get_csv_files(csv_dir, num=None, tables=None):
+    suffix = '' if num is None else f'_{num}'
+    return {entity: file_spec(entity, csv_dir, suffix, tables=tables) for entity in TABLES}
+
+
+def process_author(author, keys=None):
+    extract = ENTITY_ROWS['authors']
+    keys = TABLES['authors'] if keys is None else keys
+    author_id = author.get('id')
+
+    # authors
+    authors_list = [extract['authors'](author)] if 'authors' in keys else []
+
+    # ids
+    ids_list = []
+    if 'ids' in keys and (author_ids := author.get('ids')):
+        ids_list.append(extract['ids'](author_ids, author_id))
+
+    # counts_by_year
+    counts_by_year_list = []
+    if 'counts_by_year' in keys and (counts_by_year := author.get('counts_by_year')):
+        for count_by_year in counts_by_year:
+            counts_by_year_list.append(extract['counts_by_year'](count_by_year, author_id))
+
+    return [("authors", authors_list),
+            ("ids", ids_list),
+            ("counts_by_year", counts_by_year_list)]
+
+
+def process_concept(concept, keys=None):
+    extract = ENTITY_ROWS['concepts']
+    keys = TABLES['concepts'] if keys is None else keys
+    concept_id = concept.get('id')
+    concepts_list = [extract['concepts'](concept)] if 'concepts' in keys else []
+
+    ids_list = []
+    if 'ids' in keys and (concept_ids := concept.get('ids')):
+        ids_list.append(extract['ids'](concept_ids, concept_id))
+
+    ancestors_list = []
+    if 'ancestors' in keys and (ancestors := concept.get('ancestors')):
+        for ancestor in ancestors:
+            if ancestor_id := ancestor.get('id'):
+                ancestors_list.append((concept_id, ancestor_id))
+
+    counts_by_year_list = []
+    if 'counts_by_year' in keys and (counts_by_year := concept.get('counts_by_year')):
+        for count_by_year in counts_by_year:
+            counts_by_year_list.append(extract['counts_by_year'](count_by_year, concept_id))
 
-def flatten_authors():
-    file_spec = csv_files['authors']
-
-    with gzip.open(file_spec['authors']['name'], 'wt', encoding='utf-8') as authors_csv, \
-            gzip.open(file_spec['ids']['name'], 'wt', encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv:
+    related_concepts_list = []
+    if 'related_concepts' in keys and (related_concepts := concept.get('related_concepts')):
+        for related_concept in related_concepts:
+            if related_concept_id := related_concept.get('id'):
+                related_concepts_list.append(extract['related_concepts'](related_concept, concept_id,
+                                                                         related_concept_id))
+
+    return [("concepts", concepts_list),
+            ("ancestors", ancestors_list),
+            ("counts_by_year", counts_by_year_list),
+            ("ids", ids_list),
+            ("related_concepts", related_concepts_list)]
+
+
+def process_institution(institution, keys=None):
+    extract = ENTITY_ROWS['institutions']
+    keys = TABLES['institutions'] if keys is None else keys
+    institution_id = institution.get('id')
+
+    # institutions
+    institutions_list = [extract['institutions'](institution)] if 'institutions' in keys else []
+
+    # ids
+    ids_list = []
+    if 'ids' in keys and (institution_ids := institution.get('ids')):
+        ids_list.append(extract['ids'](institution_ids, institution_id))
+
+    # geo
+    geo_list = []
+    if 'geo' in keys and (institution_geo := institution.get('geo')):
+        geo_list.append(extract['geo'](institution_geo, institution_id))
+
+    # associated_institutions
+    associated_institutions_list = []
+    if 'associated_institutions' in keys and (associated_institutions := institution.get(
+            'associated_institutions', institution.get('associated_insitutions')  # typo in api
+    )):
+        for associated_institution in associated_institutions:
+            if associated_institution_id := associated_institution.get('id'):
+                associated_institutions_list.append(
+                    extract['associated_institutions'](associated_institution, institution_id,
+                                                       associated_institution_id))
+
+    # counts_by_year
+    counts_by_year_list = []
+    if 'counts_by_year' in keys and (counts_by_year := institution.get('counts_by_year')):
+        for count_by_year in counts_by_year:
+            counts_by_year_list.append(extract['counts_by_year'](count_by_year, institution_id))
+
+    return [("institutions", institutions_list),
+            ("ids", ids_list),
+            ("geo", geo_list),
+            ("associated_institutions", associated_institutions_list),
+            ("counts_by_year", counts_by_year_list)]
+
+
+def process_publisher(publisher, keys=None):
+    extract = ENTITY_ROWS['publishers']
+    keys = TABLES['publishers'] if keys is None else keys
+    publisher_id = publisher.get('id')
+
+    # publishers
+    publishers_list = [extract['publishers'](publisher)] if 'publishers' in keys else []
+
+    ids_list = []
+    if 'ids' in keys and (publisher_ids := publisher.get('ids')):
+        ids_list.append(extract['ids'](publisher_ids, publisher_id))
+
+    counts_by_year_list = []
+    if 'counts_by_year' in keys and (counts_by_year := publisher.get('counts_by_year')):
+        for count_by_year in counts_by_year:
+            counts_by_year_list.append(extract['counts_by_year'](count_by_year, publisher_id))
+
+    return [("publishers", publishers_list),
+            ("counts_by_year", counts_by_year_list),
+            ("ids", ids_list)]
+
+
+def process_source(source, keys=None):
+    extract = ENTITY_ROWS['sources']
+    keys = TABLES['sources'] if keys is None else keys
+    source_id = source.get('id')
+
+    sources_list = [extract['sources'](source)] if 'sources' in keys else []
+
+    ids_list = []
+    if 'ids' in keys and (source_ids := source.get('ids')):
+        ids_list.append(extract['ids'](source_ids, source_id))
+
+    counts_by_year_list = []
+    if 'counts_by_year' in keys and (counts_by_year := source.get('counts_by_year')):
+        for count_by_year in counts_by_year:
+            counts_by_year_list.append(extract['counts_by_year'](count_by_year, source_id))
+
+    return [("sources", sources_list),
+            ("ids", ids_list),
+            ("counts_by_year", counts_by_year_list)]
+
+
+ENTITY_PROCESSORS = {
+    'authors': process_author,
+    'concepts': process_concept,
+    'institutions': process_institution,
+    'publishers': process_publisher,
+    'sources': process_source,
+}
 
-        authors_writer = csv.DictWriter(
-            authors_csv, fieldnames=file_spec['authors']['columns'], extrasaction='ignore'
-        )
-        authors_writer.writeheader()
 
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=file_spec['ids']['columns'])
-        ids_writer.writeheader()
-
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv, fieldnames=file_spec['counts_by_year']['columns'])
-        counts_by_year_writer.writeheader()
-
-        files_done = 0
-        for jsonl_file_name in tqdm.tqdm(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'authors', '*', '*.gz'))):
-            # print(jsonl_file_name))
-            with gzip.open(jsonl_file_name, 'r') as authors_jsonl:
-                for author_json in authors_jsonl:
-                    if not author_json.strip():
-                        continue
-
-                    author = json.loads(author_json)
-
-                    if not (author_id := author.get('id')):
-                        continue
-
-                    # authors
-                    author['display_name_alternatives'] = json.dumps(author.get('display_name_alternatives'),
-                                                                     ensure_ascii=False)
-                    author['last_known_institution'] = (author.get('last_known_institution') or {}).get('id')
-                    authors_writer.writerow(author)
-
-                    # ids
-                    if author_ids := author.get('ids'):
-                        author_ids['author_id'] = author_id
-                        ids_writer.writerow(author_ids)
-
-                    # counts_by_year
-                    if counts_by_year := author.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['author_id'] = author_id
-                            counts_by_year_writer.writerow(count_by_year)
-            files_done += 1
-            if FILES_PER_ENTITY and files_done >= FILES_PER_ENTITY:
-                break
-
-
-def flatten_concepts():
-    with gzip.open(csv_files['concepts']['concepts']['name'], 'wt', encoding='utf-8') as concepts_csv, \
-            gzip.open(csv_files['concepts']['ancestors']['name'], 'wt', encoding='utf-8') as ancestors_csv, \
-            gzip.open(csv_files['concepts']['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv, \
-            gzip.open(csv_files['concepts']['ids']['name'], 'wt', encoding='utf-8') as ids_csv, \
-            gzip.open(csv_files['concepts']['related_concepts']['name'], 'wt',
-                      encoding='utf-8') as related_concepts_csv:
-
-        concepts_writer = csv.DictWriter(
-            concepts_csv, fieldnames=csv_files['concepts']['concepts']['columns'], extrasaction='ignore'
-        )
-        concepts_writer.writeheader()
-
-        ancestors_writer = csv.DictWriter(ancestors_csv, fieldnames=csv_files['concepts']['ancestors']['columns'])
-        ancestors_writer.writeheader()
-
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv,
-                                               fieldnames=csv_files['concepts']['counts_by_year']['columns'])
-        counts_by_year_writer.writeheader()
-
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=csv_files['concepts']['ids']['columns'])
-        ids_writer.writeheader()
-
-        related_concepts_writer = csv.DictWriter(related_concepts_csv,
-                                                 fieldnames=csv_files['concepts']['related_concepts']['columns'])
-        related_concepts_writer.writeheader()
-
-        seen_concept_ids = set()
-
-        files_done = 0
-        for jsonl_file_name in tqdm.tqdm(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'concepts', '*', '*.gz'))):
-            # # print(jsonl_file_name))
-            with gzip.open(jsonl_file_name, 'r') as concepts_jsonl:
-                for concept_json in concepts_jsonl:
-                    if not concept_json.strip():
-                        continue
-
-                    concept = json.loads(concept_json)
-
-                    if not (concept_id := concept.get('id')) or concept_id in seen_concept_ids:
-                        continue
-
-                    seen_concept_ids.add(concept_id)
-
-                    concepts_writer.writerow(concept)
-
-                    if concept_ids := concept.get('ids'):
-                        concept_ids['concept_id'] = concept_id
-                        concept_ids['umls_aui'] = json.dumps(concept_ids.get('umls_aui'), ensure_ascii=False)
-                        concept_ids['umls_cui'] = json.dumps(concept_ids.get('umls_cui'), ensure_ascii=False)
-                        ids_writer.writerow(concept_ids)
-
-                    if ancestors := concept.get('ancestors'):
-                        for ancestor in ancestors:
-                            if ancestor_id := ancestor.get('id'):
-                                ancestors_writer.writerow({
-                                    'concept_id': concept_id,
-                                    'ancestor_id': ancestor_id
-                                })
-
-                    if counts_by_year := concept.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['concept_id'] = concept_id
-                            counts_by_year_writer.writerow(count_by_year)
-
-                    if related_concepts := concept.get('related_concepts'):
-                        for related_concept in related_concepts:
-                            if related_concept_id := related_concept.get('id'):
-                                related_concepts_writer.writerow({
-                                    'concept_id': concept_id,
-                                    'related_concept_id': related_concept_id,
-                                    'score': related_concept.get('score')
-                                })
-
-            files_done += 1
-            if FILES_PER_ENTITY and files_done >= FILES_PER_ENTITY:
-                break
-
-
-def flatten_institutions():
-    file_spec = csv_files['institutions']
-
-    with gzip.open(file_spec['institutions']['name'], 'wt', encoding='utf-8') as institutions_csv, \
-            gzip.open(file_spec['ids']['name'], 'wt', encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['geo']['name'], 'wt', encoding='utf-8') as geo_csv, \
-            gzip.open(file_spec['associated_institutions']['name'], 'wt',
-                      encoding='utf-8') as associated_institutions_csv, \
-            gzip.open(file_spec['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv:
-
-        institutions_writer = csv.DictWriter(
-            institutions_csv, fieldnames=file_spec['institutions']['columns'], extrasaction='ignore'
-        )
-        institutions_writer.writeheader()
-
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=file_spec['ids']['columns'])
-        ids_writer.writeheader()
-
-        geo_writer = csv.DictWriter(geo_csv, fieldnames=file_spec['geo']['columns'])
-        geo_writer.writeheader()
-
-        associated_institutions_writer = csv.DictWriter(
-            associated_institutions_csv, fieldnames=file_spec['associated_institutions']['columns']
-        )
-        associated_institutions_writer.writeheader()
-
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv, fieldnames=file_spec['counts_by_year']['columns'])
-        counts_by_year_writer.writeheader()
-
-        seen_institution_ids = set()
-
-        files_done = 0
-        for jsonl_file_name in tqdm.tqdm(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'institutions', '*', '*.gz'))):
-            # print(jsonl_file_name))
-            with gzip.open(jsonl_file_name, 'r') as institutions_jsonl:
-                for institution_json in institutions_jsonl:
-                    if not institution_json.strip():
-                        continue
-
-                    institution = json.loads(institution_json)
-
-                    if not (institution_id := institution.get('id')) or institution_id in seen_institution_ids:
-                        continue
-
-                    seen_institution_ids.add(institution_id)
-
-                    # institutions
-                    institution['display_name_acroynyms'] = json.dumps(institution.get('display_name_acroynyms'),
-                                                                       ensure_ascii=False)
-                    institution['display_name_alternatives'] = json.dumps(institution.get('display_name_alternatives'),
-                                                                          ensure_ascii=False)
-                    institutions_writer.writerow(institution)
-
-                    # ids
-                    if institution_ids := institution.get('ids'):
-                        institution_ids['institution_id'] = institution_id
-                        ids_writer.writerow(institution_ids)
-
-                    # geo
-                    if institution_geo := institution.get('geo'):
-                        institution_geo['institution_id'] = institution_id
-                        geo_writer.writerow(institution_geo)
-
-                    # associated_institutions
-                    if associated_institutions := institution.get(
-                            'associated_institutions', institution.get('associated_insitutions')  # typo in api
-                    ):
-                        for associated_institution in associated_institutions:
-                            if associated_institution_id := associated_institution.get('id'):
-                                associated_institutions_writer.writerow({
-                                    'institution_id': institution_id,
-                                    'associated_institution_id': associated_institution_id,
-                                    'relationship': associated_institution.get('relationship')
-                                })
-
-                    # counts_by_year
-                    if counts_by_year := institution.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['institution_id'] = institution_id
-                            counts_by_year_writer.writerow(count_by_year)
-
-            files_done += 1
-            if FILES_PER_ENTITY and files_done >= FILES_PER_ENTITY:
-                break
-
-
-def flatten_publishers():
-    with gzip.open(csv_files['publishers']['publishers']['name'], 'wt', encoding='utf-8') as publishers_csv, \
-            gzip.open(csv_files['publishers']['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv, \
-            gzip.open(csv_files['publishers']['ids']['name'], 'wt', encoding='utf-8') as ids_csv:
-
-        publishers_writer = csv.DictWriter(
-            publishers_csv, fieldnames=csv_files['publishers']['publishers']['columns'], extrasaction='ignore'
-        )
-        publishers_writer.writeheader()
-
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv,
-                                               fieldnames=csv_files['publishers']['counts_by_year']['columns'])
-        counts_by_year_writer.writeheader()
-
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=csv_files['publishers']['ids']['columns'])
-        ids_writer.writeheader()
-
-        seen_publisher_ids = set()
-
-        files_done = 0
-        for jsonl_file_name in tqdm.tqdm(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'publishers', '*', '*.gz'))):
-            # print(jsonl_file_name))
-            with gzip.open(jsonl_file_name, 'r') as concepts_jsonl:
-                for publisher_json in concepts_jsonl:
-                    if not publisher_json.strip():
-                        continue
-
-                    publisher = json.loads(publisher_json)
-
-                    if not (publisher_id := publisher.get('id')) or publisher_id in seen_publisher_ids:
-                        continue
-
-                    seen_publisher_ids.add(publisher_id)
-
-                    # publishers
-                    publisher['alternate_titles'] = json.dumps(publisher.get('alternate_titles'), ensure_ascii=False)
-                    publisher['country_codes'] = json.dumps(publisher.get('country_codes'), ensure_ascii=False)
-                    publishers_writer.writerow(publisher)
-
-                    if publisher_ids := publisher.get('ids'):
-                        publisher_ids['publisher_id'] = publisher_id
-                        ids_writer.writerow(publisher_ids)
-
-                    if counts_by_year := publisher.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['publisher_id'] = publisher_id
-                            counts_by_year_writer.writerow(count_by_year)
-
-            files_done += 1
-            if FILES_PER_ENTITY and files_done >= FILES_PER_ENTITY:
-                break
-
-
-def flatten_sources():
-    with gzip.open(csv_files['sources']['sources']['name'], 'wt', encoding='utf-8') as sources_csv, \
-            gzip.open(csv_files['sources']['ids']['name'], 'wt', encoding='utf-8') as ids_csv, \
-            gzip.open(csv_files['sources']['counts_by_year']['name'], 'wt', encoding='utf-8') as counts_by_year_csv:
-
-        sources_writer = csv.DictWriter(
-            sources_csv, fieldnames=csv_files['sources']['sources']['columns'], extrasaction='ignore'
-        )
-        sources_writer.writeheader()
-
-        ids_writer = csv.DictWriter(ids_csv, fieldnames=csv_files['sources']['ids']['columns'], extrasaction='ignore')
-        ids_writer.writeheader()
-
-        counts_by_year_writer = csv.DictWriter(counts_by_year_csv,
-                                               fieldnames=csv_files['sources']['counts_by_year']['columns'],
-                                               extrasaction='raise')
-        counts_by_year_writer.writeheader()
-
-        seen_source_ids = set()
-
-        files_done = 0
-        for jsonl_file_name in tqdm.tqdm(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'sources', '*', '*.gz'))):
-            if files_done > 1:
+def entity_files(snapshot_dir, entity):
+    files = sorted(glob.glob(os.path.join(snapshot_dir, 'data', entity, '*', '*.gz')))
+    if FILES_PER_ENTITY:
+        files = files[:FILES_PER_ENTITY]
+    return files
+
+
+def process_entity_file(entity, num, jsonl_file_name, csv_dir, skip_lines=frozenset(), fmt='csv', options=None,
+                        compact_ids=False, metrics=None, reader='inline', readahead=4, tables=None, outputs=None):
+    """Flatten one snapshot file of ``entity`` into its own ``*_{num}.csv.gz`` shards.
+
+    ``skip_lines`` are the numbers of the (non blank) lines holding a record
+    a newer copy of which is kept elsewhere, they are not even decoded. Returns the
+    number of records written, the stage times and table sizes are added to
+    ``metrics`` if given. With ``tables`` only those tables are computed and
+    written. The files written are added to ``outputs`` if given.
+    """
+    file_spec = get_csv_files(csv_dir, num, tables)[entity]
+    keys = table_keys(entity, tables)
+    process_record = ENTITY_PROCESSORS[entity]
+    records = 0
+    line_no = -1
+    bytes_read = 0
+    clock = StageClock()
+    budget = memory_budget()
+    waited = budget.wait_seconds if budget is not None else 0.0
+
+    with TableWriters(file_spec, fmt, options, compact_ids, budget=budget) as writers, \
+            open_jsonl(jsonl_file_name, reader, readahead) as jsonl:
+        for record_json in jsonl:
+            clock.lap('read')
+            bytes_read += len(record_json)
+            if not record_json.strip():
+                continue
+            line_no += 1
+            if line_no in skip_lines:
                 continue
-            # print(jsonl_file_name))
-            with gzip.open(jsonl_file_name, 'r') as sources_jsonl:
-                for source_json in sources_jsonl:
-                    if not source_json.strip():
-                        continue
-
-                    source = json.loads(source_json)
-
-                    if not (source_id := source.get('id')) or source_id in seen_source_ids:
-                        continue
-
-                    seen_source_ids.add(source_id)
-
-                    source['issn'] = json.dumps(source.get('issn'))
-                    sources_writer.writerow(source)
-
-                    if source_ids := source.get('ids'):
-                        source_ids['source_id'] = source_id
-                        source_ids['issn'] = json.dumps(source_ids.get('issn'))
-                        ids_writer.writerow(source_ids)
-
-                    if counts_by_year := source.get('counts_by_year'):
-                        for count_by_year in counts_by_year:
-                            count_by_year['source_id'] = source_id
-                            counts_by_year_writer.writerow(count_by_year)
-
-            files_done += 1
-            if FILES_PER_ENTITY and files_done >= FILES_PER_ENTITY:
-                break
 
+            record = loads(record_json)
+            clock.lap('decode')
+            if not record.get('id'):
+                continue
 
-def init_dict_writer(csv_file, file_spec, **kwargs):
-    writer = csv.DictWriter(
-        csv_file, fieldnames=file_spec['columns'], **kwargs
-    )
-    writer.writeheader()
-    return writer
+            rows = process_record(record, keys)
+            clock.lap('process')
+            for key, values in rows:
+                if values:
+                    writers.write(key, values)
+            records += 1
+            clock.lap('encode')
+    if metrics is not None:
+        metrics.add_file(entity, jsonl_file_name, records, bytes_read, clock, writers)
+        if budget is not None:
+            metrics.add('memory_wait_seconds', budget.wait_seconds - waited, entity=entity)
+    if outputs is not None:
+        outputs.update(writers.file_stats())
+    return records
+
+
+def process_entity_file_metered(*args, **kwargs):
+    """Run process_entity_file in a worker, returns ``(records, metrics values, output files)`` for the parent."""
+    metrics = Metrics()
+    outputs = {}
+    records = process_entity_file(*args, metrics=metrics, outputs=outputs, **kwargs)
+    return records, metrics.values, outputs
+
+
+def flatten_entities(entities, snapshot_dir, csv_dir, workers, fmt='csv', options=None, compact_ids=False,
+                     metrics=None, dump=None, reader='inline', readahead=4, dedup=True, dedup_dir=None,
+                     memory_budget_bytes=None, tables=None, shard=None, outputs=None, dedup_plan=None):
+    """Flatten the files of ``entities`` on a pool of ``workers`` processes.
+
+    Each file becomes one set of ``<table>_<n>.csv.gz`` shards. Of a record
+    found more than once, in the same file or across ``updated_date=``
+    partitions, only the newest copy is kept, picked by ``plan_latest`` with
+    its id index in ``dedup_dir`` (the temporary directory by default),
+    unless ``dedup`` is off. ``memory_budget_bytes`` bounds the rows buffered
+    by all the workers together (see ``MemoryBudget``). With ``tables`` only
+    those tables are computed and written, the entities without any are not
+    even read. With ``shard``, ``(i, N)``, only the files ``shard_of``
+    assigns to shard ``i`` are flattened, into shards named after the input
+    file, and the output files of each are collected into ``outputs``.
+    ``dedup_plan`` (see ``write_dedup_plan``) gives the lines to skip
+    without scanning the ids of the snapshot, which a shard otherwise does
+    from its oldest file on.
+    The metrics of every file are merged into ``metrics`` and written out by
+    ``dump`` as they come. Returns the list of ``(jsonl_file_name, exception)``
+    failures.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_memory_budget,
+                             initargs=(memory_budget_bytes, multiprocessing.Value('q', 0))) as pool:
+        futures = {}
+        for entity in entities:
+            if not table_keys(entity, tables):
+                continue
+            files = entity_files(snapshot_dir, entity)
+            if shard is None:
+                assigned = {i: i for i in range(len(files))}
+            else:
+                assigned = {i: input_number(jsonl_file_name) for i, jsonl_file_name in enumerate(files)
+                            if shard_of(jsonl_file_name, shard[1]) == shard[0]}
+                if len(set(assigned.values())) < len(assigned):
+                    raise ValueError(f"{entity} files with the same number, they would write the same output files")
+            # the files older than the first one of the shard don't change what it skips
+            first = min(assigned, default=len(files))
+            if dedup_plan is not None:
+                skip_lines = [frozenset()] * len(files)
+                for i, lines in zip(assigned, planned_skip_lines(dedup_plan, [files[i] for i in assigned])):
+                    skip_lines[i] = lines
+            elif dedup:
+                skip_lines = [frozenset()] * first + plan_latest(pool, files[first:], dedup_dir)
+            else:
+                skip_lines = [frozenset()] * len(files)
+            for i, num in assigned.items():
+                future = pool.submit(process_entity_file_metered, entity, num, files[i], csv_dir, skip_lines[i],
+                                     fmt, options, compact_ids, reader=reader, readahead=readahead, tables=tables)
+                futures[future] = files[i]
+
+        with tqdm.tqdm(total=len(futures), desc="Flattening", unit="file") as progress:
+            for future in as_completed(futures):
+                try:
+                    _, values, files = future.result()
+                except Exception as e:
+                    print(f"Failed to process {futures[future]}: {e!r}")
+                    failures.append((futures[future], e))
+                else:
+                    metrics.merge(values)
+                    if outputs is not None:
+                        outputs[futures[future]] = files
+                    if dump is not None:
+                        dump.maybe_write(metrics)
+                progress.update(1)
+    return failures
 
 
 if __name__ == '__main__':
-
-
-
-    threads = []
-
-    t = threading.Thread(target=flatten_authors)
-    threads.append(t)
-    t = threading.Thread(target=flatten_concepts)
-    threads.append(t)
-    t = threading.Thread(target=flatten_institutions)
-    threads.append(t)
-    t = threading.Thread(target=flatten_publishers)
-    threads.append(t)
-    t = threading.Thread(target=flatten_sources)
-    threads.append(t)
-    for t in threads:
-        t.start()
-    for t in threads:
-        t.join()
+    parser = argparse.ArgumentParser(description="flatten-openalex-other-jsonl")
+    parser.add_argument("--snapshot_dir", type=str, default="./data/openalex/openalex-snapshot",
+                        help="snapshot_dir")
+    parser.add_argument("--csv_dir", type=str, default="./data/openalex/csv-files",
+                        help="csv_dir")
+    parser.add_argument("--entities", type=str, nargs='+', choices=list(ENTITY_PROCESSORS),
+                        default=list(ENTITY_PROCESSORS), help="entities to flatten")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes, files of every entity are spread over them")
+    parser.add_argument("--format", type=str, choices=list(FORMATS), default='csv',
+                        help="csv files, PostgreSQL binary COPY files (.pgcopy.gz) or parquet files, "
+                             "the last two typed after the schema")
+    parser.add_argument("--row_group_size", type=int, default=100000,
+                        help="rows per parquet row group")
+    parser.add_argument("--parquet_compression", type=str, default='zstd',
+                        choices=['zstd', 'snappy', 'gzip', 'lz4', 'brotli', 'none'],
+                        help="parquet compression codec")
+    parser.add_argument("--codec", type=str, choices=list(CODECS), default='gzip',
+                        help="compression of the csv and binary files, zstd and lz4 need their python package")
+    parser.add_argument("--level", type=int, default=None,
+                        help="compression level of --codec, defaults to 6 for gzip, 3 for zstd and 0 for lz4")
+    parser.add_argument("--compress_offload", type=str, choices=['thread', 'process'], default=None,
+                        help="compress on a thread of each worker, or in an external pigz/gzip/zstd/lz4 process "
+                             "per file, instead of inline")
+    parser.add_argument("--compact_ids", action="store_true",
+                        help="write the OpenAlex ids as bigint numbers, load them into a schema altered with "
+                             "openalex-pg-schema-compact-ids.sql")
+    parser.add_argument("--reader", type=str, choices=READERS, default='inline',
+                        help="inflate the input inline, ahead on a thread, or in an external pigz/gzip process")
+    parser.add_argument("--readahead", type=int, default=4,
+                        help="blocks of 4MB of inflated lines the thread/process reader keeps ready")
+    parser.add_argument("--no_dedup", action="store_true",
+                        help="keep every copy of a record instead of the one of the newest updated_date partition, "
+                             "the primary keys of openalex-pg-indexes.sql then fail to build")
+    parser.add_argument("--dedup_dir", type=str, default=None,
+                        help="directory of the id bitmap of the deduplication, the temporary directory by default")
+    parser.add_argument("--memory_budget_mb", type=float, default=None,
+                        help="bound the rows buffered by all the workers together (the parquet row groups), in MB, "
+                             "a worker flushes its largest buffers or waits when they go over it")
+    parser.add_argument("--tables", type=str, nargs='+', default=None,
+                        help="only compute and write these tables, names or patterns of the openalex tables "
+                             "(authors 'concepts_*'), all of them by default")
+    parser.add_argument("--exclude_tables", type=str, nargs='+', default=None,
+                        help="don't compute nor write these tables, e.g. '*_counts_by_year'")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="i/N, only flatten the files of shard i (0 <= i < N) of the snapshot, to spread it over "
+                             "N nodes; output files are named after their input file and the files flattened are "
+                             "listed in a manifest for merge_shard_manifests.py")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="manifest file of --shard, <csv_dir>/manifest_entities_<i>_of_<N>.json by default")
+    parser.add_argument("--dedup_plan", type=str, default=None,
+                        help="read the lines to skip from this plan instead of scanning the ids of the snapshot. "
+                             "Without it every --shard scans the ids of about the whole snapshot, make the plan "
+                             "once with --plan_only and give it to every shard")
+    parser.add_argument("--plan_only", action="store_true",
+                        help="only scan the ids of the whole snapshot, write the newest copy plan to --dedup_plan "
+                             "and exit")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="keep the per stage and per table metrics in this file, prometheus text if it "
+                             "ends with .prom (node_exporter textfile collector), json otherwise")
+    parser.add_argument("--metrics_interval", type=float, default=30,
+                        help="seconds between two writes of --metrics_file")
+    args = parser.parse_args()
+    try:
+        tables = select_tables(args.tables, args.exclude_tables)
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.plan_only and not args.dedup_plan:
+        parser.error("--plan_only needs --dedup_plan")
+    if args.dedup_plan and args.no_dedup:
+        parser.error("--dedup_plan and --no_dedup exclude each other")
+    if args.no_dedup:
+        print(NO_DEDUP_WARNING)
+
+    SNAPSHOT_DIR = args.snapshot_dir
+    CSV_DIR = args.csv_dir
+
+    if args.format == 'parquet':
+        options = {'row_group_size': args.row_group_size, 'compression': args.parquet_compression}
+    else:
+        options = {'codec': args.codec, 'level': args.level, 'offload': args.compress_offload}
+    if args.plan_only:
+        all_files, skip_lines = [], []
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            for entity in args.entities:
+                if table_keys(entity, tables):
+                    files = entity_files(SNAPSHOT_DIR, entity)
+                    all_files.extend(files)
+                    skip_lines.extend(plan_latest(pool, files, args.dedup_dir))
+        write_dedup_plan(args.dedup_plan, all_files, skip_lines)
+        print(f"dedup plan of {len(all_files)} files, {sum(map(len, skip_lines))} older copies to skip, "
+              f"written to {args.dedup_plan}")
+        raise SystemExit(0)
+    metrics = Metrics()
+    dump = MetricsDump(args.metrics_file, args.metrics_interval) if args.metrics_file else None
+    outputs = {}
+    failures = flatten_entities(args.entities, SNAPSHOT_DIR, CSV_DIR, args.workers, args.format, options,
+                                args.compact_ids, metrics, dump, args.reader, args.readahead,
+                                not args.no_dedup, args.dedup_dir,
+                                int(args.memory_budget_mb * 1024 * 1024) if args.memory_budget_mb else None, tables,
+                                shard, outputs, read_dedup_plan(args.dedup_plan) if args.dedup_plan else None)
+    print(metrics.summary())
+    if shard is not None:
+        all_files = [jsonl_file_name for entity in args.entities if table_keys(entity, tables)
+                     for jsonl_file_name in entity_files(SNAPSHOT_DIR, entity)]
+        manifest = args.manifest or os.path.join(CSV_DIR, f'manifest_entities_{shard[0]}_of_{shard[1]}.json')
+        write_shard_manifest(manifest, 'entities', shard, all_files, outputs, failures)
+        print(f"shard {shard[0]}/{shard[1]}: {len(outputs)} files flattened, manifest {manifest}")
+    if dump is not None:
+        dump.write(metrics)
+    if failures:
+        print(f"{len(failures)} files failed")
+        raise SystemExit(1)
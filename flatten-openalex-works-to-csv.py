@@ -2,23 +2,51 @@ import os
 import tqdm
 import glob
 import argparse
-import threading
-import gzip
-import json
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-import pandas as pd
+from openalex_io import (CODECS, FORMATS, NO_DEDUP_WARNING, READERS, TableWriters, WorkFilter, decode_work,
+                         init_memory_budget, input_number, memory_budget, open_jsonl, parse_shard, plan_latest,
+                         planned_skip_lines, read_dedup_plan, shard_of, write_dedup_plan, write_shard_manifest)
+from openalex_metrics import Metrics, MetricsDump, StageClock
+from openalex_tables import TABLES, file_spec, row_extractors, select_tables, table_keys
 
+WORK_ROWS = row_extractors('works')
 
-def process_work(work):
-    works_columns = [
-        'id', 'doi', 'title', 'display_name', 'publication_year', 'publication_date', 'type', 'cited_by_count',
-        'is_retracted', 'is_paratext', 'cited_by_api_url',
-        # 'abstract_inverted_index' # we don't need abstract_inverted_index
-    ]
 
-    works_list = []
+def rebuild_abstract(inverted_index):
+    """Turn an abstract_inverted_index back into plain text.
+
+    Every word is scattered straight into its positions of a preallocated list,
+    no sorting involved. The list is sized by the number of positions, which
+    is the abstract length unless some positions are missing.
+    """
+    words = [None] * sum(map(len, inverted_index.values())) if inverted_index else None
+    if not words:
+        return None
+    try:
+        for word, positions in inverted_index.items():
+            for position in positions:
+                words[position] = word
+    except IndexError:
+        # gaps in the positions, size the list by the last one instead
+        words = [None] * (1 + max(map(max, filter(None, inverted_index.values()))))
+        for word, positions in inverted_index.items():
+            for position in positions:
+                words[position] = word
+    if None in words:
+        return ' '.join(word for word in words if word is not None) or None
+    return ' '.join(words)
+
+
+def process_work(work, abstracts=False, keys=None):
+    """Flatten one work into ``[(key, rows)]``, a list of row tuples per table of ``TABLES['works']``.
+
+    Only the tables of ``keys`` are computed, the others are left empty.
+    """
+    extract = WORK_ROWS
+    keys = TABLES['works'] if keys is None else keys
+
     primary_locations_list = []
     locations_list = []
     best_oa_location_list = []
@@ -28,53 +56,31 @@ def process_work(work):
     ids_list = []
     mesh_list = []
     open_access_list = []
-    referenced_works_list = []
-    related_works_list = []
 
     work_id = work.get('id')
-    works_list.append({key: value for key, value in work.items() if key in works_columns})
+    works_list = [extract['works'](work)] if 'works' in keys else []
 
-    primary_location = work.get('primary_location', {})
+    primary_location = work.get('primary_location', {}) if 'primary_locations' in keys else None
     if primary_location and primary_location.get('source') and primary_location.get('source', {}).get('id'):
-        primary_locations_list.append({
-            'work_id': work_id,
-            'source_id': primary_location['source']['id'],
-            'landing_page_url': primary_location.get('landing_page_url'),
-            'pdf_url': primary_location.get('pdf_url'),
-            'is_oa': primary_location.get('is_oa'),
-            'version': primary_location.get('version'),
-            'license': primary_location.get('license'),
-        })
+        primary_locations_list.append(
+            extract['primary_locations'](primary_location, work_id, primary_location['source']['id']))
 
     # locations
-    if locations := work.get('locations'):
+    if 'locations' in keys and (locations := work.get('locations')):
+        extract_location = extract['locations']
         for location in locations:
             if location.get('source') and location.get('source').get('id'):
-                locations_list.append({
-                    'work_id': work_id,
-                    'source_id': location['source']['id'],
-                    'landing_page_url': location.get('landing_page_url'),
-                    'pdf_url': location.get('pdf_url'),
-                    'is_oa': location.get('is_oa'),
-                    'version': location.get('version'),
-                    'license': location.get('license'),
-                })
+                locations_list.append(extract_location(location, work_id, location['source']['id']))
 
     # best_oa_locations
-    if best_oa_location := (work.get('best_oa_location') or {}):
+    if 'best_oa_locations' in keys and (best_oa_location := (work.get('best_oa_location') or {})):
         if best_oa_location.get('source') and best_oa_location.get('source').get('id'):
-            best_oa_location_list.append({
-                'work_id': work_id,
-                'source_id': best_oa_location['source']['id'],
-                'landing_page_url': best_oa_location.get('landing_page_url'),
-                'pdf_url': best_oa_location.get('pdf_url'),
-                'is_oa': best_oa_location.get('is_oa'),
-                'version': best_oa_location.get('version'),
-                'license': best_oa_location.get('license'),
-            })
+            best_oa_location_list.append(
+                extract['best_oa_locations'](best_oa_location, work_id, best_oa_location['source']['id']))
 
     # authorships
-    if authorships := work.get('authorships'):
+    if 'authorships' in keys and (authorships := work.get('authorships')):
+        extract_authorship = extract['authorships']
         for authorship in authorships:
             if author_id := authorship.get('author', {}).get('id'):
                 institutions = authorship.get('institutions')
@@ -83,57 +89,37 @@ def process_work(work):
                 institution_ids = institution_ids or [None]
 
                 for institution_id in institution_ids:
-                    authorships_list.append({
-                        'work_id': work_id,
-                        'author_position': authorship.get('author_position'),
-                        'author_id': author_id,
-                        'institution_id': institution_id,
-                        'raw_affiliation_string': authorship.get('raw_affiliation_string'),
-                    })
+                    authorships_list.append(extract_authorship(authorship, work_id, author_id, institution_id))
     # biblio
-    if biblio := work.get('biblio'):
-        biblio['work_id'] = work_id
-        biblio_list.append(biblio)
-
-        # concepts
-    for concept in work.get('concepts'):
-        if concept_id := concept.get('id'):
-            concepts_list.append({
-                'work_id': work_id,
-                'concept_id': concept_id,
-                'score': concept.get('score'),
-            })
+    if 'biblio' in keys and (biblio := work.get('biblio')):
+        biblio_list.append(extract['biblio'](biblio, work_id))
+
+    # concepts
+    if 'concepts' in keys:
+        extract_concept = extract['concepts']
+        for concept in work.get('concepts'):
+            if concept_id := concept.get('id'):
+                concepts_list.append(extract_concept(concept, work_id, concept_id))
 
     # ids
-    if ids := work.get('ids'):
-        ids['work_id'] = work_id
-        ids_list.append(ids)
+    if 'ids' in keys and (ids := work.get('ids')):
+        ids_list.append(extract['ids'](ids, work_id))
 
     # mesh
-    for mesh in work.get('mesh'):
-        mesh['work_id'] = work_id
-        mesh_list.append(mesh)
+    if 'mesh' in keys:
+        extract_mesh = extract['mesh']
+        for mesh in work.get('mesh'):
+            mesh_list.append(extract_mesh(mesh, work_id))
 
     # open_access
-    if open_access := work.get('open_access'):
-        open_access['work_id'] = work_id
-        open_access_list.append(open_access)
-
-    # referenced_works
-    for referenced_work in work.get('referenced_works'):
-        if referenced_work:
-            referenced_works_list.append({
-                'work_id': work_id,
-                'referenced_work_id': referenced_work
-            })
-
-    # related_works
-    for related_work in work.get('related_works'):
-        if related_work:
-            related_works_list.append({
-                'work_id': work_id,
-                'related_work_id': related_work
-            })
+    if 'open_access' in keys and (open_access := work.get('open_access')):
+        open_access_list.append(extract['open_access'](open_access, work_id))
+
+    # referenced_works, related_works
+    referenced_works_list = [(work_id, referenced_work) for referenced_work in work.get('referenced_works')
+                             if referenced_work] if 'referenced_works' in keys else []
+    related_works_list = [(work_id, related_work) for related_work in work.get('related_works')
+                          if related_work] if 'related_works' in keys else []
 
     data = [("works", works_list),
             ("primary_locations", primary_locations_list),
@@ -148,153 +134,286 @@ def process_work(work):
             ("referenced_works", referenced_works_list),
             ("related_works", related_works_list)]
 
+    # abstracts
+    if abstracts and 'abstracts' in keys:
+        abstract = rebuild_abstract(work.get('abstract_inverted_index'))
+        data.append(("abstracts", [(work_id, abstract)] if abstract else []))
+
     return data
 
 
-def process_file(num, jsonl_file_name, save_dir):
-    csv_files = {
-        'works': {
-            'works': {
-                'name': os.path.join(save_dir, f'works_{num}.csv.gz'),
-                'columns': [
-                    'id', 'doi', 'title', 'display_name', 'publication_year', 'publication_date', 'type',
-                    'cited_by_count',
-                    'is_retracted', 'is_paratext', 'cited_by_api_url',
-                    # 'abstract_inverted_index' # we don't need abstract_inverted_index
-                ]
-            },
-            'primary_locations': {
-                'name': os.path.join(save_dir, f'works_primary_locations_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa', 'version', 'license'
-                ]
-            },
-            'locations': {
-                'name': os.path.join(save_dir, f'works_locations_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa', 'version', 'license'
-                ]
-            },
-            'best_oa_locations': {
-                'name': os.path.join(save_dir, f'works_best_oa_locations_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa', 'version', 'license'
-                ]
-            },
-            'authorships': {
-                'name': os.path.join(save_dir, f'works_authorships_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'author_position', 'author_id', 'institution_id', 'raw_affiliation_string'
-                ]
-            },
-            'biblio': {
-                'name': os.path.join(save_dir, f'works_biblio_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'volume', 'issue', 'first_page', 'last_page'
-                ]
-            },
-            'concepts': {
-                'name': os.path.join(save_dir, f'works_concepts_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'concept_id', 'score'
-                ]
-            },
-            'ids': {
-                'name': os.path.join(save_dir, f'works_ids_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'openalex', 'doi', 'mag', 'pmid', 'pmcid'
-                ]
-            },
-            'mesh': {
-                'name': os.path.join(save_dir, f'works_mesh_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'descriptor_ui', 'descriptor_name', 'qualifier_ui', 'qualifier_name', 'is_major_topic'
-                ]
-            },
-            'open_access': {
-                'name': os.path.join(save_dir, f'works_open_access_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'is_oa', 'oa_status', 'oa_url', 'any_repository_has_fulltext'
-                ]
-            },
-            'referenced_works': {
-                'name': os.path.join(save_dir, f'works_referenced_works_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'referenced_work_id'
-                ]
-            },
-            'related_works': {
-                'name': os.path.join(save_dir, f'works_related_works_{num}.csv.gz'),
-                'columns': [
-                    'work_id', 'related_work_id'
-                ]
-            },
-        },
-    }
-
-    file_spec = csv_files['works']
-
-    for tabel, desc in file_spec.items():
-        path = desc['name']
-        columns = desc['columns']
-        header_df = pd.DataFrame(columns=columns)
-        with gzip.open(path, 'wt', encoding='utf-8') as f:
-            header_df.to_csv(f, index=False)
-    data_caches = defaultdict(list)
-    buffer_size = 2000
-    with gzip.open(jsonl_file_name, 'r') as works_jsonl:
-        for num_of_i, work_json in tqdm.tqdm(enumerate(works_jsonl), desc=f"Processing {jsonl_file_name}"):
+def get_csv_files(num, save_dir, abstracts=False, tables=None):
+    return {'works': file_spec('works', save_dir, f'_{num}', optional=abstracts, tables=tables)}
+
+
+def process_file(num, jsonl_file_name, save_dir, show_progress=True, abstracts=False, fmt='csv',
+                 options=None, compact_ids=False, metrics=None, reader='inline', readahead=4,
+                 skip_lines=frozenset(), partitions=0, where=None, tables=None, outputs=None):
+    file_spec = get_csv_files(num, save_dir, abstracts, tables)['works']
+    keys = table_keys('works', tables)
+    # only the works matching every --where predicate, see WorkFilter
+    work_filter = WorkFilter(where) if where else None
+
+    works_count = 0
+    filtered = 0
+    bytes_read = 0
+    line_no = -1
+    clock = StageClock()
+    budget = memory_budget()
+    waited = budget.wait_seconds if budget is not None else 0.0
+    with TableWriters(file_spec, fmt, options, compact_ids, partitions, budget) as writers, \
+            open_jsonl(jsonl_file_name, reader, readahead) as works_jsonl:
+        for work_json in tqdm.tqdm(works_jsonl, desc=f"Processing {jsonl_file_name}", disable=not show_progress):
+            clock.lap('read')
+            bytes_read += len(work_json)
             if not work_json.strip():
                 continue
-            work = json.loads(work_json)
-            processed_data = process_work(work)
-            for key, values in processed_data:
-                data_caches[key] += values
-
-            if len(data_caches["works"]) >= buffer_size:
-                # start = time.time()
-                for key, values in data_caches.items():
-                    if len(values) == 0:
-                        continue
-                    save_path = file_spec[key]['name']
-                    df = pd.DataFrame(values)
-                    df.to_csv(save_path, mode='a', index=False, header=False, compression='gzip',
-                              columns=file_spec[key]['columns'])
-                data_caches = defaultdict(list)
-                # end = time.time()
-                # print(f"Saving used:{end - start}")
-    for key, values in data_caches.items():
-        if len(values) == 0:
-            continue
-        save_path = file_spec[key]['name']
-        df = pd.DataFrame(values)
-        df.to_csv(save_path, mode='at', index=False, header=False, compression='gzip',
-                  columns=file_spec[key]['columns'])
+            line_no += 1
+            if line_no in skip_lines:
+                # an older copy of a work updated in a later partition
+                continue
+            if work_filter is not None:
+                keep = work_filter.match_raw(work_json)
+                clock.lap('filter')
+                if not keep:
+                    filtered += 1
+                    continue
+            work = decode_work(work_json, with_abstract=abstracts)
+            clock.lap('decode')
+            if work_filter is not None and not work_filter.match(work):
+                filtered += 1
+                continue
+            works_count += 1
+            rows = process_work(work, abstracts, keys)
+            clock.lap('process')
+            for key, values in rows:
+                if values:
+                    writers.write(key, values)
+            clock.lap('encode')
+    if metrics is not None:
+        metrics.add_file('works', jsonl_file_name, works_count, bytes_read, clock, writers)
+        if budget is not None:
+            metrics.add('memory_wait_seconds', budget.wait_seconds - waited, entity='works')
+        if work_filter is not None:
+            metrics.add('records_filtered', filtered, entity='works')
+    if outputs is not None:
+        outputs.update(writers.file_stats())
+    return works_count
 
 
-if __name__ == '__main__':
-    MAX_CONCURRENT_THREADS = 16  # For example, limit to 4 concurrent threads
+def process_file_metered(*args, **kwargs):
+    """Run process_file in a worker, returns ``(works_count, metrics values, output files)`` for the parent."""
+    metrics = Metrics()
+    outputs = {}
+    works_count = process_file(*args, metrics=metrics, outputs=outputs, **kwargs)
+    return works_count, metrics.values, outputs
+
 
-    # Create a semaphore to control the number of concurrent threads
-    thread_semaphore = threading.Semaphore(MAX_CONCURRENT_THREADS)
+def run_pool(all_files, save_dir, workers, executor='process', abstracts=False, fmt='csv', options=None,
+             compact_ids=False, metrics=None, dump=None, reader='inline', readahead=4, dedup=True, dedup_dir=None,
+             partitions=0, memory_budget_bytes=None, where=None, tables=None, shard=None, outputs=None,
+             dedup_plan=None):
+    """Flatten every file in ``all_files`` on a pool of ``workers``.
 
+    Each task owns one input file and writes its own ``*_{num}.csv.gz`` shards,
+    so workers never share an output file. ``all_files`` are sorted oldest
+    partition first, and unless ``dedup`` is off only the newest copy of a
+    work is flattened (see ``plan_latest``, its id index lives in
+    ``dedup_dir``). With ``partitions`` the hash partitioned tables get one
+    shard per leaf table. ``memory_budget_bytes`` bounds the rows buffered
+    by all the workers together (see ``MemoryBudget``). With ``where`` only
+    the works matching those predicates are flattened (see ``WorkFilter``),
+    with ``tables`` only those tables are computed and written (see
+    ``select_tables``). The parent only collects progress,
+    errors and the metrics of every task into ``metrics``, written out by
+    ``dump`` as they come. Returns the list of ``(jsonl_file_name, exception)``
+    failures.
+
+    With ``shard``, ``(i, N)``, only the files ``shard_of`` assigns to shard
+    ``i`` are flattened, their shards named after the input file
+    (``works_ids_20230517003.csv.gz``) so the nodes never write the same
+    name. ``all_files`` is still the whole snapshot listing. The output files
+    of every flattened input are collected into ``outputs``.
+
+    ``dedup_plan``, made once for the whole snapshot by ``write_dedup_plan``,
+    gives the lines to skip without any id scan. Without it a shard scans
+    the ids of every file from its oldest one on, which with hashed shards
+    is about the whole snapshot on every node.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    pool_cls = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+    failures = []
+    total_works = 0
+    if executor == 'process':
+        pool = pool_cls(max_workers=workers, initializer=init_memory_budget,
+                        initargs=(memory_budget_bytes, multiprocessing.Value('q', 0)))
+    else:
+        init_memory_budget(memory_budget_bytes)
+        pool = pool_cls(max_workers=workers)
+    if shard is None:
+        assigned = {i: i for i in range(len(all_files))}
+    else:
+        assigned = {i: input_number(jsonl_file_name) for i, jsonl_file_name in enumerate(all_files)
+                    if shard_of(jsonl_file_name, shard[1]) == shard[0]}
+        if len(set(assigned.values())) < len(assigned):
+            raise ValueError("input files with the same number, they would write the same output files")
+    # the files older than the first one of the shard don't change what it skips
+    first = min(assigned, default=len(all_files))
+    with pool:
+        if dedup_plan is not None:
+            skip_lines = [frozenset()] * len(all_files)
+            for i, lines in zip(assigned, planned_skip_lines(dedup_plan, [all_files[i] for i in assigned])):
+                skip_lines[i] = lines
+        elif dedup:
+            skip_lines = [frozenset()] * first + plan_latest(pool, all_files[first:], dedup_dir)
+        else:
+            skip_lines = [frozenset()] * len(all_files)
+        futures = {
+            pool.submit(process_file_metered, num, all_files[i], save_dir, False, abstracts, fmt, options,
+                        compact_ids, reader=reader, readahead=readahead, skip_lines=skip_lines[i],
+                        partitions=partitions, where=where, tables=tables): all_files[i]
+            for i, num in assigned.items()
+        }
+        with tqdm.tqdm(total=len(futures), desc="Flattening works", unit="file") as progress:
+            for future in as_completed(futures):
+                jsonl_file_name = futures[future]
+                try:
+                    works_count, values, files = future.result()
+                except Exception as e:
+                    print(f"Failed to process {jsonl_file_name}: {e!r}")
+                    failures.append((jsonl_file_name, e))
+                else:
+                    total_works += works_count
+                    metrics.merge(values)
+                    if outputs is not None:
+                        outputs[jsonl_file_name] = files
+                    if dump is not None:
+                        dump.maybe_write(metrics)
+                progress.update(1)
+                progress.set_postfix(works=total_works, failed=len(failures))
+    return failures
+
+
+if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="flatten-openalex-works-to-csv")
     parser.add_argument("--snapshot_dir", type=str, default="./data/openalex/openalex-snapshot",
                         help="snapshot_dir")
     parser.add_argument("--csv_dir", type=str, default="./data/openalex/csv-files",
                         help="csv_dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of concurrent workers, defaults to the number of CPUs")
+    parser.add_argument("--executor", type=str, choices=['process', 'thread'], default='process',
+                        help="run workers as processes (scales with cores) or threads (GIL-bound)")
+    parser.add_argument("--abstracts", action="store_true",
+                        help="also rebuild the plain text abstracts into works_abstracts_<n>.csv.gz")
+    parser.add_argument("--format", type=str, choices=list(FORMATS), default='csv',
+                        help="csv files, PostgreSQL binary COPY files (.pgcopy.gz) or parquet files, "
+                             "the last two typed after the schema")
+    parser.add_argument("--row_group_size", type=int, default=100000,
+                        help="rows per parquet row group")
+    parser.add_argument("--parquet_compression", type=str, default='zstd',
+                        choices=['zstd', 'snappy', 'gzip', 'lz4', 'brotli', 'none'],
+                        help="parquet compression codec")
+    parser.add_argument("--codec", type=str, choices=list(CODECS), default='gzip',
+                        help="compression of the csv and binary files, zstd and lz4 need their python package")
+    parser.add_argument("--level", type=int, default=None,
+                        help="compression level of --codec, defaults to 6 for gzip, 3 for zstd and 0 for lz4")
+    parser.add_argument("--compress_offload", type=str, choices=['thread', 'process'], default=None,
+                        help="compress on a thread of each worker, or in an external pigz/gzip/zstd/lz4 process "
+                             "per file, instead of inline")
+    parser.add_argument("--compact_ids", action="store_true",
+                        help="write the OpenAlex ids as bigint numbers, load them into a schema altered with "
+                             "openalex-pg-schema-compact-ids.sql")
+    parser.add_argument("--reader", type=str, choices=READERS, default='inline',
+                        help="inflate the input inline, ahead on a thread, or in an external pigz/gzip process")
+    parser.add_argument("--readahead", type=int, default=4,
+                        help="blocks of 4MB of inflated lines the thread/process reader keeps ready")
+    parser.add_argument("--no_dedup", action="store_true",
+                        help="keep every copy of a work instead of the one of the newest updated_date partition, "
+                             "the primary keys of openalex-pg-indexes.sql then fail to build")
+    parser.add_argument("--dedup_dir", type=str, default=None,
+                        help="directory of the id bitmap of the deduplication, the temporary directory by default")
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="split the works child tables of openalex-pg-schema-partitioned.sql into one shard "
+                             "per hash partition of work_id (works_authorships_p<r>_<n>.csv.gz), give the number "
+                             "of partitions of the schema, 16")
+    parser.add_argument("--memory_budget_mb", type=float, default=None,
+                        help="bound the rows buffered by all the workers together (the parquet row groups), in MB, "
+                             "a worker flushes its largest buffers or waits when they go over it")
+    parser.add_argument("--where", type=str, action='append', default=None,
+                        help="only flatten the works matching this predicate, repeat it for several: a top level "
+                             "field compared with = != > >= < <= (publication_year>=2015, type=article,review) or "
+                             "concept_id/author_id/institution_id/source_id/referenced_work_id = or != a list of ids")
+    parser.add_argument("--tables", type=str, nargs='+', default=None,
+                        help="only compute and write these tables, names or patterns of the openalex tables "
+                             "(works works_authorships 'works_*'), all of them by default")
+    parser.add_argument("--exclude_tables", type=str, nargs='+', default=None,
+                        help="don't compute nor write these tables, e.g. works_related_works '*_counts_by_year'")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="i/N, only flatten the files of shard i (0 <= i < N) of the snapshot, to spread it over "
+                             "N nodes; output files are named after their input file and the files flattened are "
+                             "listed in a manifest for merge_shard_manifests.py")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="manifest file of --shard, <csv_dir>/manifest_works_<i>_of_<N>.json by default")
+    parser.add_argument("--dedup_plan", type=str, default=None,
+                        help="read the lines to skip from this plan instead of scanning the ids of the snapshot. "
+                             "Without it every --shard scans the ids of about the whole snapshot, make the plan "
+                             "once with --plan_only and give it to every shard")
+    parser.add_argument("--plan_only", action="store_true",
+                        help="only scan the ids of the whole snapshot, write the newest copy plan to --dedup_plan "
+                             "and exit")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="keep the per stage and per table metrics in this file, prometheus text if it "
+                             "ends with .prom (node_exporter textfile collector), json otherwise")
+    parser.add_argument("--metrics_interval", type=float, default=30,
+                        help="seconds between two writes of --metrics_file")
     args = parser.parse_args()
+    try:
+        WorkFilter(args.where or [])
+        tables = select_tables(args.tables, args.exclude_tables)
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+    if not table_keys('works', tables):
+        parser.error("none of the works tables is selected")
+    if args.plan_only and not args.dedup_plan:
+        parser.error("--plan_only needs --dedup_plan")
+    if args.dedup_plan and args.no_dedup:
+        parser.error("--dedup_plan and --no_dedup exclude each other")
+    if args.no_dedup:
+        print(NO_DEDUP_WARNING)
 
     SNAPSHOT_DIR = args.snapshot_dir
     CSV_DIR = args.csv_dir
-    threads = []
+    if args.format == 'parquet':
+        options = {'row_group_size': args.row_group_size, 'compression': args.parquet_compression}
+    else:
+        options = {'codec': args.codec, 'level': args.level, 'offload': args.compress_offload}
     all_files = sorted(glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'works', '*', '*.gz')))
-    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_THREADS) as executor:
-        for i, jsonl_file_name in tqdm.tqdm(
-                enumerate(all_files)):
-            thread = executor.submit(process_file, i, jsonl_file_name, CSV_DIR)
-            threads.append(thread)
-
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.result()
+    if args.plan_only:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            skip_lines = plan_latest(pool, all_files, args.dedup_dir)
+        write_dedup_plan(args.dedup_plan, all_files, skip_lines)
+        print(f"dedup plan of {len(all_files)} files, {sum(map(len, skip_lines))} older copies to skip, "
+              f"written to {args.dedup_plan}")
+        raise SystemExit(0)
+    metrics = Metrics()
+    dump = MetricsDump(args.metrics_file, args.metrics_interval) if args.metrics_file else None
+    outputs = {}
+    failures = run_pool(all_files, CSV_DIR, args.workers, args.executor, args.abstracts, args.format,
+                        options, args.compact_ids, metrics, dump, args.reader, args.readahead,
+                        not args.no_dedup, args.dedup_dir, args.partitions,
+                        int(args.memory_budget_mb * 1024 * 1024) if args.memory_budget_mb else None, args.where,
+                        tables, shard, outputs, read_dedup_plan(args.dedup_plan) if args.dedup_plan else None)
+    print(metrics.summary())
+    if shard is not None:
+        manifest = args.manifest or os.path.join(CSV_DIR, f'manifest_works_{shard[0]}_of_{shard[1]}.json')
+        write_shard_manifest(manifest, 'works', shard, all_files, outputs, failures)
+        print(f"shard {shard[0]}/{shard[1]}: {len(outputs)} files flattened, manifest {manifest}")
+    if dump is not None:
+        dump.write(metrics)
+    if failures:
+        print(f"{len(failures)} of {len(outputs) + len(failures)} files failed:")
+        for jsonl_file_name, _ in failures:
+            print(f"  {jsonl_file_name}")
+        raise SystemExit(1)
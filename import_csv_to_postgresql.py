@@ -12,85 +12,558 @@
 """
 import tqdm
 import psycopg2
-from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 
 import argparse
 import glob
+import json
 import os
 import re
-import gzip
-
-sql_map = {
-    "authors": "Copy openalex.authors (id, orcid, display_name, display_name_alternatives, works_count, cited_by_count, last_known_institution, works_api_url, updated_date) from stdin WITH CSV HEADER DELIMITER as ','",
-    "authors_ids": "Copy openalex.authors_ids (author_id, openalex, orcid, scopus, twitter, wikipedia, mag) from stdin WITH CSV HEADER DELIMITER as ','",
-    "authors_counts_by_year": "Copy openalex.authors_counts_by_year (author_id, year, works_count, cited_by_count,oa_works_count) from stdin WITH CSV HEADER DELIMITER as ','",
-    "concepts": "Copy openalex.concepts (id, wikidata, display_name, level, description, works_count, cited_by_count, image_url, image_thumbnail_url, works_api_url, updated_date) from stdin WITH CSV HEADER DELIMITER as ','",
-    "concepts_ancestors": "Copy openalex.concepts_ancestors (concept_id, ancestor_id) from stdin WITH CSV HEADER DELIMITER as ','",
-    "concepts_counts_by_year": "Copy openalex.concepts_counts_by_year (concept_id, year, works_count, cited_by_count, oa_works_count) from stdin WITH CSV HEADER DELIMITER as ','",
-    "concepts_ids": "Copy openalex.concepts_ids (concept_id, openalex, wikidata, wikipedia, umls_aui, umls_cui, mag) from stdin WITH CSV HEADER DELIMITER as ','",
-    "concepts_related_concepts": "Copy openalex.concepts_related_concepts (concept_id, related_concept_id, score) from stdin WITH CSV HEADER DELIMITER as ','",
-    "institutions": "Copy openalex.institutions (id, ror, display_name, country_code, type, homepage_url, image_url, image_thumbnail_url, display_name_acroynyms, display_name_alternatives, works_count, cited_by_count, works_api_url, updated_date) from stdin WITH CSV HEADER DELIMITER as ','",
-    "institutions_ids": "Copy openalex.institutions_ids (institution_id, openalex, ror, grid, wikipedia, wikidata, mag) from stdin WITH CSV HEADER DELIMITER as ','",
-    "institutions_geo": "Copy openalex.institutions_geo (institution_id, city, geonames_city_id, region, country_code, country, latitude, longitude) from stdin WITH CSV HEADER DELIMITER as ','",
-    "institutions_associated_institutions": "Copy openalex.institutions_associated_institutions (institution_id, associated_institution_id, relationship) from stdin WITH CSV HEADER DELIMITER as ','",
-    "institutions_counts_by_year": "Copy openalex.institutions_counts_by_year (institution_id, year, works_count, cited_by_count, oa_works_count) from stdin WITH CSV HEADER DELIMITER as ','",
-    "publishers": "Copy openalex.publishers (id, display_name, alternate_titles, country_codes, hierarchy_level, parent_publisher, works_count, cited_by_count, sources_api_url, updated_date) from stdin WITH CSV HEADER DELIMITER as ','",
-    "publishers_ids": "Copy openalex.publishers_ids (publisher_id, openalex, ror, wikidata) from stdin WITH CSV HEADER DELIMITER as ','",
-    "publishers_counts_by_year": "Copy openalex.publishers_counts_by_year (publisher_id, year, works_count, cited_by_count, oa_works_count) from stdin WITH CSV HEADER DELIMITER as ','",
-    "sources": "Copy openalex.sources (id, issn_l, issn, display_name, publisher, works_count, cited_by_count, is_oa, is_in_doaj, homepage_url, works_api_url, updated_date) from stdin WITH CSV HEADER DELIMITER as ','",
-    "sources_ids": "Copy openalex.sources_ids (source_id, openalex, issn_l, issn, mag, wikidata, fatcat) from stdin WITH CSV HEADER DELIMITER as ','",
-    "sources_counts_by_year": "Copy openalex.sources_counts_by_year (source_id, year, works_count, cited_by_count,oa_works_count) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works": "Copy openalex.works (id, doi, title, display_name, publication_year, publication_date, type, cited_by_count, is_retracted, is_paratext, cited_by_api_url) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_primary_locations": "Copy openalex.works_primary_locations (work_id, source_id, landing_page_url, pdf_url, is_oa, version, license) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_locations": "Copy openalex.works_locations (work_id, source_id, landing_page_url, pdf_url, is_oa, version, license) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_best_oa_locations": "Copy openalex.works_best_oa_locations (work_id, source_id, landing_page_url, pdf_url, is_oa, version, license) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_authorships": "Copy openalex.works_authorships (work_id, author_position, author_id, institution_id, raw_affiliation_string) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_biblio": "Copy openalex.works_biblio (work_id, volume, issue, first_page, last_page) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_concepts": "Copy openalex.works_concepts (work_id, concept_id, score) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_ids": "Copy openalex.works_ids (work_id, openalex, doi, mag, pmid, pmcid) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_mesh": "Copy openalex.works_mesh (work_id, descriptor_ui, descriptor_name, qualifier_ui, qualifier_name, is_major_topic) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_open_access": "Copy openalex.works_open_access (work_id, is_oa, oa_status, oa_url, any_repository_has_fulltext) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_referenced_works": "Copy openalex.works_referenced_works (work_id, referenced_work_id) from stdin WITH CSV HEADER DELIMITER as ','",
-    "works_related_works": "Copy openalex.works_related_works (work_id, related_work_id) from stdin WITH CSV HEADER DELIMITER as ','",
+import io
+import hashlib
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from openalex_io import (PARTITIONED_TABLES, file_codec, file_format, open_decompressed, partition_parent,
+                         split_extension, table_key)
+from openalex_tables import copy_statements, select_tables
+
+# output formats of the flatten scripts that COPY can load, parquet files are skipped
+COPY_FORMATS = ['csv', 'binary']
+
+# the csv COPY statement of every table, generated from the table registry
+sql_map = copy_statements()
+
+# change your db connexion config
+DB_CONFIG = {
+    "database": "postgres",
+    "user": "postgres",
+    "password": "PASSWORD",
+    "host": "127.0.0.1",
+    "port": "45432",
 }
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="import_csv_to_postgresql")
-    parser.add_argument("--csv_dir", type=str, default="./data/openalex/csv-files",
-                        help="csv_dir")
-    args = parser.parse_args()
+# one row per imported file, written in the same transaction as its COPY so a
+# committed row always means the file's data is in the db
+MANIFEST_DDL = """
+CREATE TABLE IF NOT EXISTS openalex.load_manifest (
+    file_name text PRIMARY KEY,
+    path text,
+    size bigint,
+    checksum text,
+    rows bigint,
+    status text NOT NULL,
+    error text,
+    updated_at timestamp without time zone DEFAULT now()
+)
+"""
 
-    # change your db connexion config
-    conn = psycopg2.connect(
-        database="postgres",
-        user="postgres",
-        password="PASSWORD",
-        host="127.0.0.1",
-        port="45432")
+MANIFEST_UPSERT = """
+INSERT INTO openalex.load_manifest AS m (file_name, path, size, checksum, rows, status, error, updated_at)
+VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+ON CONFLICT (file_name) DO UPDATE
+SET path = EXCLUDED.path, size = EXCLUDED.size, checksum = EXCLUDED.checksum, rows = EXCLUDED.rows,
+    status = EXCLUDED.status, error = EXCLUDED.error, updated_at = EXCLUDED.updated_at
+WHERE m.status <> 'committed'
+"""
 
-    csv_dir = args.csv_dir
-    files = sorted(glob.glob(os.path.join(csv_dir, '*.gz')))
-    for fp in tqdm.tqdm(files):
-        _, filename = os.path.split(fp)
-        key = filename.replace(".csv.gz", "")
-        key = re.sub('_\d*$', "", key)
-        # 解析文件名
-        # 创建一个游标对象
-        cur = conn.cursor()
-        sql = sql_map.get(key, "")
-        # if 'works_open_access' not in sql: # use this for import specific table
-        #     continue
-        sql = sql.format(file_path=fp)
-        # 定义 COPY 命令的 SQL 查询
-        print(sql)
+
+class HashingReader(io.RawIOBase):
+    """File wrapper that checksums the bytes as they are read, so no extra pass is needed."""
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.hash = hashlib.md5()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        self.hash.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+# session settings of the COPY connections with --bulk_load. An asynchronous
+# commit can only lose the last files on a server crash, together with their
+# manifest rows
+BULK_LOAD_SETTINGS = {
+    'synchronous_commit': 'off',
+    'statement_timeout': '0',
+}
+
+INDEXES_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openalex-pg-indexes.sql')
+
+
+def ensure_manifest(conn):
+    with conn.cursor() as cur:
+        cur.execute(MANIFEST_DDL)
+    conn.commit()
+
+
+def pending_files(conn, files):
+    """Drop the files the manifest already marks as committed.
+
+    A committed file whose size changed since is reported and still skipped,
+    importing it again would duplicate its rows.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT file_name, size FROM openalex.load_manifest WHERE status = 'committed'")
+        committed = dict(cur.fetchall())
+    pending = []
+    for fp in files:
+        file_name = os.path.basename(fp)
+        if file_name not in committed:
+            pending.append(fp)
+        elif committed[file_name] != os.path.getsize(fp):
+            print(f"{fp} changed since it was imported, skipped (delete its rows and manifest entry to reload)")
+    return pending
+
+
+def record_failure(conn, fp, e):
+    with conn.cursor() as cur:
+        cur.execute(MANIFEST_UPSERT, (os.path.basename(fp), os.path.abspath(fp), os.path.getsize(fp), None, None,
+                                      'failed', repr(e)))
+    conn.commit()
+
+
+def plan_files(plan_path, csv_dir):
+    """Return the files of a load plan of merge_shard_manifests.py found in ``csv_dir``, and the problems.
+
+    A file of the plan that is missing, or whose size differs from the one
+    the flatten wrote (a copy between nodes that didn't finish), is reported.
+    """
+    with open(plan_path, encoding='utf-8') as f:
+        plan = json.load(f)
+    files, problems = [], []
+    for desc in plan['files']:
+        fp = os.path.join(csv_dir, desc['path'])
+        if not os.path.exists(fp):
+            problems.append(f"{fp} is missing")
+        elif os.path.getsize(fp) != desc['bytes']:
+            problems.append(f"{fp} has {os.path.getsize(fp)} bytes instead of {desc['bytes']}")
+        elif is_copy_file(fp):
+            files.append(fp)
+    return sorted(files), problems
+
+
+def is_copy_file(fp):
+    """Whether ``fp`` is a flattened file COPY can load, in any codec."""
+    try:
+        return split_extension(fp)[1] in COPY_FORMATS
+    except ValueError:
+        return False
+
+
+def copy_statement(key, fmt='csv', freeze=False):
+    """Return the ``sql_map`` COPY statement of a table for the given file format.
+
+    ``freeze`` writes the rows already frozen, only allowed in the transaction
+    that created or truncated the table.
+
+    The shards of a hash partition (``works_authorships_p3``) are copied
+    straight into that leaf table.
+    """
+    if key not in sql_map and (parent := partition_parent(key)):
+        copy_sql = sql_map[parent].replace(f"openalex.{parent} ", f"openalex.{key} ", 1)
+    else:
+        copy_sql = sql_map.get(key, "")
+    if copy_sql and fmt == 'binary':
+        copy_sql = copy_sql.replace("WITH CSV HEADER DELIMITER as ','", "WITH (FORMAT binary)")
+    if copy_sql and freeze:
+        copy_sql = copy_sql.replace("WITH CSV HEADER DELIMITER as ','", "WITH (FORMAT csv, HEADER true)")
+        copy_sql = copy_sql[:-1] + ", FREEZE true)"
+    return copy_sql
+
+
+def import_file(conn, fp, manifest=True, freeze=False, commit=True):
+    """COPY one flattened file in its own transaction, returns the number of rows loaded.
+
+    The COPY format (csv or binary) and the codec to decompress (gzip, zstd,
+    lz4 or none) follow the file extension. With
+    ``manifest`` the file is marked committed in ``openalex.load_manifest``
+    inside the same transaction. Without ``commit`` the transaction is left
+    open for more files.
+    """
+    fmt = file_format(fp)
+    copy_sql = copy_statement(table_key(fp), fmt, freeze)
+    with conn.cursor() as cur:
+        with open(fp, 'rb') as raw:
+            hashed = HashingReader(raw)
+            with open_decompressed(hashed, file_codec(fp)) as f:
+                if fmt == 'csv':
+                    f = io.TextIOWrapper(f, encoding='utf-8')
+                cur.copy_expert(sql=copy_sql, file=f)
+            rows = cur.rowcount
+        if manifest:
+            cur.execute(MANIFEST_UPSERT, (os.path.basename(fp), os.path.abspath(fp), os.path.getsize(fp),
+                                          hashed.hexdigest(), rows, 'committed', None))
+    if commit:
+        conn.commit()
+    return rows
+
+
+def import_table(conn, table, files, manifest=True):
+    """COPY all the ``files`` of the empty ``table`` in one transaction, returns the number of rows loaded.
+
+    The transaction starts by truncating the table, which gives it a new
+    relation file: the rows are written frozen, and with ``wal_level =
+    minimal`` the COPY skips the WAL, the file is synced at commit instead.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"TRUNCATE openalex.{table}")
+    rows = sum(import_file(conn, fp, manifest, freeze=True, commit=False) for fp in files)
+    conn.commit()
+    return rows
+
+
+def import_files(files, workers, manifest=True, bulk_tables=(), bulk_load=False):
+    """COPY ``files`` over a pool of ``workers`` connections.
+
+    Files are scheduled largest first, so the shards of big tables such as
+    works_referenced_works and works_authorships are spread over all the
+    connections instead of queuing behind each other. The files of
+    ``bulk_tables`` are loaded table by table with ``import_table`` instead,
+    and with ``bulk_load`` the connections use ``BULK_LOAD_SETTINGS``.
+    Returns the per-worker stats and the list of ``(fp, error)`` failures.
+    """
+    pool = ThreadedConnectionPool(1, workers, **DB_CONFIG)
+    stats = defaultdict(lambda: {'files': 0, 'rows': 0, 'seconds': 0.0})
+    failures = []
+    lock = threading.Lock()
+
+    def run(task):
+        table, task_files = task
+        conn = pool.getconn()
+        start = time.time()
+        rows = 0
         try:
-            with gzip.open(fp, 'rt') as f:
-                cur.copy_expert(sql=sql, file=f)
-            conn.commit()
+            if bulk_load:
+                with conn.cursor() as cur:
+                    for name, value in BULK_LOAD_SETTINGS.items():
+                        cur.execute("SELECT set_config(%s, %s, false)", (name, value))
+            if table is None:
+                rows = import_file(conn, task_files[0], manifest)
+            else:
+                rows = import_table(conn, table, task_files, manifest)
         except Exception as e:
-            print("发生异常：", e)
+            print("发生异常：", table or task_files[0], e)
             # 执行回滚操作，确保事务状态不会被标记为 "aborted"
             conn.rollback()
+            for fp in task_files:
+                if manifest:
+                    record_failure(conn, fp, e)
+                with lock:
+                    failures.append((fp, e))
+        finally:
+            pool.putconn(conn)
+        with lock:
+            worker_stats = stats[threading.current_thread().name]
+            worker_stats['files'] += len(task_files)
+            worker_stats['rows'] += rows
+            worker_stats['seconds'] += time.time() - start
+
+    table_files = defaultdict(list)
+    tasks = []
+    for fp in files:
+        if table_key(fp) in bulk_tables:
+            table_files[table_key(fp)].append(fp)
+        else:
+            tasks.append((None, [fp]))
+    tasks.extend(table_files.items())
+    ordered = sorted(tasks, key=lambda task: sum(map(os.path.getsize, task[1])), reverse=True)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import') as executor:
+            for _ in tqdm.tqdm(executor.map(run, ordered), total=len(ordered)):
+                pass
+    finally:
+        pool.closeall()
+    return stats, failures
+
+
+def plan_bulk_load(conn, files, workers=1):
+    """The target tables of ``files`` that ``import_table`` can load, the empty plain tables.
+
+    A table loaded by ``import_table`` takes one connection for all its
+    files, so only the tables holding at most a ``workers``-th of the bytes
+    to load are, the leaf tables of a hash partitioned table each count on
+    their own. The bigger ones (an unpartitioned works_referenced_works)
+    would hold up the whole load on one connection, they are loaded file by
+    file over all the connections like the tables that already hold rows
+    and partitioned parents.
+    """
+    table_bytes = defaultdict(int)
+    for fp in files:
+        table_bytes[table_key(fp)] += os.path.getsize(fp)
+    max_bytes = sum(table_bytes.values()) / workers
+    keys = set(table_bytes)
+    with conn.cursor() as cur:
+        cur.execute("SHOW wal_level")
+        if cur.fetchone()[0] != 'minimal':
+            print("wal_level is not minimal, the COPY still writes the WAL, "
+                  "see postgresql-single/custom-conf/bulk-load.conf.example")
+        cur.execute("""
+            SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'openalex' AND c.relkind = 'r' AND c.relname = ANY(%s)
+        """, (sorted(keys),))
+        tables = []
+        for (table,) in cur.fetchall():
+            cur.execute(f"SELECT EXISTS (SELECT FROM openalex.{table})")
+            if cur.fetchone()[0]:
+                continue
+            if table_bytes[table] > max_bytes:
+                hint = ", partition it with openalex-pg-schema-partitioned.sql" if table in PARTITIONED_TABLES else ""
+                print(f"{table} is too big to load on one of the {workers} connections, loaded file by file{hint}")
+                continue
+            tables.append(table)
+    conn.commit()
+    return set(tables)
+
+
+def analyze_tables(tables, workers):
+    """ANALYZE ``tables`` on ``workers`` connections, the parent of a leaf table instead of the leaf.
+
+    ANALYZE of a partitioned table also samples its leaves.
+    """
+    analyzed = sorted({partition_parent(table) or table for table in tables})
+    pool = ThreadedConnectionPool(1, workers, **DB_CONFIG)
+
+    def run(table):
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"ANALYZE openalex.{table}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"ANALYZE {table} failed: {e}")
+        finally:
+            pool.putconn(conn)
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analyze') as executor:
+            list(executor.map(run, analyzed))
+    finally:
+        pool.closeall()
+    print(f"analyzed {len(analyzed)} tables in {time.time() - start:.1f}s")
+
+
+def load_index_statements(path=INDEXES_SQL):
+    """Parse openalex-pg-indexes.sql into ``[(name, table, create_sql, drop_sql)]``."""
+    with open(path, encoding='utf-8') as f:
+        text = '\n'.join(line for line in f.read().split('\n') if not line.startswith('--'))
+    indexes = []
+    for statement in text.split(';'):
+        statement = ' '.join(statement.split())
+        if m := re.match(r'CREATE INDEX IF NOT EXISTS (\w+) ON openalex\.(\w+)', statement):
+            name, table = m.groups()
+            drop_sql = f"DROP INDEX IF EXISTS openalex.{name}"
+        elif m := re.match(r'ALTER TABLE ONLY openalex\.(\w+) ADD CONSTRAINT (\w+)', statement):
+            table, name = m.groups()
+            drop_sql = f"ALTER TABLE openalex.{table} DROP CONSTRAINT IF EXISTS {name}"
+        else:
+            continue
+        indexes.append((name, table, statement, drop_sql))
+    return indexes
+
+
+def expand_partitioned_indexes(conn, indexes):
+    """Split the indexes of hash partitioned tables into one index per leaf table.
+
+    Every leaf gets its own ``CREATE INDEX``, ``works_locations_work_id_idx``
+    becomes ``works_locations_p3_work_id_idx`` on ``works_locations_p3``, so
+    the leaves are built concurrently and a failed build only costs its
+    leaf. The parent index is then created ``ON ONLY`` the parent with the
+    leaf indexes attached, which is only catalog work.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT parent.relname, child.relname FROM pg_inherits i
+            JOIN pg_class parent ON parent.oid = i.inhparent JOIN pg_class child ON child.oid = i.inhrelid
+            JOIN pg_namespace n ON n.oid = parent.relnamespace
+            WHERE n.nspname = 'openalex' AND parent.relkind = 'p'
+        """)
+        leaves = defaultdict(list)
+        for parent, leaf in cur.fetchall():
+            leaves[parent].append(leaf)
+
+    expanded = []
+    for name, table, create_sql, drop_sql in indexes:
+        if table not in leaves or not create_sql.startswith('CREATE INDEX'):
+            expanded.append((name, table, create_sql, drop_sql))
             continue
-        cur.close()
+        # the parent comes first, dropping it drops the attached leaf indexes
+        attach_sql = [create_sql.replace(f" ON openalex.{table} ", f" ON ONLY openalex.{table} ", 1)]
+        leaf_indexes = []
+        for leaf in sorted(leaves[table]):
+            leaf_name = name.replace(table, leaf, 1) if name.startswith(table) else f"{leaf}_{name}"
+            leaf_sql = create_sql.replace(f" {name} ON openalex.{table} ", f" {leaf_name} ON openalex.{leaf} ", 1)
+            leaf_indexes.append((leaf_name, leaf, leaf_sql, f"DROP INDEX IF EXISTS openalex.{leaf_name}"))
+            attach_sql.append(f"ALTER INDEX openalex.{name} ATTACH PARTITION openalex.{leaf_name}")
+        expanded.append((name, table, '; '.join(attach_sql), drop_sql))
+        expanded.extend(leaf_indexes)
+    return expanded
+
+
+def drop_indexes(conn, indexes):
+    with conn.cursor() as cur:
+        for _, _, _, drop_sql in indexes:
+            cur.execute(drop_sql)
+    conn.commit()
+
+
+def build_indexes(indexes, workers, maintenance_work_mem, parallel_maintenance_workers):
+    """Build ``indexes`` over ``workers`` connections and report the time of each.
+
+    Indexes that already exist are skipped, the others are built biggest table
+    first. The indexes of partitioned tables (see ``expand_partitioned_indexes``)
+    are attached once all the leaf indexes are built. Returns the list of
+    ``(name, error)`` failures.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    with conn.cursor() as cur:
+        pending = []
+        for index in indexes:
+            cur.execute("SELECT to_regclass(%s)", (f"openalex.{index[0]}",))
+            if cur.fetchone()[0] is None:
+                pending.append(index)
+        cur.execute("""
+            SELECT c.relname, pg_total_relation_size(c.oid) FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'openalex' AND c.relkind = 'r'
+        """)
+        sizes = dict(cur.fetchall())
     conn.close()
+    pending.sort(key=lambda index: sizes.get(index[1], 0), reverse=True)
+
+    pool = ThreadedConnectionPool(1, workers, **DB_CONFIG)
+    failures = []
+    lock = threading.Lock()
+
+    def run(index):
+        name, table, create_sql, _ = index
+        conn = pool.getconn()
+        start = time.time()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET maintenance_work_mem = %s", (maintenance_work_mem,))
+                cur.execute("SET max_parallel_maintenance_workers = %s", (parallel_maintenance_workers,))
+                cur.execute(create_sql)
+            conn.commit()
+            print(f"{name} on {table}: {time.time() - start:.1f}s")
+        except Exception as e:
+            conn.rollback()
+            print(f"{name} on {table} failed after {time.time() - start:.1f}s: {e}")
+            with lock:
+                failures.append((name, e))
+        finally:
+            pool.putconn(conn)
+
+    attach = [index for index in pending if ' ON ONLY ' in index[2]]
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='index') as executor:
+            list(executor.map(run, [index for index in pending if index not in attach]))
+            list(executor.map(run, attach))
+    finally:
+        pool.closeall()
+    return failures
+
+
+def print_stats(stats, elapsed):
+    total_rows = 0
+    for worker, worker_stats in sorted(stats.items()):
+        total_rows += worker_stats['rows']
+        rate = worker_stats['rows'] / worker_stats['seconds'] if worker_stats['seconds'] else 0
+        print(f"{worker}: {worker_stats['files']} files, {worker_stats['rows']} rows, {rate:,.0f} rows/s")
+    rate = total_rows / elapsed if elapsed else 0
+    print(f"total: {total_rows} rows in {elapsed:.1f}s, {rate:,.0f} rows/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="import_csv_to_postgresql")
+    parser.add_argument("--csv_dir", type=str, default="./data/openalex/csv-files",
+                        help="csv_dir")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of concurrent COPY connections")
+    parser.add_argument("--no_manifest", action="store_true",
+                        help="don't record files in openalex.load_manifest and import every file")
+    parser.add_argument("--defer_indexes", action="store_true",
+                        help="drop the indexes and primary keys of openalex-pg-indexes.sql before the COPY "
+                             "and build them afterwards")
+    parser.add_argument("--bulk_load", action="store_true",
+                        help="load every empty table in one transaction that truncates it first, COPY FREEZE and "
+                             "without WAL under wal_level = minimal (postgresql-single/custom-conf/"
+                             "bulk-load.conf.example), with asynchronous commits, and ANALYZE at the end. Such a "
+                             "table loads on a single connection, so the tables bigger than a --workers-th of the "
+                             "load are still loaded file by file in parallel, partition the big works tables to "
+                             "bulk load them leaf by leaf")
+    parser.add_argument("--load_plan", type=str, default=None,
+                        help="only import the files of this load plan of merge_shard_manifests.py, checked to be "
+                             "all in --csv_dir first")
+    parser.add_argument("--tables", type=str, nargs='+', default=None,
+                        help="only import the files of these tables, names or patterns of the openalex tables "
+                             "('works_*'), a partitioned table includes its leaf tables")
+    parser.add_argument("--exclude_tables", type=str, nargs='+', default=None,
+                        help="don't import the files of these tables")
+    parser.add_argument("--index_workers", type=int, default=4,
+                        help="number of indexes built concurrently")
+    parser.add_argument("--maintenance_work_mem", type=str, default="2GB",
+                        help="maintenance_work_mem of each index build")
+    parser.add_argument("--max_parallel_maintenance_workers", type=int, default=4,
+                        help="max_parallel_maintenance_workers of each index build")
+    args = parser.parse_args()
+    try:
+        tables = select_tables(args.tables, args.exclude_tables)
+    except ValueError as e:
+        parser.error(str(e))
+
+    csv_dir = args.csv_dir
+    if args.load_plan:
+        files, problems = plan_files(args.load_plan, csv_dir)
+        if problems:
+            print(f"{len(problems)} files of {args.load_plan} are not ready:")
+            for problem in problems:
+                print(f"  {problem}")
+            raise SystemExit(1)
+    else:
+        files = sorted(fp for fp in glob.glob(os.path.join(csv_dir, '*')) if is_copy_file(fp))
+    if tables is not None:
+        files = [fp for fp in files if (partition_parent(table_key(fp)) or table_key(fp)) in tables]
+    manifest = not args.no_manifest
+    conn = psycopg2.connect(**DB_CONFIG)
+    indexes = expand_partitioned_indexes(conn, load_index_statements()) if args.defer_indexes else []
+    if tables is not None:
+        indexes = [index for index in indexes if (partition_parent(index[1]) or index[1]) in tables]
+    if manifest:
+        ensure_manifest(conn)
+        pending = pending_files(conn, files)
+        print(f"{len(files) - len(pending)} files already committed, {len(pending)} to import")
+        files = pending
+    if indexes:
+        drop_indexes(conn, indexes)
+    bulk_tables = plan_bulk_load(conn, files, args.workers) if args.bulk_load else set()
+    conn.close()
+
+    start = time.time()
+    stats, failures = import_files(files, args.workers, manifest, bulk_tables, args.bulk_load)
+    print_stats(stats, time.time() - start)
+    if failures:
+        print(f"{len(failures)} files failed:")
+        for fp, e in failures:
+            print(f"  {fp}: {e}")
+
+    if indexes:
+        start = time.time()
+        index_failures = build_indexes(indexes, args.index_workers, args.maintenance_work_mem,
+                                       args.max_parallel_maintenance_workers)
+        print(f"built {len(indexes) - len(index_failures)} of {len(indexes)} indexes in {time.time() - start:.1f}s")
+
+    if args.bulk_load:
+        analyze_tables({table_key(fp) for fp in files}, args.workers)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     merge_shard_manifests
+   Description :  check the manifests of a flatten spread over several nodes
+                  with --shard i/N and merge them into the load plan of
+                  import_csv_to_postgresql.py --load_plan
+-------------------------------------------------
+"""
+import argparse
+import glob
+import json
+import os
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from openalex_io import partition_parent
+
+
+def load_manifests(paths):
+    manifests = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest['path'] = path
+        manifests.append(manifest)
+    return manifests
+
+
+def merge_manifests(manifests):
+    """Merge the shard manifests into one load plan, ``(plan, problems)``.
+
+    Every run (``works``, ``entities``) must have the manifests of all its
+    ``N`` shards, made from the same snapshot listing, which together cover
+    every file of the snapshot once and without failures, and no two output
+    files may share a name. Each broken rule is reported in ``problems``, the
+    plan is only worth loading when there are none.
+    """
+    problems = []
+    runs = defaultdict(list)
+    for manifest in manifests:
+        runs[manifest['name']].append(manifest)
+
+    plan = {'created': datetime.now().isoformat(timespec='seconds'), 'runs': {}, 'files': [], 'tables': Counter()}
+    owners = {}
+    for name, shards in sorted(runs.items()):
+        counts = {manifest['shard'][1] for manifest in shards}
+        if len(counts) > 1:
+            problems.append(f"{name}: manifests of different shard counts {sorted(counts)}")
+            continue
+        count = counts.pop()
+        indexes = Counter(manifest['shard'][0] for manifest in shards)
+        missing = sorted(set(range(count)) - set(indexes))
+        if missing:
+            problems.append(f"{name}: no manifest of shard {', '.join(f'{i}/{count}' for i in missing)}")
+        for index, times in sorted(indexes.items()):
+            if times > 1:
+                problems.append(f"{name}: {times} manifests of shard {index}/{count}")
+        if len({manifest['snapshot_digest'] for manifest in shards}) > 1:
+            problems.append(f"{name}: the shards listed different snapshots")
+
+        inputs = Counter()
+        for manifest in shards:
+            inputs.update(list(manifest['inputs']) + list(manifest['failures']))
+            for input_key, error in sorted(manifest['failures'].items()):
+                problems.append(f"{name}: {input_key} failed on shard {manifest['shard'][0]}/{count}: {error}")
+            for input_key, flattened in sorted(manifest['inputs'].items()):
+                for file_name, stats in sorted(flattened['outputs'].items()):
+                    if file_name in owners:
+                        problems.append(f"{file_name} written by both {owners[file_name]} and {input_key}")
+                        continue
+                    owners[file_name] = input_key
+                    plan['files'].append({'path': file_name, 'table': stats['table'], 'rows': stats['rows'],
+                                          'bytes': stats['bytes'], 'input': input_key,
+                                          'shard': manifest['shard'][0]})
+                    plan['tables'][partition_parent(stats['table']) or stats['table']] += stats['rows']
+        for input_key, times in sorted(inputs.items()):
+            if times > 1:
+                problems.append(f"{name}: {input_key} flattened by {times} shards")
+        snapshot_files = max(manifest['snapshot_files'] for manifest in shards)
+        if not missing and len(inputs) != snapshot_files:
+            problems.append(f"{name}: the shards cover {len(inputs)} of the {snapshot_files} snapshot files")
+        plan['runs'][name] = {'shards': count, 'snapshot_files': snapshot_files, 'inputs': len(inputs),
+                              'hosts': sorted({manifest['host'] for manifest in shards})}
+
+    plan['files'].sort(key=lambda f: f['path'])
+    plan['tables'] = dict(sorted(plan['tables'].items()))
+    return plan, problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="merge_shard_manifests")
+    parser.add_argument("--csv_dir", type=str, default="./data/openalex/csv-files",
+                        help="directory the output files of every node were gathered in, with their manifests")
+    parser.add_argument("--manifests", type=str, nargs='+', default=None,
+                        help="manifest files to merge, the manifest_*_of_*.json of --csv_dir by default")
+    parser.add_argument("--output", type=str, default=None,
+                        help="load plan to write, <csv_dir>/load_plan.json by default")
+    args = parser.parse_args()
+
+    paths = args.manifests or sorted(glob.glob(os.path.join(args.csv_dir, 'manifest_*_of_*.json')))
+    if not paths:
+        parser.error(f"no manifest in {args.csv_dir}")
+    plan, problems = merge_manifests(load_manifests(paths))
+    for name, run in plan['runs'].items():
+        print(f"{name}: {run['inputs']} of {run['snapshot_files']} files over {run['shards']} shards "
+              f"({', '.join(run['hosts'])})")
+    print(f"{len(plan['files'])} files, {sum(plan['tables'].values())} rows")
+    if problems:
+        print(f"{len(problems)} problems, no load plan written:")
+        for problem in problems:
+            print(f"  {problem}")
+        raise SystemExit(1)
+
+    output = args.output or os.path.join(args.csv_dir, 'load_plan.json')
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, indent=1)
+    print(f"load plan written to {output}")
@@ -0,0 +1,121 @@
+--
+-- Compact OpenAlex ids: run after openalex-pg-schema.sql to load files flattened with
+-- --compact_ids. Every column holding an OpenAlex id becomes a bigint
+-- (https://openalex.org/W2741809807 -> 2741809807), the entity letter is implied by the
+-- column. Rows already loaded with url ids are converted in place.
+--
+
+ALTER TABLE openalex.authors
+    ALTER COLUMN id TYPE bigint USING NULLIF(substring(id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN last_known_institution TYPE bigint USING NULLIF(substring(last_known_institution from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.authors_counts_by_year
+    ALTER COLUMN author_id TYPE bigint USING NULLIF(substring(author_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.authors_ids
+    ALTER COLUMN author_id TYPE bigint USING NULLIF(substring(author_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN openalex TYPE bigint USING NULLIF(substring(openalex from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.concepts
+    ALTER COLUMN id TYPE bigint USING NULLIF(substring(id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.concepts_ancestors
+    ALTER COLUMN concept_id TYPE bigint USING NULLIF(substring(concept_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN ancestor_id TYPE bigint USING NULLIF(substring(ancestor_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.concepts_counts_by_year
+    ALTER COLUMN concept_id TYPE bigint USING NULLIF(substring(concept_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.concepts_ids
+    ALTER COLUMN concept_id TYPE bigint USING NULLIF(substring(concept_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN openalex TYPE bigint USING NULLIF(substring(openalex from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.concepts_related_concepts
+    ALTER COLUMN concept_id TYPE bigint USING NULLIF(substring(concept_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN related_concept_id TYPE bigint USING NULLIF(substring(related_concept_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.institutions
+    ALTER COLUMN id TYPE bigint USING NULLIF(substring(id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.institutions_associated_institutions
+    ALTER COLUMN institution_id TYPE bigint USING NULLIF(substring(institution_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN associated_institution_id TYPE bigint USING NULLIF(substring(associated_institution_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.institutions_counts_by_year
+    ALTER COLUMN institution_id TYPE bigint USING NULLIF(substring(institution_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.institutions_geo
+    ALTER COLUMN institution_id TYPE bigint USING NULLIF(substring(institution_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.institutions_ids
+    ALTER COLUMN institution_id TYPE bigint USING NULLIF(substring(institution_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN openalex TYPE bigint USING NULLIF(substring(openalex from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.publishers
+    ALTER COLUMN id TYPE bigint USING NULLIF(substring(id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN parent_publisher TYPE bigint USING NULLIF(substring(parent_publisher from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.publishers_counts_by_year
+    ALTER COLUMN publisher_id TYPE bigint USING NULLIF(substring(publisher_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.publishers_ids
+    ALTER COLUMN publisher_id TYPE bigint USING NULLIF(substring(publisher_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN openalex TYPE bigint USING NULLIF(substring(openalex from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.sources
+    ALTER COLUMN id TYPE bigint USING NULLIF(substring(id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.sources_counts_by_year
+    ALTER COLUMN source_id TYPE bigint USING NULLIF(substring(source_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.sources_ids
+    ALTER COLUMN source_id TYPE bigint USING NULLIF(substring(source_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN openalex TYPE bigint USING NULLIF(substring(openalex from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works
+    ALTER COLUMN id TYPE bigint USING NULLIF(substring(id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_primary_locations
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN source_id TYPE bigint USING NULLIF(substring(source_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_locations
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN source_id TYPE bigint USING NULLIF(substring(source_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_best_oa_locations
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN source_id TYPE bigint USING NULLIF(substring(source_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_authorships
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN author_id TYPE bigint USING NULLIF(substring(author_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN institution_id TYPE bigint USING NULLIF(substring(institution_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_biblio
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_concepts
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN concept_id TYPE bigint USING NULLIF(substring(concept_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_ids
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN openalex TYPE bigint USING NULLIF(substring(openalex from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_mesh
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_open_access
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_referenced_works
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN referenced_work_id TYPE bigint USING NULLIF(substring(referenced_work_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_related_works
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint,
+    ALTER COLUMN related_work_id TYPE bigint USING NULLIF(substring(related_work_id from '[0-9]+$'), '')::bigint;
+
+ALTER TABLE openalex.works_abstracts
+    ALTER COLUMN work_id TYPE bigint USING NULLIF(substring(work_id from '[0-9]+$'), '')::bigint;
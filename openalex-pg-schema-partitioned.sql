@@ -0,0 +1,36 @@
+--
+-- Hash partitioned works child tables: run after openalex-pg-schema.sql (and after
+-- openalex-pg-schema-compact-ids.sql if you use it, the type of a partition key can't
+-- change afterwards), before loading anything. The largest works child tables become
+-- PARTITION BY HASH (work_id) parents of 16 leaf tables <table>_p0 ... <table>_p15, so
+-- vacuum, index builds and reloads work one leaf at a time.
+--
+-- Flatten the works with flatten-openalex-works-to-csv.py --partitions 16, every shard
+-- then holds the rows of one leaf and import_csv_to_postgresql.py COPYs it straight into
+-- that leaf. Keep the number of partitions below and --partitions the same, and the table
+-- list the same as PARTITIONED_TABLES in openalex_io.py.
+--
+
+DO $$
+DECLARE
+    partitions CONSTANT integer := 16;
+    parent text;
+    loaded boolean;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['works_authorships', 'works_concepts', 'works_locations', 'works_mesh',
+                                  'works_referenced_works', 'works_related_works'] LOOP
+        EXECUTE format('SELECT EXISTS (SELECT FROM openalex.%I)', parent) INTO loaded;
+        IF loaded THEN
+            RAISE EXCEPTION 'openalex.% already holds rows, partition it before loading the data', parent;
+        END IF;
+        EXECUTE format('ALTER TABLE openalex.%I RENAME TO %I', parent, parent || '_unpartitioned');
+        EXECUTE format('CREATE TABLE openalex.%I (LIKE openalex.%I INCLUDING ALL) PARTITION BY HASH (work_id)',
+                       parent, parent || '_unpartitioned');
+        EXECUTE format('DROP TABLE openalex.%I', parent || '_unpartitioned');
+        FOR remainder IN 0 .. partitions - 1 LOOP
+            EXECUTE format('CREATE TABLE openalex.%I PARTITION OF openalex.%I FOR VALUES WITH (MODULUS %s, REMAINDER %s)',
+                           parent || '_p' || remainder, parent, partitions, remainder);
+        END LOOP;
+    END LOOP;
+END
+$$;
@@ -470,175 +470,20 @@ CREATE TABLE openalex.works_related_works (
 );
 
 
-----
----- Name: authors_counts_by_year authors_counts_by_year_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
 --
---ALTER TABLE ONLY openalex.authors_counts_by_year
---    ADD CONSTRAINT authors_counts_by_year_pkey PRIMARY KEY (author_id, year);
+-- Name: works_abstracts; Type: TABLE; Schema: openalex; Owner: -
 --
---
-----
----- Name: authors_ids authors_ids_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.authors_ids
---    ADD CONSTRAINT authors_ids_pkey PRIMARY KEY (author_id);
---
---
-----
----- Name: authors authors_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.authors
---    ADD CONSTRAINT authors_pkey PRIMARY KEY (id);
---
---
-----
----- Name: concepts_counts_by_year concepts_counts_by_year_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.concepts_counts_by_year
---    ADD CONSTRAINT concepts_counts_by_year_pkey PRIMARY KEY (concept_id, year);
---
---
-----
----- Name: concepts_ids concepts_ids_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.concepts_ids
---    ADD CONSTRAINT concepts_ids_pkey PRIMARY KEY (concept_id);
---
---
-----
----- Name: concepts concepts_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.concepts
---    ADD CONSTRAINT concepts_pkey PRIMARY KEY (id);
---
---
-----
----- Name: institutions_counts_by_year institutions_counts_by_year_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.institutions_counts_by_year
---    ADD CONSTRAINT institutions_counts_by_year_pkey PRIMARY KEY (institution_id, year);
---
---
-----
----- Name: institutions_geo institutions_geo_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.institutions_geo
---    ADD CONSTRAINT institutions_geo_pkey PRIMARY KEY (institution_id);
---
---
-----
----- Name: institutions_ids institutions_ids_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.institutions_ids
---    ADD CONSTRAINT institutions_ids_pkey PRIMARY KEY (institution_id);
---
---
-----
----- Name: institutions institutions_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.institutions
---    ADD CONSTRAINT institutions_pkey PRIMARY KEY (id);
---
---
-----
----- Name: sources source_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.sources
---    ADD CONSTRAINT source_pkey PRIMARY KEY (id);
---
---
-----
----- Name: sources_counts_by_year sources_counts_by_year_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.sources_counts_by_year
---    ADD CONSTRAINT sources_counts_by_year_pkey PRIMARY KEY (source_id, year);
---
---
-----
----- Name: works_biblio works_biblio_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.works_biblio
---    ADD CONSTRAINT works_biblio_pkey PRIMARY KEY (work_id);
---
---
-----
----- Name: works_ids works_ids_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.works_ids
---    ADD CONSTRAINT works_ids_pkey PRIMARY KEY (work_id);
---
---
-----
----- Name: works_open_access works_open_access_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.works_open_access
---    ADD CONSTRAINT works_open_access_pkey PRIMARY KEY (work_id);
---
---
-----
----- Name: works works_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
-----
---
---ALTER TABLE ONLY openalex.works
---    ADD CONSTRAINT works_pkey PRIMARY KEY (id);
---
-
---
--- Name: concepts_ancestors_concept_id_idx; Type: INDEX; Schema: openalex; Owner: -
---
-
-CREATE INDEX concepts_ancestors_concept_id_idx ON openalex.concepts_ancestors USING btree (concept_id);
-
-
---
--- Name: concepts_related_concepts_concept_id_idx; Type: INDEX; Schema: openalex; Owner: -
---
-
-CREATE INDEX concepts_related_concepts_concept_id_idx ON openalex.concepts_related_concepts USING btree (concept_id);
 
-
---
--- Name: concepts_related_concepts_related_concept_id_idx; Type: INDEX; Schema: openalex; Owner: -
---
-
-CREATE INDEX concepts_related_concepts_related_concept_id_idx ON openalex.concepts_related_concepts USING btree (related_concept_id);
-
---
--- Name: works_primary_locations_work_id_idx; Type: INDEX; Schema: openalex; Owner: -
---
-
-CREATE INDEX works_primary_locations_work_id_idx ON openalex.works_primary_locations USING btree (work_id);
-
-
---
--- Name: works_locations_work_id_idx; Type: INDEX; Schema: openalex; Owner: -
---
-
-CREATE INDEX works_locations_work_id_idx ON openalex.works_locations USING btree (work_id);
+CREATE TABLE openalex.works_abstracts (
+    work_id text NOT NULL,
+    abstract text
+);
 
 
 --
--- Name: works_best_oa_locations_work_id_idx; Type: INDEX; Schema: openalex; Owner: -
+-- Indexes and primary keys are in openalex-pg-indexes.sql, build them after the data is loaded.
 --
 
-CREATE INDEX works_best_oa_locations_work_id_idx ON openalex.works_best_oa_locations USING btree (work_id);
-
-
 --
 -- PostgreSQL database dump complete
 --
@@ -0,0 +1,1446 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     openalex_io
+   Description :  shared helpers for the flatten and import scripts
+-------------------------------------------------
+"""
+import csv
+import glob
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import mmap
+import multiprocessing
+import operator
+import os
+import queue
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # optional, about twice as fast as the json module
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for the zstd codec
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # optional, only needed for the lz4 codec
+    lz4 = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional, only needed for the parquet output
+    pyarrow = None
+
+loads = orjson.loads if orjson is not None else json.loads
+
+ABSTRACT_KEY = b'"abstract_inverted_index":'
+
+SCHEMA_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openalex-pg-schema.sql')
+
+# columns holding an OpenAlex id, stored as bigint with --compact_ids. The
+# entity letter is implied by the column, e.g. works.id or referenced_work_id
+# are W ids and author_id is an A id.
+ID_COLUMNS = frozenset([
+    'id', 'openalex', 'work_id', 'referenced_work_id', 'related_work_id', 'author_id', 'concept_id',
+    'ancestor_id', 'related_concept_id', 'institution_id', 'associated_institution_id',
+    'last_known_institution', 'publisher_id', 'parent_publisher', 'source_id',
+])
+
+# works child tables that openalex-pg-schema-partitioned.sql hash partitions on
+# work_id into <table>_p0 ... <table>_p<n-1> leaves
+PARTITIONED_TABLES = [
+    'works_authorships', 'works_concepts', 'works_locations', 'works_mesh', 'works_referenced_works',
+    'works_related_works',
+]
+PARTITION_KEY = 'work_id'
+
+# output formats of the flatten scripts and the extension of their files,
+# csv and binary files also get the extension of their codec
+FORMATS = {
+    'csv': '.csv',
+    'binary': '.pgcopy',
+    'parquet': '.parquet',
+}
+
+# compression codecs of the csv and binary files
+CODECS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'lz4': '.lz4',
+    'none': '',
+}
+
+# level used when none is given. gzip -6 is the gzip(1) default, level 9 costs
+# about twice the time for a few percent on csv
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3, 'lz4': 0, 'none': None}
+
+# external compressors of the process offload, reading stdin and writing stdout
+COMPRESSOR_COMMANDS = {
+    'gzip': lambda level: [shutil.which('pigz') or 'gzip', '-c', f'-{level}'],
+    'zstd': lambda level: ['zstd', '-q', '-c', f'-{level}'],
+    'lz4': lambda level: ['lz4', '-q', '-c', f'-{max(level, 1)}'],
+}
+
+
+def load_script(filename, module_name):
+    """Import one of the hyphenated scripts next to this file as ``module_name``."""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def split_abstract(line):
+    """Cut the ``abstract_inverted_index`` object out of a raw works line.
+
+    Returns ``(line, abstract)``: the line with the abstract replaced by
+    ``null`` and the raw json of the abstract object. ``abstract`` is ``None``
+    (and the line unchanged) when there is no abstract to cut.
+
+    The inverted index only holds word keys mapped to position arrays, so it
+    ends at the first ``]}`` followed by the next member or the end of the
+    work. That is found with single byte searches instead of decoding the
+    object, which is often the biggest part of a work. If a word happens to
+    fool the search, ``decode_work`` falls back to a full decode.
+    """
+    start = line.find(ABSTRACT_KEY)
+    if start < 0:
+        return line, None
+    begin = start + len(ABSTRACT_KEY)
+    while line[begin:begin + 1] in (b' ', b'\t'):
+        begin += 1
+    if line[begin:begin + 1] != b'{':
+        return line, None
+    end = line.find(b'}', begin + 1)
+    while end > 0 and not (
+            (end == begin + 1 or line[end - 1] == 0x5d)  # '{}' or '...]}'
+            and line[end + 1:end + 2] in (b',', b'}', b' ', b'\n', b'')):
+        end = line.find(b'}', end + 1)
+    if end < 0:
+        return line, None
+    return line[:start] + ABSTRACT_KEY + b'null' + line[end + 1:], line[begin:end + 1]
+
+
+def decode_work(line, with_abstract=False):
+    """Decode a raw works line without materializing its abstract_inverted_index.
+
+    With ``with_abstract`` the abstract is decoded on its own and put back
+    under ``abstract_inverted_index``.
+    """
+    stripped, abstract = split_abstract(line)
+    if abstract is None:
+        return loads(line)
+    try:
+        work = loads(stripped)
+    except ValueError:
+        # the cut landed inside a string value, decode the whole line
+        return loads(line)
+    if with_abstract:
+        work['abstract_inverted_index'] = loads(abstract)
+    return work
+
+
+# operators of a --where predicate, the longest first for the parser
+WHERE_OPERATORS = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '!=': operator.ne,
+    '=': operator.eq,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+
+# fields of --where that hold a list of ids in a work: ``(list key, path to the id in an item)``
+WORK_LIST_FIELDS = {
+    'concept_id': ('concepts', ('id',)),
+    'author_id': ('authorships', ('author', 'id')),
+    'institution_id': ('authorships', ('institutions', 'id')),
+    'source_id': ('locations', ('source', 'id')),
+    'referenced_work_id': ('referenced_works', ()),
+}
+
+
+def _where_value(text):
+    """Type a --where value like its json, ``2015 -> 2015``, ``true -> True``, ``article -> 'article'``."""
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def _short_id(value):
+    return value.rsplit('/', 1)[-1] if isinstance(value, str) else value
+
+
+class WorkFilter:
+    """The ``--where`` predicates of the works, all of them must hold.
+
+    A predicate is ``field op value``: a top level field of the work compared
+    with ``= != > >= < <=``, ``=`` and ``!=`` taking a comma separated list
+    (``publication_year>=2015``, ``type=article,review``), or one of
+    ``WORK_LIST_FIELDS`` with ``=`` / ``!=``, true when any / none of the ids
+    is found in the work (``concept_id=C41008148``).
+
+    ``match_raw`` looks at the raw json line and rejects most of the works
+    that don't match before they are decoded, it only looks for the values it
+    can't miss, so it never rejects a matching work. ``match`` then decides
+    on the decoded work.
+    """
+
+    def __init__(self, predicates):
+        self.predicates = []
+        self._raw_tests = []
+        for predicate in predicates:
+            match = re.match(r'\s*(\w+)\s*(>=|<=|!=|=|>|<)(.*)$', predicate)
+            if match is None:
+                raise ValueError(f"bad --where predicate {predicate!r}, expected field op value")
+            field, op, text = match.groups()
+            values = [_where_value(value) for value in text.split(',')] if op in ('=', '!=') else [_where_value(text)]
+            if field in WORK_LIST_FIELDS:
+                if op not in ('=', '!='):
+                    raise ValueError(f"{field} only takes = or != in --where")
+                values = [_short_id(value) for value in values]
+            self.predicates.append((field, op, values))
+            raw_test = self._compile_raw(field, op, values)
+            if raw_test is not None:
+                self._raw_tests.append(raw_test)
+
+    @staticmethod
+    def _test(op, values, value):
+        compare = WHERE_OPERATORS[op]
+        try:
+            if op == '!=':
+                return all(compare(value, expected) for expected in values)
+            return any(compare(value, expected) for expected in values)
+        except TypeError:
+            # None or a value of another type in a range
+            return False
+
+    def _compile_raw(self, field, op, values):
+        """Return a test of the raw line that is only false for works that don't match, or None."""
+        if field in WORK_LIST_FIELDS:
+            if op != '=' or not all(isinstance(value, str) and value.isascii() and value.isalnum()
+                                    for value in values):
+                return None
+            # the id closes its json string, whatever the escaping of the '/' before it
+            needles = [value.encode() + b'"' for value in values]
+            return lambda line: any(needle in line for needle in needles)
+        if self._test(op, values, None):
+            # a work without the field matches, it can't be told from a line without it
+            return None
+        # every "field": value of the line, nested ones included, the top level one must match
+        pattern = re.compile(rb'"' + field.encode() + rb'"\s*:\s*("(?:[^"\\]|\\.)*"|[^\s,}\]\[{]+)')
+
+        def raw_test(line):
+            for found in pattern.finditer(line):
+                try:
+                    value = loads(found.group(1))
+                except ValueError:
+                    continue
+                if self._test(op, values, value):
+                    return True
+            return False
+        return raw_test
+
+    def match_raw(self, line):
+        for raw_test in self._raw_tests:
+            if not raw_test(line):
+                return False
+        return True
+
+    def match(self, work):
+        for field, op, values in self.predicates:
+            if field in WORK_LIST_FIELDS:
+                found = set(self._list_ids(work, *WORK_LIST_FIELDS[field]))
+                if (op == '=') != any(value in found for value in values):
+                    return False
+            elif not self._test(op, values, work.get(field)):
+                return False
+        return True
+
+    @staticmethod
+    def _list_ids(work, key, path):
+        items = work.get(key) or []
+        for step in path:
+            next_items = []
+            for item in items:
+                value = (item or {}).get(step)
+                next_items.extend(value if isinstance(value, list) else [value])
+            items = next_items
+        return [_short_id(item) for item in items if item]
+
+
+def split_extension(path):
+    """Split an output file name into ``(stem, format, codec)``.
+
+    ``works_ids_3.csv.zst -> ('works_ids_3', 'csv', 'zstd')``. Raises
+    ``ValueError`` for files that are not flattener output.
+    """
+    name = os.path.basename(path)
+    for codec, codec_extension in CODECS.items():
+        if codec_extension and not name.endswith(codec_extension):
+            continue
+        stem = name[:-len(codec_extension)] if codec_extension else name
+        for fmt, extension in FORMATS.items():
+            if stem.endswith(extension) and (codec == 'none' or fmt != 'parquet'):
+                return stem[:-len(extension)], fmt, codec
+    raise ValueError(f"unknown output format: {path}")
+
+
+def output_path(csv_name, fmt='csv', codec='gzip'):
+    """Turn a ``.csv.gz`` name of the file specs into the file name of ``fmt`` and ``codec``."""
+    stem = csv_name[:-len(FORMATS['csv'] + CODECS['gzip'])]
+    return stem + FORMATS[fmt] + ('' if fmt == 'parquet' else CODECS[codec])
+
+
+def table_key(path):
+    """Map an output file to its table, e.g. ``works_authorships_12.csv.gz -> works_authorships``."""
+    try:
+        key = split_extension(path)[0]
+    except ValueError:
+        key = os.path.basename(path)
+    return re.sub(r'_\d*$', "", key)
+
+
+def file_format(path):
+    """Return the output format of a file from its extension."""
+    return split_extension(path)[1]
+
+
+def file_codec(path):
+    """Return the compression codec of a file from its extension."""
+    return split_extension(path)[2]
+
+
+def _require(module, codec):
+    if module is None:
+        raise RuntimeError(f"the {codec} codec needs the {'zstandard' if codec == 'zstd' else codec} package")
+
+
+def open_compressed(path, codec='gzip', level=None):
+    """Open ``path`` for writing through ``codec``, returns a binary file object."""
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=level)
+    if codec == 'zstd':
+        _require(zstandard, codec)
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(path, 'wb'), closefd=True)
+    if codec == 'lz4':
+        _require(lz4, codec)
+        return lz4.frame.open(path, 'wb', compression_level=level)
+    return open(path, 'wb')
+
+
+def open_decompressed(file, codec='gzip'):
+    """Wrap a binary file object to read its decompressed bytes."""
+    if codec == 'gzip':
+        return gzip.open(file, 'rb')
+    if codec == 'zstd':
+        _require(zstandard, codec)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(file, closefd=False))
+    if codec == 'lz4':
+        _require(lz4, codec)
+        return lz4.frame.open(file, 'rb')
+    return file
+
+
+class ThreadCompressor(io.RawIOBase):
+    """Compress on a background thread, so it overlaps with the flatten of the next rows.
+
+    Writes are gathered into ``chunk_size`` blocks and handed over a bounded
+    queue. zlib, zstd and lz4 release the GIL while compressing, so the
+    thread really runs next to the worker.
+    """
+
+    def __init__(self, file, chunk_size=1 << 18, depth=4):
+        super().__init__()
+        self.file = file
+        self.chunk_size = chunk_size
+        self._pending = bytearray()
+        self._queue = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while (chunk := self._queue.get()) is not None:
+            if self._error is None:
+                try:
+                    self.file.write(chunk)
+                except BaseException as e:
+                    self._error = e
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._pending += data
+        if len(self._pending) >= self.chunk_size:
+            self._queue.put(bytes(self._pending))
+            self._pending.clear()
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._pending:
+                self._queue.put(bytes(self._pending))
+            self._queue.put(None)
+            self._thread.join()
+            self.file.close()
+        finally:
+            super().close()
+        if self._error is not None:
+            raise self._error
+
+
+class ProcessCompressor(io.RawIOBase):
+    """Compress in an external process (pigz/gzip, zstd or lz4) fed through a pipe."""
+
+    def __init__(self, path, codec='gzip', level=None):
+        super().__init__()
+        level = DEFAULT_LEVELS[codec] if level is None else level
+        with open(path, 'wb') as out:
+            self._process = subprocess.Popen(COMPRESSOR_COMMANDS[codec](level), stdin=subprocess.PIPE, stdout=out)
+        self.file = self._process.stdin
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.file.write(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.file.close()
+            returncode = self._process.wait()
+        finally:
+            super().close()
+        if returncode:
+            raise RuntimeError(f"{self._process.args[0]} exited with {returncode}")
+
+
+def open_output(path, codec='gzip', level=None, offload=None):
+    """Open an output file through ``codec``, compressing inline or with ``offload`` ``thread``/``process``."""
+    if codec == 'none':
+        return open(path, 'wb')
+    if offload == 'process':
+        return ProcessCompressor(path, codec, level)
+    file = open_compressed(path, codec, level)
+    return ThreadCompressor(file) if offload == 'thread' else file
+
+
+def compact_id(value):
+    """Turn an OpenAlex id into its number, ``https://openalex.org/W2741809807 -> 2741809807``."""
+    if not value:
+        return None
+    return int(value[value.rfind('/') + 2:])
+
+
+def compact_rows(rows, id_positions):
+    """Copy the row tuples ``rows`` with the OpenAlex ids at ``id_positions`` made compact."""
+    compacted = []
+    for row in rows:
+        row = list(row)
+        for position in id_positions:
+            row[position] = compact_id(row[position])
+        compacted.append(row)
+    return compacted
+
+
+# PostgreSQL's hash partitioning, ported from hashfn.c and partbounds.c: the
+# key is hashed with the extended hash function of its type (hashtextextended
+# or hashint8extended, both lookup3) seeded with HASH_PARTITION_SEED, combined
+# with hash_combine64 and taken modulo the number of partitions
+HASH_PARTITION_SEED = 0x7A5B22367996DCFD
+_UINT32 = 0xFFFFFFFF
+_UINT64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _rot(x, k):
+    return ((x << k) | (x >> (32 - k))) & _UINT32
+
+
+def _mix(a, b, c):
+    a = (a - c) & _UINT32
+    a ^= _rot(c, 4)
+    c = (c + b) & _UINT32
+    b = (b - a) & _UINT32
+    b ^= _rot(a, 6)
+    a = (a + c) & _UINT32
+    c = (c - b) & _UINT32
+    c ^= _rot(b, 8)
+    b = (b + a) & _UINT32
+    a = (a - c) & _UINT32
+    a ^= _rot(c, 16)
+    c = (c + b) & _UINT32
+    b = (b - a) & _UINT32
+    b ^= _rot(a, 19)
+    a = (a + c) & _UINT32
+    c = (c - b) & _UINT32
+    c ^= _rot(b, 4)
+    b = (b + a) & _UINT32
+    return a, b, c
+
+
+def _final(a, b, c):
+    c ^= b
+    c = (c - _rot(b, 14)) & _UINT32
+    a ^= c
+    a = (a - _rot(c, 11)) & _UINT32
+    b ^= a
+    b = (b - _rot(a, 25)) & _UINT32
+    c ^= b
+    c = (c - _rot(b, 16)) & _UINT32
+    a ^= c
+    a = (a - _rot(c, 4)) & _UINT32
+    b ^= a
+    b = (b - _rot(a, 14)) & _UINT32
+    c ^= b
+    c = (c - _rot(b, 24)) & _UINT32
+    return a, b, c
+
+
+@lru_cache(maxsize=256)
+def _hash_start(length, seed):
+    a = b = c = (0x9e3779b9 + length + 3923095) & _UINT32
+    if seed:
+        a = (a + (seed >> 32)) & _UINT32
+        b = (b + (seed & _UINT32)) & _UINT32
+        a, b, c = _mix(a, b, c)
+    return a, b, c
+
+
+def pg_hash_bytes(data, seed=HASH_PARTITION_SEED):
+    """``hash_bytes_extended``, the hash of a text value under a deterministic collation."""
+    a, b, c = _hash_start(len(data), seed)
+    end = len(data) - len(data) % 12
+    for x, y, z in struct.iter_unpack('<3I', data[:end]):
+        a, b, c = _mix((a + x) & _UINT32, (b + y) & _UINT32, (c + z) & _UINT32)
+    # the last 0 to 11 bytes, the lowest byte of c is left for the length
+    x, y, z = struct.unpack('<3I', data[end:].ljust(12, b'\0'))
+    a, b, c = _final((a + x) & _UINT32, (b + y) & _UINT32, (c + (z << 8)) & _UINT32)
+    return (b << 32) | c
+
+
+def pg_hash_int8(value, seed=HASH_PARTITION_SEED):
+    """``hashint8extended``, the hash of a bigint value."""
+    lohalf = value & _UINT32
+    hihalf = (value >> 32) & _UINT32
+    lohalf ^= hihalf if value >= 0 else ~hihalf & _UINT32
+    a, b, c = _hash_start(4, seed)
+    a, b, c = _final((a + lohalf) & _UINT32, b, c)
+    return (b << 32) | c
+
+
+@lru_cache(maxsize=4096)
+def hash_partition(value, modulus):
+    """The remainder of the hash partition holding ``value``, a text or (with compact ids) bigint key.
+
+    Matches ``PARTITION BY HASH`` with ``modulus`` partitions, so rows can be
+    written straight to the file of their leaf table. NULL keys go to
+    remainder 0, like in PostgreSQL.
+    """
+    if value is None:
+        return 0
+    key_hash = pg_hash_int8(value) if isinstance(value, int) else pg_hash_bytes(value.encode('utf-8'))
+    return ((key_hash + 0x49a0f4dd15e5a8e3) & _UINT64) % modulus
+
+
+def partition_table(table, remainder):
+    return f"{table}_p{remainder}"
+
+
+def partition_parent(table):
+    """The partitioned table of a leaf, ``works_authorships_p3 -> works_authorships``, None for other tables."""
+    parent, _, remainder = table.rpartition('_p')
+    return parent if parent in PARTITIONED_TABLES and remainder.isdigit() else None
+
+
+@lru_cache(maxsize=None)
+def load_column_types(path=SCHEMA_SQL, compact_ids=False):
+    """Parse the ``CREATE TABLE openalex.*`` statements into ``{table: {column: type}}``.
+
+    With ``compact_ids`` the ``ID_COLUMNS`` are typed ``bigint``, like in
+    openalex-pg-schema-compact-ids.sql.
+    """
+    with open(path, encoding='utf-8') as f:
+        schema = f.read()
+    column_types = {}
+    for table, body in re.findall(r'CREATE TABLE openalex\.(\w+) \((.*?)\n\);', schema, re.S):
+        columns = {}
+        for line in body.strip().split('\n'):
+            name, column_type = line.strip().rstrip(',').split(' ', 1)
+            columns[name] = 'bigint' if compact_ids and name in ID_COLUMNS else column_type.replace(' NOT NULL', '')
+        column_types[table] = columns
+    return column_types
+
+
+# ways of reading the snapshot files: gzip inline in the parser, inflated
+# ahead on a thread, or by an external pigz/gzip process
+READERS = ['inline', 'thread', 'process']
+
+
+class LineBlockReader:
+    """Iterate the lines of a gzip jsonl file, inflated ahead of the parser.
+
+    A background thread inflates ``block_size`` chunks, with zlib on the thread
+    itself (``mode='thread'``, zlib releases the GIL while inflating) or by
+    reading the output of a ``pigz -dc``/``gzip -dc`` process
+    (``mode='process'``), and cuts them into blocks of complete lines. Up to
+    ``readahead`` blocks wait in a queue, so the parser only pops lists of
+    lines. Lines keep their ``\n`` like the lines of ``gzip.open``.
+    """
+
+    def __init__(self, path, mode='thread', readahead=4, block_size=1 << 22):
+        self.path = path
+        self.block_size = block_size
+        self._queue = queue.Queue(maxsize=max(1, readahead))
+        self._stop = threading.Event()
+        self._process = None
+        if mode == 'process':
+            self._process = subprocess.Popen([shutil.which('pigz') or 'gzip', '-dc', path], stdout=subprocess.PIPE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _chunks(self):
+        if self._process is not None:
+            while chunk := self._process.stdout.read(self.block_size):
+                yield chunk
+            if self._process.wait():
+                raise RuntimeError(f"{self._process.args[0]} -dc {self.path} exited with {self._process.returncode}")
+            return
+        with open(self.path, 'rb') as f:
+            inflater = zlib.decompressobj(wbits=31)
+            while data := f.read(self.block_size):
+                while data:
+                    yield inflater.decompress(data)
+                    # concatenated gzip members, start over on what follows the first one
+                    data = inflater.unused_data if inflater.eof else b''
+                    if data:
+                        inflater = zlib.decompressobj(wbits=31)
+            if not inflater.eof:
+                raise EOFError(f"compressed file ended before the end-of-stream marker was reached: {self.path}")
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            rest = b''
+            for chunk in self._chunks():
+                block = rest + chunk if rest else chunk
+                cut = block.rfind(b'\n') + 1
+                if cut:
+                    rest = block[cut:]
+                    # split on \n only, like gzip.open: splitlines would also cut at a \r in a record
+                    # and the line numbers of plan_latest would no longer match
+                    if not self._put([line + b'\n' for line in block[:cut - 1].split(b'\n')]):
+                        return
+                else:
+                    rest = block
+            if rest:
+                self._put([rest])
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def blocks(self):
+        """Yield the lists of lines as the reader thread hands them over."""
+        while (block := self._queue.get()) is not None:
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+
+    def __iter__(self):
+        for block in self.blocks():
+            yield from block
+
+    def close(self):
+        self._stop.set()
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+        self._thread.join()
+        if self._process is not None:
+            self._process.stdout.close()
+            self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_jsonl(jsonl_file_name, reader='inline', readahead=4):
+    """Open a snapshot file for iterating its lines, with one of the ``READERS``."""
+    if reader == 'inline':
+        return gzip.open(jsonl_file_name, 'rb')
+    return LineBlockReader(jsonl_file_name, reader, readahead)
+
+
+ID_PREFIX = re.compile(rb'\{\s*"id"\s*:\s*"([^"]*)"')
+
+# printed by every --no_dedup run, the snapshot repeats the records updated
+# since an older updated_date partition and the primary keys need one row per id
+NO_DEDUP_WARNING = ("warning: --no_dedup keeps every copy of a record found in several updated_date partitions, "
+                    "the primary keys of openalex-pg-indexes.sql (works_pkey, authors_pkey, ...) will fail to "
+                    "build on them")
+
+
+def record_number(record_id):
+    """The number of an OpenAlex id, ``-1`` if it has none (such records are never deduplicated)."""
+    try:
+        number = compact_id(record_id)
+    except ValueError:
+        return -1
+    return -1 if number is None else number
+
+
+def scan_ids(jsonl_file_name):
+    """Return the id numbers of the records of a snapshot file, one per non blank line.
+
+    Records start with their id, so it is read with a regex instead of a full
+    parse. Records without an id get ``-1``.
+    """
+    numbers = array('q')
+    with gzip.open(jsonl_file_name, 'rb') as jsonl:
+        for record_json in jsonl:
+            if not record_json.strip():
+                continue
+            if m := ID_PREFIX.match(record_json):
+                numbers.append(record_number(m.group(1).decode('utf-8')))
+            else:
+                numbers.append(record_number(loads(record_json).get('id')))
+    return numbers
+
+
+class IdBitmap:
+    """A set of OpenAlex id numbers, one bit each, in a memory mapped temporary file.
+
+    Ids are dense numbers below a few billion, so even the works and authors fit
+    in about 600MB of bitmap, paged to ``directory`` by the OS instead of
+    held as python strings.
+    """
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._map = None
+        self._size = 0
+
+    def _grow(self, size):
+        size = max(size, 2 * self._size, mmap.PAGESIZE)
+        size += -size % mmap.PAGESIZE
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._size = size
+
+    def add(self, number):
+        """Add ``number``, returns whether it was already in."""
+        index = number >> 3
+        if index >= self._size:
+            self._grow(index + 1)
+        mask = 1 << (number & 7)
+        byte = self._map[index]
+        if byte & mask:
+            return True
+        self._map[index] = byte | mask
+        return False
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def plan_latest(pool, files, index_dir=None, window=None):
+    """Pick the newest copy of every record of one entity across ``files``.
+
+    ``files`` are sorted oldest first, like the ``updated_date=`` partitions.
+    Their ids are scanned on ``pool``, at most ``window`` files ahead, while
+    the parent walks them newest first and their lines last first, so each
+    id is kept the first time it is met. Returns, for every file, the set of
+    line numbers (counting non blank lines) to skip.
+    """
+    window = window or 2 * (getattr(pool, '_max_workers', 1) or 1)
+    skip_lines = [None] * len(files)
+    pending = deque()
+    order = list(range(len(files) - 1, -1, -1))
+    with IdBitmap(index_dir) as seen:
+        for num in order:
+            pending.append((num, pool.submit(scan_ids, files[num])))
+            if len(pending) > window:
+                done, future = pending.popleft()
+                skip_lines[done] = _stale_lines(seen, future.result())
+        while pending:
+            done, future = pending.popleft()
+            skip_lines[done] = _stale_lines(seen, future.result())
+    return skip_lines
+
+
+def _stale_lines(seen, numbers):
+    stale = set()
+    for line_no in range(len(numbers) - 1, -1, -1):
+        number = numbers[line_no]
+        if number >= 0 and seen.add(number):
+            stale.add(line_no)
+    return stale
+
+
+def list_partitions(snapshot_dir, entity, since=None):
+    """List the ``updated_date=YYYY-MM-DD`` partitions of an entity, oldest first.
+
+    Returns ``[(date, [files])]``, only partitions strictly newer than ``since``
+    (an ISO date string) when it is given.
+    """
+    partitions = []
+    for partition_dir in glob.glob(os.path.join(snapshot_dir, 'data', entity, 'updated_date=*')):
+        date = re.sub(r'^updated_date=', '', os.path.basename(partition_dir))
+        if since and date <= since:
+            continue
+        files = sorted(glob.glob(os.path.join(partition_dir, '*.gz')))
+        if files:
+            partitions.append((date, files))
+    return sorted(partitions)
+
+
+def write_dedup_plan(path, files, skip_lines):
+    """Write the ``skip_lines`` of ``plan_latest`` for ``files`` to share them with every shard of a run.
+
+    Each file is recorded under its ``input_key``, with its size and the
+    numbers of its lines that hold an older copy of a record. The file is
+    replaced at once, like the manifests.
+    """
+    plan = {input_key(f): {'size': os.path.getsize(f), 'skip_lines': sorted(lines)}
+            for f, lines in zip(files, skip_lines)}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def read_dedup_plan(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def planned_skip_lines(plan, files):
+    """Return the ``skip_lines`` of ``files`` from a plan of ``write_dedup_plan``.
+
+    Raises ``ValueError`` for a file the plan doesn't know or whose size
+    changed, the line numbers would point at other records.
+    """
+    skip_lines = []
+    for jsonl_file_name in files:
+        planned = plan.get(input_key(jsonl_file_name))
+        if planned is None:
+            raise ValueError(f"{jsonl_file_name} is not in the dedup plan")
+        if planned['size'] != os.path.getsize(jsonl_file_name):
+            raise ValueError(f"{jsonl_file_name} changed since the dedup plan was made")
+        skip_lines.append(frozenset(planned['skip_lines']))
+    return skip_lines
+
+
+def parse_shard(text):
+    """Parse a ``--shard`` value, ``i/N`` with ``0 <= i < N``, into ``(i, N)``."""
+    m = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text or '')
+    if not m or not int(m.group(1)) < int(m.group(2)):
+        raise ValueError(f"invalid shard {text!r}, expected i/N with 0 <= i < N")
+    return int(m.group(1)), int(m.group(2))
+
+
+def input_key(jsonl_file_name):
+    """The name of a snapshot file wherever the snapshot is, ``works/updated_date=2023-05-17/part_003.gz``."""
+    return '/'.join(os.path.abspath(jsonl_file_name).split(os.sep)[-3:])
+
+
+def shard_of(jsonl_file_name, count):
+    """The shard, out of ``count``, a snapshot file belongs to.
+
+    A hash of ``input_key``, so every node computes the same assignment from
+    the file names alone, and the files of a new ``updated_date=`` partition
+    don't move the others.
+    """
+    return zlib.crc32(input_key(jsonl_file_name).encode('utf-8')) % count
+
+
+def input_number(jsonl_file_name):
+    """Number the output shards after their input file, ``updated_date=2023-05-17/part_003.gz -> 20230517003``.
+
+    The digits of the partition and of the file name, or a crc of the file
+    name if it has none, so the shards of every node have distinct names.
+    """
+    key = input_key(jsonl_file_name).split('/', 1)[-1]
+    return ''.join(re.findall(r'\d+', key)) or str(zlib.crc32(key.encode('utf-8')))
+
+
+def snapshot_digest(files):
+    """A digest of the ``input_key`` of every file of a snapshot, equal on the nodes that list the same snapshot."""
+    return hashlib.sha1('\n'.join(sorted(input_key(f) for f in files)).encode('utf-8')).hexdigest()
+
+
+def write_shard_manifest(path, name, shard, all_files, outputs, failures):
+    """Write the manifest of the files flattened by one shard of a run.
+
+    ``name`` tells the runs apart (``works``, ``entities``), ``shard`` is the
+    ``(i, N)`` of this node and ``all_files`` the whole snapshot listing, of
+    every node. ``outputs`` maps the input files of this shard to the
+    ``{file name: {'table', 'rows', 'bytes'}}`` they were flattened to, and
+    ``failures`` are the ``(jsonl_file_name, exception)`` that were not.
+    The file is replaced at once, so it is either complete or absent.
+    """
+    manifest = {
+        'name': name,
+        'shard': list(shard),
+        'host': socket.gethostname(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'snapshot_files': len(all_files),
+        'snapshot_digest': snapshot_digest(all_files),
+        'inputs': {input_key(f): {'outputs': files} for f, files in sorted(outputs.items())},
+        'failures': {input_key(f): repr(e) for f, e in failures},
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+class MemoryBudget:
+    """A byte budget for the row buffers of every worker of a run.
+
+    Buffers (parquet row groups, COPY buffers) report their size with
+    ``update``; the total is kept in ``used``, a ``multiprocessing.Value``
+    shared by the worker processes, in steps of ``GRANULE`` bytes. As soon as
+    the total goes over ``limit`` the worker flushes its own buffers, largest
+    first, and if that is not enough waits for the other workers to flush
+    theirs. A worker only waits once it holds nothing, so they can't all wait.
+    A total that stays over the limit without changing for ``STALL_SECONDS``
+    was left by a worker that died holding it, the wait then fails instead
+    of hanging the run.
+    """
+
+    GRANULE = 1 << 16
+    STALL_SECONDS = 300
+
+    def __init__(self, limit, used=None):
+        self.limit = limit
+        self.used = used if used is not None else multiprocessing.Value('q', 0)
+        self.wait_seconds = 0.0
+        # id(buffer) -> [buffer, charged bytes, owner thread], a thread only flushes its own buffers
+        self._charged = {}
+        self._lock = threading.Lock()
+        self._relieving = set()
+
+    def _add(self, nbytes):
+        with self.used.get_lock():
+            self.used.value += nbytes
+            return self.used.value
+
+    def update(self, buffer, nbytes):
+        """Account ``buffer`` at ``nbytes``, flush or wait if that takes the total over the limit."""
+        with self._lock:
+            entry = self._charged.setdefault(id(buffer), [buffer, 0, threading.get_ident()])
+            delta = nbytes - entry[1]
+            if nbytes and abs(delta) < self.GRANULE:
+                return
+            entry[1] = nbytes
+        if delta and self._add(delta) > self.limit and delta > 0:
+            self._relieve()
+
+    def release(self, buffer):
+        """Forget a closed buffer."""
+        with self._lock:
+            entry = self._charged.pop(id(buffer), None)
+        if entry is not None and entry[1]:
+            self._add(-entry[1])
+
+    def _relieve(self):
+        me = threading.get_ident()
+        if me in self._relieving:
+            return
+        self._relieving.add(me)
+        try:
+            with self._lock:
+                mine = sorted((entry for entry in self._charged.values() if entry[2] == me and entry[1]),
+                              key=lambda entry: entry[1], reverse=True)
+            for buffer, _, _ in mine:
+                buffer.flush()
+                if self.used.value <= self.limit:
+                    return
+            start = changed = time.perf_counter()
+            last = self.used.value
+            while last > self.limit:
+                time.sleep(0.005)
+                used = self.used.value
+                now = time.perf_counter()
+                if used != last:
+                    last, changed = used, now
+                elif now - changed > self.STALL_SECONDS:
+                    raise RuntimeError(f"memory budget stuck at {used} of {self.limit} bytes for "
+                                       f"{self.STALL_SECONDS}s, a worker holding part of it has died")
+            self.wait_seconds += time.perf_counter() - start
+        finally:
+            self._relieving.discard(me)
+
+
+_memory_budget = None
+
+
+def init_memory_budget(limit, used=None):
+    """Set the ``MemoryBudget`` of this process, the initializer of the worker pools.
+
+    Give every worker the same ``used`` value to share one budget between them,
+    a ``limit`` of None or 0 leaves the buffers unbounded by memory.
+    """
+    global _memory_budget
+    _memory_budget = MemoryBudget(limit, used) if limit else None
+
+
+def memory_budget():
+    return _memory_budget
+
+
+class TimedFile(io.RawIOBase):
+    """Binary file wrapper that counts the bytes written through it and the time spent.
+
+    Put around a gzip file it measures the compression. Text writers buffer
+    before writing, so that is a couple of clock reads per few KB.
+    """
+
+    def __init__(self, file):
+        super().__init__()
+        self.file = file
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.file.write(data)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.file is not None:
+            self.file.close()
+        super().close()
+
+
+class CsvTableWriter:
+    """Streaming CSV writer for one flattened table.
+
+    The compressed stream stays open for the life of the writer, so each output
+    file is a single gzip member and rows are written as they are produced,
+    without any per-batch DataFrame or file reopen.
+    """
+
+    def __init__(self, path, columns, codec='gzip', level=None, offload=None):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        self.raw = TimedFile(open_output(path, codec, level, offload))
+        self._file = io.TextIOWrapper(self.raw, encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file, lineterminator='\n')
+        self._writer.writerow(self.columns)
+
+    def write_rows(self, rows):
+        """Write a list of row tuples in column order, None becomes an empty field."""
+        self._writer.writerows(rows)
+        self.rows += len(rows)
+        return len(rows)
+
+    def close(self):
+        self._file.close()
+
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PG_NULL = struct.pack('>i', -1)
+PG_EPOCH = datetime(2000, 1, 1)
+
+_int16 = struct.Struct('>h')
+_int32 = struct.Struct('>i')
+_int4_field = struct.Struct('>ii')
+_int8_field = struct.Struct('>iq')
+_float4_field = struct.Struct('>if')
+
+
+def _encode_text(value):
+    data = str(value).encode('utf-8')
+    return _int32.pack(len(data)) + data
+
+
+def _encode_integer(value):
+    return _int4_field.pack(4, int(value))
+
+
+def _encode_bigint(value):
+    return _int8_field.pack(8, int(value))
+
+
+def _encode_real(value):
+    return _float4_field.pack(4, float(value))
+
+
+def _encode_boolean(value):
+    return b'\x00\x00\x00\x01\x01' if value in (True, 'true', 'True', 't') else b'\x00\x00\x00\x01\x00'
+
+
+def parse_timestamp(value):
+    """Parse an ISO timestamp for a ``timestamp without time zone`` column.
+
+    A value with an offset or ``Z`` is moved to UTC and made naive, so it can
+    be compared with ``PG_EPOCH``; ``fromisoformat`` only takes ``Z`` since
+    Python 3.11.
+    """
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _encode_timestamp(value):
+    delta = parse_timestamp(value) - PG_EPOCH
+    return _int8_field.pack(8, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+# binary encoders of the column types used in openalex-pg-schema.sql, json is sent as its text
+PG_BINARY_ENCODERS = {
+    'text': _encode_text,
+    'json': _encode_text,
+    'integer': _encode_integer,
+    'bigint': _encode_bigint,
+    'real': _encode_real,
+    'boolean': _encode_boolean,
+    'timestamp without time zone': _encode_timestamp,
+}
+
+
+class PgBinaryTableWriter:
+    """Streaming writer of PostgreSQL binary COPY data (``FORMAT binary``) for one table.
+
+    Values are converted to the column types of openalex-pg-schema.sql here, so
+    the server doesn't have to parse any text on load. Like the csv output,
+    None and empty strings are loaded as NULL.
+    """
+
+    def __init__(self, path, columns, column_types, codec='gzip', level=None, offload=None):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        self._encoders = [PG_BINARY_ENCODERS[column_types[column]] for column in self.columns]
+        self._field_count = _int16.pack(len(self.columns))
+        self._file = self.raw = TimedFile(open_output(path, codec, level, offload))
+        self._file.write(PGCOPY_HEADER)
+
+    def write_rows(self, rows):
+        """Write an iterable of row tuples in column order."""
+        encoders = self._encoders
+        field_count = self._field_count
+        parts = []
+        count = 0
+        for row in rows:
+            parts.append(field_count)
+            for value, encode in zip(row, encoders):
+                parts.append(PG_NULL if value is None or value == '' else encode(value))
+            count += 1
+        self._file.write(b''.join(parts))
+        self.rows += count
+        return count
+
+    def close(self):
+        self._file.write(PGCOPY_TRAILER)
+        self._file.close()
+
+
+def _to_bigint(value):
+    return int(value)
+
+
+def _to_real(value):
+    return float(value)
+
+
+def _to_boolean(value):
+    return value in (True, 'true', 'True', 't')
+
+
+def _to_timestamp(value):
+    return value if isinstance(value, datetime) else parse_timestamp(value)
+
+
+# arrow type and value conversion of the column types used in openalex-pg-schema.sql
+ARROW_TYPES = {
+    'text': ('string', str),
+    'json': ('string', str),
+    'integer': ('int32', _to_bigint),
+    'bigint': ('int64', _to_bigint),
+    'real': ('float32', _to_real),
+    'boolean': ('bool_', _to_boolean),
+    'timestamp without time zone': ('timestamp', _to_timestamp),
+}
+
+
+def arrow_schema(columns, column_types):
+    fields = []
+    for column in columns:
+        type_name = ARROW_TYPES[column_types[column]][0]
+        arrow_type = pyarrow.timestamp('us') if type_name == 'timestamp' else getattr(pyarrow, type_name)()
+        fields.append(pyarrow.field(column, arrow_type))
+    return pyarrow.schema(fields)
+
+
+class ParquetTableWriter:
+    """Streaming Parquet writer for one table, typed after openalex-pg-schema.sql.
+
+    Rows are gathered column by column, turned into compact arrow record
+    batches every ``batch_rows`` rows and written as a row group every
+    ``row_group_size`` rows, so memory stays bounded by one row group of arrow
+    data. With a ``budget`` the row group is also written early whenever the
+    ``MemoryBudget`` runs out. None and empty strings become nulls,
+    like in the other formats.
+    """
+
+    def __init__(self, path, columns, column_types, row_group_size=100000, compression='zstd', batch_rows=8192,
+                 budget=None):
+        if pyarrow is None:
+            raise RuntimeError("the parquet output needs pyarrow, pip install pyarrow")
+        self.path = path
+        self.columns = list(columns)
+        self.rows = 0
+        # the arrow size of the rows, compression happens inside write_table
+        self.raw = TimedFile(None)
+        self.row_group_size = row_group_size
+        self.batch_rows = batch_rows
+        self.budget = budget
+        self._converters = [ARROW_TYPES[column_types[column]][1] for column in self.columns]
+        self._schema = arrow_schema(self.columns, column_types)
+        self._values = [[] for _ in self.columns]
+        self._batches = []
+        self._batch_bytes = 0
+        self._pending = 0
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression=compression)
+
+    def write_rows(self, rows):
+        """Write an iterable of row tuples in column order."""
+        count = 0
+        for row in rows:
+            for value, convert, values in zip(row, self._converters, self._values):
+                values.append(None if value is None or value == '' else convert(value))
+            count += 1
+        self.rows += count
+        self._pending += count
+        if self._pending >= self.row_group_size:
+            self.flush()
+        elif len(self._values[0]) >= self.batch_rows:
+            self._seal()
+            if self.budget is not None:
+                self.budget.update(self, self._batch_bytes)
+        return count
+
+    def _seal(self):
+        """Turn the gathered python values into an arrow record batch."""
+        if not self._values[0]:
+            return
+        batch = pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(self._values, self._schema)],
+            schema=self._schema)
+        self._batches.append(batch)
+        self._batch_bytes += batch.nbytes
+        self._values = [[] for _ in self.columns]
+
+    def flush(self):
+        """Write the rows gathered so far as a row group."""
+        self._seal()
+        if not self._batches:
+            return
+        table = pyarrow.Table.from_batches(self._batches, schema=self._schema)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self.raw.bytes += table.nbytes
+        self._batches = []
+        self._batch_bytes = 0
+        self._pending = 0
+        if self.budget is not None:
+            self.budget.update(self, 0)
+
+    def close(self):
+        try:
+            self.flush()
+            self._writer.close()
+        finally:
+            if self.budget is not None:
+                self.budget.release(self)
+
+
+class TableWriters:
+    """A set of table writers keyed by table, opened from a file spec.
+
+    ``file_spec`` is the ``{table: {'name': path, 'columns': [...]}}`` mapping
+    used by the flatten scripts. With ``fmt='binary'`` the ``.csv.gz`` names
+    become ``.pgcopy.gz`` files of PostgreSQL binary COPY data, with
+    ``fmt='parquet'`` they become ``.parquet`` files. ``options`` are passed
+    on to the writers of that format: ``codec``, ``level`` and ``offload``
+    for csv and binary, where the codec also sets the file extension
+    (``.csv.zst``, ...), ``row_group_size`` and ``compression`` for parquet.
+    With ``compact_ids`` the OpenAlex ids are written as numbers.
+
+    With ``partitions`` the ``PARTITIONED_TABLES`` get one file per hash
+    partition instead, ``works_authorships_12.csv.gz`` becomes
+    ``works_authorships_p0_12.csv.gz`` ... and every row goes to the file of
+    the leaf table PostgreSQL would route its ``work_id`` to.
+
+    The parquet writers buffer a row group each, with a ``budget`` they share
+    that ``MemoryBudget`` with every other buffer of the run.
+    """
+
+    def __init__(self, file_spec, fmt='csv', options=None, compact_ids=False, partitions=0, budget=None):
+        self.writers = {}
+        self.partitions = {}
+        self.id_positions = {}
+        self.partition_keys = {}
+        options = options or {}
+        try:
+            for table, desc in file_spec.items():
+                if compact_ids:
+                    self.id_positions[table] = [i for i, column in enumerate(desc['columns']) if column in ID_COLUMNS]
+                key = table_key(desc['name'])
+                if partitions and key in PARTITIONED_TABLES:
+                    self.partition_keys[table] = desc['columns'].index(PARTITION_KEY)
+                    directory, file_name = os.path.split(desc['name'])
+                    self.partitions[table] = [
+                        self._open(os.path.join(directory, partition_table(key, remainder) + file_name[len(key):]),
+                                   desc['columns'], fmt, options, compact_ids, budget)
+                        for remainder in range(partitions)
+                    ]
+                else:
+                    self.writers[table] = self._open(desc['name'], desc['columns'], fmt, options, compact_ids,
+                                                     budget)
+        except BaseException:
+            self.close()
+            raise
+
+    @staticmethod
+    def _open(csv_name, columns, fmt, options, compact_ids, budget=None):
+        path = output_path(csv_name, fmt, options.get('codec', 'gzip'))
+        if fmt == 'csv':
+            return CsvTableWriter(path, columns, **options)
+        key = table_key(path)
+        column_types = load_column_types(compact_ids=compact_ids)[partition_parent(key) or key]
+        if fmt == 'binary':
+            return PgBinaryTableWriter(path, columns, column_types, **options)
+        return ParquetTableWriter(path, columns, column_types, budget=budget, **options)
+
+    def write(self, table, rows):
+        if self.id_positions.get(table):
+            rows = compact_rows(rows, self.id_positions[table])
+        if table in self.partitions:
+            return self._write_partitions(self.partitions[table], rows, self.partition_keys[table])
+        return self.writers[table].write_rows(rows)
+
+    @staticmethod
+    def _write_partitions(writers, rows, position):
+        keys = [row[position] for row in rows]
+        if keys.count(keys[0]) == len(keys):
+            # the usual case, all the child rows of one work
+            return writers[hash_partition(keys[0], len(writers))].write_rows(rows)
+        partition_rows = defaultdict(list)
+        for key, row in zip(keys, rows):
+            partition_rows[hash_partition(key, len(writers))].append(row)
+        return sum(writers[remainder].write_rows(leaf_rows) for remainder, leaf_rows in partition_rows.items())
+
+    def all_writers(self):
+        yield from self.writers.values()
+        for writers in self.partitions.values():
+            yield from writers
+
+    def row_counts(self):
+        counts = {table: writer.rows for table, writer in self.writers.items()}
+        counts.update((table, sum(writer.rows for writer in writers)) for table, writers in self.partitions.items())
+        return counts
+
+    def table_stats(self):
+        """Rows, uncompressed and file bytes and compression time of every table, once closed.
+
+        The files of the partitions of a table are summed up under the table.
+        """
+        stats = {}
+        for writer in self.all_writers():
+            key = table_key(writer.path)
+            table_stats = stats.setdefault(partition_parent(key) or key, dict.fromkeys(
+                ['rows', 'bytes_raw', 'bytes_out', 'compress_seconds'], 0))
+            table_stats['rows'] += writer.rows
+            table_stats['bytes_raw'] += writer.raw.bytes
+            table_stats['bytes_out'] += os.path.getsize(writer.path)
+            table_stats['compress_seconds'] += writer.raw.seconds
+        return stats
+
+    def file_stats(self):
+        """``{file name: {'table', 'rows', 'bytes'}}`` of every file written, once closed."""
+        return {
+            os.path.basename(writer.path): {'table': table_key(writer.path), 'rows': writer.rows,
+                                            'bytes': os.path.getsize(writer.path)}
+            for writer in self.all_writers()
+        }
+
+    def close(self):
+        for writer in self.all_writers():
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     openalex_metrics
+   Description :  per stage and per table counters of the flatten scripts,
+                  merged across workers and dumped as json or prometheus text
+-------------------------------------------------
+"""
+import json
+import os
+import time
+from collections import Counter
+
+# stages of a flatten loop, in order. read is the gzip decompression and line
+# split of the input, filter the --where test of the raw lines, encode the
+# csv/binary/parquet encoding of the rows and compress the gzip compression of
+# the output
+STAGES = ['read', 'filter', 'decode', 'process', 'encode', 'compress']
+
+
+class StageClock:
+    """Split the wall time of a loop between stages, one ``perf_counter`` call per stage.
+
+    Every ``lap(stage)`` charges the time since the previous lap to ``stage``.
+    """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.seconds[stage] += now - self._last
+        self._last = now
+
+
+class Metrics:
+    """Counters of a run keyed by name and labels.
+
+    ``values`` is a plain ``Counter`` of ``(name, labels) -> value``, so a worker
+    process returns it with its result and the parent ``merge``s it.
+    """
+
+    def __init__(self, values=None):
+        self.values = Counter(values or {})
+
+    def add(self, name, value, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] += value
+
+    def merge(self, values):
+        self.values.update(values)
+
+    def add_file(self, entity, jsonl_file_name, records, bytes_read, clock, writers):
+        """Record one flattened input file: its stage times and the rows and bytes of every table.
+
+        The write time of ``clock`` is split between ``encode`` and the
+        ``compress`` time measured by the ``writers``.
+        """
+        table_stats = writers.table_stats()
+        compress = sum(stats['compress_seconds'] for stats in table_stats.values())
+        seconds = dict(clock.seconds)
+        seconds['compress'] = min(compress, seconds['encode'])
+        seconds['encode'] -= seconds['compress']
+
+        self.add('files', 1, entity=entity)
+        self.add('records', records, entity=entity)
+        self.add('bytes_in', os.path.getsize(jsonl_file_name), entity=entity, encoding='gzip')
+        self.add('bytes_in', bytes_read, entity=entity, encoding='none')
+        for stage, stage_seconds in seconds.items():
+            self.add('stage_seconds', stage_seconds, entity=entity, stage=stage)
+        for table, stats in table_stats.items():
+            self.add('rows', stats['rows'], table=table)
+            self.add('bytes_out', stats['bytes_raw'], table=table, encoding='none')
+            self.add('bytes_out', stats['bytes_out'], table=table, encoding='file')
+
+    def to_json(self):
+        return {
+            'time': time.time(),
+            'metrics': [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.values.items())],
+        }
+
+    def to_prometheus(self, prefix='openalex_flatten_'):
+        lines = []
+        last_name = None
+        for (name, labels), value in sorted(self.values.items()):
+            metric = f"{prefix}{name}_total"
+            if name != last_name:
+                lines.append(f"# TYPE {metric} counter")
+                last_name = name
+            label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{metric}{{{label_text}}} {value:g}" if label_text else f"{metric} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """A text table of the time per stage and the rows and bytes per table."""
+        stage_seconds = Counter()
+        rows, bytes_out, records, bytes_in = Counter(), Counter(), Counter(), Counter()
+        for (name, labels), value in self.values.items():
+            labels = dict(labels)
+            if name == 'stage_seconds':
+                stage_seconds[labels['stage']] += value
+            elif name == 'records':
+                records[labels['entity']] += value
+            elif name == 'bytes_in' and labels['encoding'] == 'gzip':
+                bytes_in[labels['entity']] += value
+            elif name == 'rows':
+                rows[labels['table']] += value
+            elif name == 'bytes_out' and labels['encoding'] == 'file':
+                bytes_out[labels['table']] += value
+
+        lines = []
+        total = sum(stage_seconds.values()) or 1
+        lines.append("stage        seconds  share  (summed over workers)")
+        for stage in STAGES:
+            lines.append(f"{stage:10s} {stage_seconds[stage]:9.1f} {stage_seconds[stage] / total:6.1%}")
+        for entity in sorted(records):
+            lines.append(f"{entity}: {records[entity]:.0f} records, {bytes_in[entity] / 1e6:.1f} MB in")
+        lines.append(f"{'table':40s} {'rows':>12s} {'MB out':>10s}")
+        for table in sorted(rows):
+            lines.append(f"{table:40s} {rows[table]:12.0f} {bytes_out[table] / 1e6:10.1f}")
+        return '\n'.join(lines)
+
+
+class MetricsDump:
+    """Write the metrics to ``path`` at most every ``interval`` seconds.
+
+    ``.prom`` files get the prometheus text format (for the node_exporter
+    textfile collector), anything else json. The file is replaced atomically.
+    """
+
+    def __init__(self, path, interval=30):
+        self.path = path
+        self.interval = interval
+        self._last = time.monotonic()
+
+    def maybe_write(self, metrics):
+        if time.monotonic() - self._last >= self.interval:
+            self.write(metrics)
+
+    def write(self, metrics):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            if self.path.endswith('.prom'):
+                f.write(metrics.to_prometheus())
+            else:
+                json.dump(metrics.to_json(), f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._last = time.monotonic()
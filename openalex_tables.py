@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     openalex_tables
+   Description :  the one registry of the flattened tables, their columns drive
+                  the row extractors, the output files and the COPY statements
+-------------------------------------------------
+"""
+import fnmatch
+import json
+import os
+from functools import lru_cache
+
+from openalex_io import load_column_types
+
+LOCATION_COLUMNS = ['work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa', 'version', 'license']
+
+COUNTS_BY_YEAR_COLUMNS = ['year', 'works_count', 'cited_by_count', 'oa_works_count']
+
+# {entity: {key: table}}, the table of a key is openalex.<entity>_<key>, or
+# openalex.<entity> for the entity itself. Every row is a tuple in the order of
+# ``columns``: the ``given`` columns are passed in by the flatten code, the
+# others are read from the record by their name, or by the ``a.b`` path of
+# ``fields``. Tables made of given columns only are built as tuples in place.
+TABLES = {
+    'authors': {
+        'authors': {
+            'columns': ['id', 'orcid', 'display_name', 'display_name_alternatives', 'works_count', 'cited_by_count',
+                        'last_known_institution', 'works_api_url', 'updated_date'],
+            'fields': {'last_known_institution': 'last_known_institution.id'},
+        },
+        'ids': {
+            'columns': ['author_id', 'openalex', 'orcid', 'scopus', 'twitter', 'wikipedia', 'mag'],
+            'given': ['author_id'],
+        },
+        'counts_by_year': {
+            'columns': ['author_id', *COUNTS_BY_YEAR_COLUMNS],
+            'given': ['author_id'],
+        },
+    },
+    'concepts': {
+        'concepts': {
+            'columns': ['id', 'wikidata', 'display_name', 'level', 'description', 'works_count', 'cited_by_count',
+                        'image_url', 'image_thumbnail_url', 'works_api_url', 'updated_date'],
+        },
+        'ancestors': {
+            'columns': ['concept_id', 'ancestor_id'],
+            'given': ['concept_id', 'ancestor_id'],
+        },
+        'counts_by_year': {
+            'columns': ['concept_id', *COUNTS_BY_YEAR_COLUMNS],
+            'given': ['concept_id'],
+        },
+        'ids': {
+            'columns': ['concept_id', 'openalex', 'wikidata', 'wikipedia', 'umls_aui', 'umls_cui', 'mag'],
+            'given': ['concept_id'],
+        },
+        'related_concepts': {
+            'columns': ['concept_id', 'related_concept_id', 'score'],
+            'given': ['concept_id', 'related_concept_id'],
+        },
+    },
+    'institutions': {
+        'institutions': {
+            'columns': ['id', 'ror', 'display_name', 'country_code', 'type', 'homepage_url', 'image_url',
+                        'image_thumbnail_url', 'display_name_acroynyms', 'display_name_alternatives', 'works_count',
+                        'cited_by_count', 'works_api_url', 'updated_date'],
+        },
+        'ids': {
+            'columns': ['institution_id', 'openalex', 'ror', 'grid', 'wikipedia', 'wikidata', 'mag'],
+            'given': ['institution_id'],
+        },
+        'geo': {
+            'columns': ['institution_id', 'city', 'geonames_city_id', 'region', 'country_code', 'country',
+                        'latitude', 'longitude'],
+            'given': ['institution_id'],
+        },
+        'associated_institutions': {
+            'columns': ['institution_id', 'associated_institution_id', 'relationship'],
+            'given': ['institution_id', 'associated_institution_id'],
+        },
+        'counts_by_year': {
+            'columns': ['institution_id', *COUNTS_BY_YEAR_COLUMNS],
+            'given': ['institution_id'],
+        },
+    },
+    'publishers': {
+        'publishers': {
+            'columns': ['id', 'display_name', 'alternate_titles', 'country_codes', 'hierarchy_level',
+                        'parent_publisher', 'works_count', 'cited_by_count', 'sources_api_url', 'updated_date'],
+        },
+        'counts_by_year': {
+            'columns': ['publisher_id', *COUNTS_BY_YEAR_COLUMNS],
+            'given': ['publisher_id'],
+        },
+        'ids': {
+            'columns': ['publisher_id', 'openalex', 'ror', 'wikidata'],
+            'given': ['publisher_id'],
+        },
+    },
+    'sources': {
+        'sources': {
+            'columns': ['id', 'issn_l', 'issn', 'display_name', 'publisher', 'works_count', 'cited_by_count', 'is_oa',
+                        'is_in_doaj', 'homepage_url', 'works_api_url', 'updated_date'],
+        },
+        'ids': {
+            'columns': ['source_id', 'openalex', 'issn_l', 'issn', 'mag', 'wikidata', 'fatcat'],
+            'given': ['source_id'],
+        },
+        'counts_by_year': {
+            'columns': ['source_id', *COUNTS_BY_YEAR_COLUMNS],
+            'given': ['source_id'],
+        },
+    },
+    'works': {
+        'works': {
+            # abstract_inverted_index is left out, see works_abstracts
+            'columns': ['id', 'doi', 'title', 'display_name', 'publication_year', 'publication_date', 'type',
+                        'cited_by_count', 'is_retracted', 'is_paratext', 'cited_by_api_url'],
+        },
+        'primary_locations': {'columns': LOCATION_COLUMNS, 'given': ['work_id', 'source_id']},
+        'locations': {'columns': LOCATION_COLUMNS, 'given': ['work_id', 'source_id']},
+        'best_oa_locations': {'columns': LOCATION_COLUMNS, 'given': ['work_id', 'source_id']},
+        'authorships': {
+            'columns': ['work_id', 'author_position', 'author_id', 'institution_id', 'raw_affiliation_string'],
+            'given': ['work_id', 'author_id', 'institution_id'],
+        },
+        'biblio': {
+            'columns': ['work_id', 'volume', 'issue', 'first_page', 'last_page'],
+            'given': ['work_id'],
+        },
+        'concepts': {
+            'columns': ['work_id', 'concept_id', 'score'],
+            'given': ['work_id', 'concept_id'],
+        },
+        'ids': {
+            'columns': ['work_id', 'openalex', 'doi', 'mag', 'pmid', 'pmcid'],
+            'given': ['work_id'],
+        },
+        'mesh': {
+            'columns': ['work_id', 'descriptor_ui', 'descriptor_name', 'qualifier_ui', 'qualifier_name',
+                        'is_major_topic'],
+            'given': ['work_id'],
+        },
+        'open_access': {
+            'columns': ['work_id', 'is_oa', 'oa_status', 'oa_url', 'any_repository_has_fulltext'],
+            'given': ['work_id'],
+        },
+        'referenced_works': {
+            'columns': ['work_id', 'referenced_work_id'],
+            'given': ['work_id', 'referenced_work_id'],
+        },
+        'related_works': {
+            'columns': ['work_id', 'related_work_id'],
+            'given': ['work_id', 'related_work_id'],
+        },
+        # only written with --abstracts
+        'abstracts': {
+            'columns': ['work_id', 'abstract'],
+            'given': ['work_id', 'abstract'],
+            'optional': True,
+        },
+    },
+}
+
+
+def table_name(entity, key):
+    """Map a flattener table key to its ``openalex.*`` table, e.g. ``('works', 'ids') -> 'works_ids'``."""
+    return entity if key == entity else f"{entity}_{key}"
+
+
+def select_tables(include=None, exclude=None):
+    """Return the set of ``openalex.*`` tables picked by ``include`` minus ``exclude``, or None for all of them.
+
+    Both are lists of table names or fnmatch patterns (``works_*``,
+    ``*_counts_by_year``), no ``include`` picks every table. Raises
+    ``ValueError`` for a pattern that matches no table, likely a typo.
+    """
+    if not include and not exclude:
+        return None
+    all_tables = [table_name(entity, key) for entity, tables in TABLES.items() for key in tables]
+    picked = set()
+    for patterns, add in ((include or ['*'], True), (exclude or [], False)):
+        for pattern in patterns:
+            matched = fnmatch.filter(all_tables, pattern)
+            if not matched:
+                raise ValueError(f"no table matches {pattern!r}")
+            if add:
+                picked.update(matched)
+            else:
+                picked.difference_update(matched)
+    return picked
+
+
+def table_keys(entity, tables=None):
+    """Return the keys of ``entity`` whose table is in ``tables``, every key if it is None."""
+    return {key for key in TABLES[entity] if tables is None or table_name(entity, key) in tables}
+
+
+def file_spec(entity, csv_dir, suffix='', optional=False, tables=None):
+    """Return the ``{key: {'name': path, 'columns': [...]}}`` spec of the files of ``entity``.
+
+    The files are named after their table, ``<table><suffix>.csv.gz``, the
+    ``optional`` tables (``works_abstracts``) are only included if asked, and
+    with ``tables`` (see ``select_tables``) only those tables are.
+    """
+    return {
+        key: {'name': os.path.join(csv_dir, f'{table_name(entity, key)}{suffix}.csv.gz'), 'columns': desc['columns']}
+        for key, desc in TABLES[entity].items()
+        if (optional or not desc.get('optional')) and (tables is None or table_name(entity, key) in tables)
+    }
+
+
+def copy_statements():
+    """Return the csv ``COPY ... FROM STDIN`` statement of every table, keyed by table."""
+    return {
+        table_name(entity, key): (f"Copy openalex.{table_name(entity, key)} ({', '.join(desc['columns'])}) "
+                                  "from stdin WITH CSV HEADER DELIMITER as ','")
+        for entity, tables in TABLES.items()
+        for key, desc in tables.items()
+    }
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def compile_extractor(columns, given=(), fields=None, json_columns=()):
+    """Compile ``extract(record, *given)``, which returns the row tuple of a table.
+
+    The function is generated with one ``record.get`` per column, so building
+    a row costs no dict and no loop over the columns. The ``given`` values
+    come in their column order. ``fields`` maps a column to the ``a.b`` path
+    it is read from, and the ``json_columns`` are dumped to json text.
+    """
+    fields = fields or {}
+    values = []
+    for column in columns:
+        if column in given:
+            values.append(column)
+            continue
+        first, *rest = fields.get(column, column).split('.')
+        value = f"get({first!r})"
+        for key in rest:
+            value = f"({value} or EMPTY).get({key!r})"
+        values.append(f"dumps({value})" if column in json_columns else value)
+    arguments = ', '.join(['record', *(column for column in columns if column in given)])
+    source = f"def extract({arguments}):\n    get = record.get\n    return ({', '.join(values)},)\n"
+    namespace = {'EMPTY': {}, 'dumps': _dumps}
+    exec(compile(source, f'<extract {", ".join(columns)}>', 'exec'), namespace)
+    return namespace['extract']
+
+
+@lru_cache(maxsize=None)
+def row_extractors(entity):
+    """Return ``{key: extract}`` for the tables of ``entity`` that read a record.
+
+    The columns typed ``json`` in openalex-pg-schema.sql are dumped to json.
+    """
+    column_types = load_column_types()
+    extractors = {}
+    for key, desc in TABLES[entity].items():
+        given = desc.get('given', [])
+        if len(given) == len(desc['columns']):
+            continue
+        types = column_types[table_name(entity, key)]
+        json_columns = [column for column in desc['columns'] if types.get(column) == 'json']
+        extractors[key] = compile_extractor(desc['columns'], given, desc.get('fields'), json_columns)
+    return extractors
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     stream_jsonl_to_postgresql
+   Description :  flatten the snapshot jsonl and COPY the rows straight into
+                  postgresql, without writing intermediate csv files
+-------------------------------------------------
+"""
+import argparse
+import csv
+import glob
+import io
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import psycopg2
+import tqdm
+
+from import_csv_to_postgresql import DB_CONFIG, sql_map
+from openalex_io import (ID_COLUMNS, NO_DEDUP_WARNING, READERS, WorkFilter, compact_rows, decode_work,
+                         init_memory_budget, load_script, loads, memory_budget, open_jsonl, plan_latest)
+from openalex_tables import file_spec, select_tables, table_keys, table_name
+
+works_script = load_script('flatten-openalex-works-to-csv.py', 'flatten_openalex_works_to_csv')
+other_script = load_script('flatten-openalex-other-jsonl.py', 'flatten_openalex_other_jsonl')
+
+ENTITIES = ['works', 'authors', 'concepts', 'institutions', 'publishers', 'sources']
+
+PROCESSORS = {'works': works_script.process_work, **other_script.ENTITY_PROCESSORS}
+
+# works skip their abstract_inverted_index, which none of the tables use
+DECODERS = {entity: decode_work if entity == 'works' else loads for entity in ENTITIES}
+
+
+def get_file_spec(entity, tables=None, optional=False):
+    return file_spec(entity, '', optional=optional, tables=tables)
+
+
+class CopyBuffer:
+    """Bounded in-memory csv buffer for one table, flushed with ``COPY ... FROM STDIN``.
+
+    Rows are encoded exactly like the csv files, so the ``sql_map`` statements
+    are reused as is, pointed at ``schema`` instead of ``openalex`` if asked.
+    The buffer is sent to the server as soon as it holds ``max_bytes`` of text,
+    or earlier when the ``budget`` shared by all the buffers of the run is used
+    up. With ``compact_ids`` the OpenAlex ids are sent as numbers.
+    """
+
+    def __init__(self, cursor, table, columns, max_bytes, schema='openalex', compact_ids=False, budget=None):
+        self.cursor = cursor
+        self.sql = sql_map[table].replace('openalex.', f'{schema}.', 1)
+        self.columns = list(columns)
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.id_positions = [i for i, column in enumerate(self.columns) if column in ID_COLUMNS] if compact_ids else []
+        self.rows = 0
+        self._pending = 0
+        # csv text encoded as it is written, so its size and the budget are counted in bytes
+        self._buffer = io.BytesIO()
+        self._text = io.TextIOWrapper(self._buffer, encoding='utf-8', newline='', write_through=True)
+        self._writer = csv.writer(self._text, lineterminator='\n')
+        self._reset()
+
+    def _reset(self):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        # the sql_map statements use HEADER, so every COPY chunk starts with one
+        self._writer.writerow(self.columns)
+        self._pending = 0
+
+    def write_rows(self, rows):
+        if self.id_positions:
+            rows = compact_rows(rows, self.id_positions)
+        self._writer.writerows(rows)
+        self._pending += len(rows)
+        if self._buffer.tell() >= self.max_bytes:
+            self.flush()
+        elif self.budget is not None:
+            self.budget.update(self, self._buffer.tell())
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._buffer.seek(0)
+        self.cursor.copy_expert(sql=self.sql, file=self._buffer)
+        self.rows += self._pending
+        self._reset()
+        if self.budget is not None:
+            self.budget.update(self, 0)
+
+    def close(self):
+        if self.budget is not None:
+            self.budget.release(self)
+
+
+def load_files(entity, jsonl_files, buffer_bytes, compact_ids=False, reader='inline', readahead=4,
+               skip_lines=None, where=None, tables=None):
+    """Stream ``jsonl_files`` of one entity into postgresql on a dedicated connection.
+
+    Each input file is loaded in its own transaction. ``skip_lines`` holds, for
+    every file, the numbers of the non blank lines to leave out, see
+    ``plan_latest``. With ``where`` only the works matching those predicates
+    are loaded, see ``WorkFilter``. With ``tables`` only those tables are
+    computed and loaded. Returns the committed row counts per table and the list of
+    ``(jsonl_file_name, error)`` failures.
+    """
+    process_record = PROCESSORS[entity]
+    decode = DECODERS[entity]
+    file_spec = get_file_spec(entity, tables)
+    keys = table_keys(entity, tables)
+    skip_lines = skip_lines or [frozenset()] * len(jsonl_files)
+    budget = memory_budget()
+    work_filter = WorkFilter(where) if where and entity == 'works' else None
+    row_counts = Counter()
+    failures = []
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        for jsonl_file_name, file_skip_lines in zip(jsonl_files, skip_lines):
+            line_no = -1
+            buffers = {}
+            try:
+                with conn.cursor() as cur:
+                    buffers = {
+                        key: CopyBuffer(cur, table_name(entity, key), desc['columns'], buffer_bytes,
+                                        compact_ids=compact_ids, budget=budget)
+                        for key, desc in file_spec.items()
+                    }
+                    with open_jsonl(jsonl_file_name, reader, readahead) as jsonl:
+                        for record_json in jsonl:
+                            if not record_json.strip():
+                                continue
+                            line_no += 1
+                            if line_no in file_skip_lines:
+                                continue
+                            if work_filter is not None and not work_filter.match_raw(record_json):
+                                continue
+
+                            record = decode(record_json)
+                            if not record.get('id'):
+                                continue
+                            if work_filter is not None and not work_filter.match(record):
+                                continue
+
+                            for key, values in process_record(record, keys=keys):
+                                if values:
+                                    buffers[key].write_rows(values)
+                    for buffer in buffers.values():
+                        buffer.flush()
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                failures.append((jsonl_file_name, repr(e)))
+                continue
+            finally:
+                for buffer in buffers.values():
+                    buffer.close()
+
+            for key, buffer in buffers.items():
+                row_counts[table_name(entity, key)] += buffer.rows
+    finally:
+        conn.close()
+    return row_counts, failures
+
+
+def plan_tasks(snapshot_dir, entities, pool=None, dedup_dir=None, tables=None):
+    """Split the snapshot into one ``(entity, [file], [skip_lines])`` task per file.
+
+    With a ``pool`` the files of every entity are first scanned by
+    ``plan_latest``, so that only the newest copy of a record is loaded
+    whichever worker gets its file. The entities without any of the
+    ``tables`` are left out.
+    """
+    tasks = []
+    for entity in entities:
+        if not table_keys(entity, tables):
+            continue
+        files = sorted(glob.glob(os.path.join(snapshot_dir, 'data', entity, '*', '*.gz')))
+        if not files:
+            continue
+        skip_lines = plan_latest(pool, files, dedup_dir) if pool is not None else [frozenset()] * len(files)
+        tasks.extend((entity, [jsonl_file_name], [file_skip_lines])
+                     for jsonl_file_name, file_skip_lines in zip(files, skip_lines))
+    return tasks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="stream_jsonl_to_postgresql")
+    parser.add_argument("--snapshot_dir", type=str, default="./data/openalex/openalex-snapshot",
+                        help="snapshot_dir")
+    parser.add_argument("--entities", type=str, nargs='+', choices=ENTITIES, default=ENTITIES,
+                        help="entities to load")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes, each one holds its own connection")
+    parser.add_argument("--buffer_mb", type=float, default=8,
+                        help="max size of the in-memory COPY buffer of each table, in MB")
+    parser.add_argument("--memory_budget_mb", type=float, default=None,
+                        help="bound the COPY buffers of all the workers together, in MB, a worker sends its "
+                             "largest buffers or waits when they go over it")
+    parser.add_argument("--compact_ids", action="store_true",
+                        help="load the OpenAlex ids as bigint numbers into a schema altered with "
+                             "openalex-pg-schema-compact-ids.sql")
+    parser.add_argument("--no_dedup", action="store_true",
+                        help="load every copy of a record instead of the one of the newest updated_date partition, "
+                             "the primary keys of openalex-pg-indexes.sql then fail to build")
+    parser.add_argument("--dedup_dir", type=str, default=None,
+                        help="directory of the id bitmap of the deduplication, the temporary directory by default")
+    parser.add_argument("--where", type=str, action='append', default=None,
+                        help="only load the works matching this predicate, repeat it for several, see "
+                             "flatten-openalex-works-to-csv.py --where")
+    parser.add_argument("--tables", type=str, nargs='+', default=None,
+                        help="only compute and load these tables, names or patterns of the openalex tables")
+    parser.add_argument("--exclude_tables", type=str, nargs='+', default=None,
+                        help="don't compute nor load these tables, e.g. '*_counts_by_year'")
+    parser.add_argument("--reader", type=str, choices=READERS, default='inline',
+                        help="inflate the input inline, ahead on a thread, or in an external pigz/gzip process")
+    parser.add_argument("--readahead", type=int, default=4,
+                        help="blocks of 4MB of inflated lines the thread/process reader keeps ready")
+    args = parser.parse_args()
+    try:
+        WorkFilter(args.where or [])
+        tables = select_tables(args.tables, args.exclude_tables)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.no_dedup:
+        print(NO_DEDUP_WARNING)
+
+    buffer_bytes = int(args.buffer_mb * 1024 * 1024)
+    total_rows = Counter()
+    all_failures = []
+    memory_budget_bytes = int(args.memory_budget_mb * 1024 * 1024) if args.memory_budget_mb else None
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_memory_budget,
+                             initargs=(memory_budget_bytes, multiprocessing.Value('q', 0))) as pool:
+        tasks = plan_tasks(args.snapshot_dir, args.entities, None if args.no_dedup else pool, args.dedup_dir,
+                           tables)
+        futures = {pool.submit(load_files, entity, files, buffer_bytes, args.compact_ids, args.reader,
+                               args.readahead, skip_lines, args.where, tables): files
+                   for entity, files, skip_lines in tasks}
+        with tqdm.tqdm(total=len(tasks), desc="Loading", unit="file") as progress:
+            for future in as_completed(futures):
+                try:
+                    row_counts, failures = future.result()
+                except Exception as e:
+                    row_counts, failures = {}, [(jsonl_file_name, repr(e)) for jsonl_file_name in futures[future]]
+                total_rows.update(row_counts)
+                all_failures.extend(failures)
+                progress.update(len(futures[future]))
+
+    for table, rows in sorted(total_rows.items()):
+        print(f"{table}: {rows} rows")
+    if all_failures:
+        print(f"{len(all_failures)} files failed:")
+        for jsonl_file_name, error in all_failures:
+            print(f"  {jsonl_file_name}: {error}")
+        raise SystemExit(1)
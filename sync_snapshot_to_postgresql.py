@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+-------------------------------------------------
+   File Name：     sync_snapshot_to_postgresql
+   Description :  incremental refresh of the openalex tables from the snapshot
+                  partitions newer than the last sync
+-------------------------------------------------
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+import psycopg2
+
+from import_csv_to_postgresql import DB_CONFIG
+from openalex_io import IdBitmap, decode_work, list_partitions, open_jsonl, record_number
+from stream_jsonl_to_postgresql import DECODERS, ENTITIES, PROCESSORS, CopyBuffer, get_file_spec, table_name
+
+STAGING_SCHEMA = 'openalex_staging'
+
+SYNC_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS openalex.sync_state (
+    entity text PRIMARY KEY,
+    watermark text NOT NULL,
+    synced_at timestamp without time zone DEFAULT now()
+)
+"""
+
+
+def get_watermark(conn, entity):
+    with conn.cursor() as cur:
+        cur.execute("SELECT watermark FROM openalex.sync_state WHERE entity = %s", (entity,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(conn, entity, watermark):
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO openalex.sync_state (entity, watermark, synced_at) VALUES (%s, %s, now())
+            ON CONFLICT (entity) DO UPDATE SET watermark = EXCLUDED.watermark, synced_at = EXCLUDED.synced_at
+        """, (entity, watermark))
+    conn.commit()
+
+
+def has_abstracts(conn):
+    """Whether the db has an ``openalex.works_abstracts`` table to keep in sync."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('openalex.works_abstracts') IS NOT NULL")
+        exists = cur.fetchone()[0]
+    conn.commit()
+    return exists
+
+
+def entity_tables(entity, abstracts=False):
+    """Return ``[(table, key_column)]`` for an entity, the parent table first.
+
+    Child tables reference the parent through their first column (``work_id``,
+    ``author_id``, ...). ``works_abstracts`` is only included with ``abstracts``.
+    """
+    tables = []
+    for key, desc in get_file_spec(entity, optional=abstracts).items():
+        if key == entity:
+            tables.insert(0, (entity, 'id'))
+        else:
+            tables.append((table_name(entity, key), desc['columns'][0]))
+    return tables
+
+
+def stage_entity(entity, partitions, buffer_bytes, compact_ids=False, abstracts=False):
+    """COPY the records of ``partitions`` into fresh ``openalex_staging`` tables.
+
+    Partitions are read newest first and only the first copy of each id is
+    kept, so the staging tables hold the latest version of every changed
+    entity. The ids seen are kept in an ``IdBitmap``, ids without a number in
+    a set. With ``abstracts`` the plain text abstracts of the works are
+    staged too. Returns the number of staged entities.
+    """
+    process_record = PROCESSORS[entity]
+    decode = DECODERS[entity]
+    if abstracts:
+        process_record = partial(process_record, abstracts=True)
+        decode = partial(decode_work, with_abstract=True)
+    file_spec = get_file_spec(entity, optional=abstracts)
+    seen_numbers = IdBitmap()
+    seen_ids = set()
+    staged = 0
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {STAGING_SCHEMA}")
+            for table, _ in entity_tables(entity, abstracts):
+                cur.execute(f"DROP TABLE IF EXISTS {STAGING_SCHEMA}.{table}")
+                cur.execute(f"CREATE UNLOGGED TABLE {STAGING_SCHEMA}.{table} (LIKE openalex.{table})")
+            buffers = {
+                key: CopyBuffer(cur, table_name(entity, key), desc['columns'], buffer_bytes, schema=STAGING_SCHEMA,
+                                compact_ids=compact_ids)
+                for key, desc in file_spec.items()
+            }
+            for _, files in reversed(partitions):
+                for jsonl_file_name in reversed(files):
+                    with open_jsonl(jsonl_file_name) as jsonl:
+                        for record_json in jsonl:
+                            if not record_json.strip():
+                                continue
+
+                            record = decode(record_json)
+
+                            if not (record_id := record.get('id')):
+                                continue
+                            if (number := record_number(record_id)) >= 0:
+                                if seen_numbers.add(number):
+                                    continue
+                            elif record_id in seen_ids:
+                                continue
+                            else:
+                                seen_ids.add(record_id)
+                            staged += 1
+
+                            for key, values in process_record(record):
+                                if values:
+                                    buffers[key].write_rows(values)
+            for buffer in buffers.values():
+                buffer.flush()
+            for table, _ in entity_tables(entity, abstracts):
+                cur.execute(f"ANALYZE {STAGING_SCHEMA}.{table}")
+        conn.commit()
+    finally:
+        conn.close()
+        seen_numbers.close()
+    return staged
+
+
+def ensure_key_indexes(conn, entity, abstracts=False):
+    """Index the key column of every table of ``entity`` that has no index starting with it.
+
+    The merge deletes the changed entities from every child table by
+    ``work_id``, ``author_id``, ..., several of which openalex-pg-indexes.sql
+    doesn't index, so each batch would scan those tables in full. The
+    indexes are named like the ones of that file, ``<table>_<column>_idx``,
+    and built once, later syncs find them. Returns the indexes created.
+    """
+    created = []
+    with conn.cursor() as cur:
+        for table, key_column in entity_tables(entity, abstracts):
+            cur.execute("""
+                SELECT EXISTS (
+                    SELECT FROM pg_index i JOIN pg_class c ON c.oid = i.indrelid
+                    JOIN pg_namespace n ON n.oid = c.relnamespace
+                    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+                    WHERE n.nspname = 'openalex' AND c.relname = %s AND a.attname = %s
+                )
+            """, (table, key_column))
+            if cur.fetchone()[0]:
+                continue
+            index = f"{table}_{key_column}_idx"
+            print(f"{entity}: creating {index}, {table} has no index on {key_column}")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {index} ON openalex.{table} ({key_column})")
+            conn.commit()
+            created.append(index)
+    conn.commit()
+    return created
+
+
+def merge_entity(conn, entity, batches, abstracts=False):
+    """Replace the changed entities and all their child rows with the staged version.
+
+    The staged ids are split into ``batches`` by hash and every batch is one
+    transaction of set-based DELETE ... USING / INSERT ... SELECT statements,
+    so a rerun after a crash just merges the same batches again.
+    """
+    tables = entity_tables(entity, abstracts)
+    for batch in range(batches):
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TEMP TABLE sync_ids ON COMMIT DROP AS
+                SELECT DISTINCT id FROM {STAGING_SCHEMA}.{entity}
+                WHERE (hashtext(id::text) & 2147483647) %% %s = %s
+            """, (batches, batch))
+            cur.execute("CREATE INDEX ON sync_ids (id)")
+            cur.execute("ANALYZE sync_ids")
+            for table, key_column in reversed(tables):
+                cur.execute(f"DELETE FROM openalex.{table} t USING sync_ids s WHERE t.{key_column} = s.id")
+            for table, key_column in tables:
+                cur.execute(f"""
+                    INSERT INTO openalex.{table}
+                    SELECT t.* FROM {STAGING_SCHEMA}.{table} t JOIN sync_ids s ON t.{key_column} = s.id
+                """)
+        conn.commit()
+
+
+def drop_staging(conn, entity, abstracts=False):
+    with conn.cursor() as cur:
+        for table, _ in entity_tables(entity, abstracts):
+            cur.execute(f"DROP TABLE IF EXISTS {STAGING_SCHEMA}.{table}")
+    conn.commit()
+
+
+def sync_entity(snapshot_dir, entity, since, batches, buffer_bytes, compact_ids=False):
+    """Stage and merge the partitions of ``entity`` newer than its watermark.
+
+    The key columns the merge deletes by are indexed first where they are
+    not. The works abstracts are synced too if the db has a
+    ``works_abstracts`` table. The watermark only moves forward once every
+    batch is merged. Returns
+    ``(partitions, staged_entities, new_watermark)``.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SYNC_STATE_DDL)
+        conn.commit()
+        watermark = since or get_watermark(conn, entity)
+        partitions = list_partitions(snapshot_dir, entity, since=watermark)
+        if not partitions:
+            return 0, 0, watermark
+        abstracts = entity == 'works' and has_abstracts(conn)
+        staged = stage_entity(entity, partitions, buffer_bytes, compact_ids, abstracts)
+        ensure_key_indexes(conn, entity, abstracts)
+        merge_entity(conn, entity, batches, abstracts)
+        new_watermark = partitions[-1][0]
+        set_watermark(conn, entity, new_watermark)
+        drop_staging(conn, entity, abstracts)
+    finally:
+        conn.close()
+    return len(partitions), staged, new_watermark
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="sync_snapshot_to_postgresql")
+    parser.add_argument("--snapshot_dir", type=str, default="./data/openalex/openalex-snapshot",
+                        help="snapshot_dir")
+    parser.add_argument("--entities", type=str, nargs='+', choices=ENTITIES, default=ENTITIES,
+                        help="entities to sync")
+    parser.add_argument("--since", type=str, default=None,
+                        help="only sync partitions after this YYYY-MM-DD, overrides the stored watermark")
+    parser.add_argument("--merge_batches", type=int, default=4,
+                        help="number of hash batches (transactions) the merge of each entity is split into, the "
+                             "key column of every table is indexed first if it isn't, so no batch scans a table")
+    parser.add_argument("--workers", type=int, default=len(ENTITIES),
+                        help="number of entities synced concurrently")
+    parser.add_argument("--buffer_mb", type=float, default=8,
+                        help="max size of the in-memory COPY buffer of each table, in MB")
+    parser.add_argument("--compact_ids", action="store_true",
+                        help="the db was built with --compact_ids (openalex-pg-schema-compact-ids.sql)")
+    args = parser.parse_args()
+
+    buffer_bytes = int(args.buffer_mb * 1024 * 1024)
+    failed = False
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(sync_entity, args.snapshot_dir, entity, args.since, args.merge_batches, buffer_bytes,
+                        args.compact_ids): entity
+            for entity in args.entities
+        }
+        for future in as_completed(futures):
+            entity = futures[future]
+            try:
+                partitions, staged, watermark = future.result()
+            except Exception as e:
+                print(f"{entity}: sync failed: {e!r}")
+                failed = True
+                continue
+            if partitions:
+                print(f"{entity}: merged {staged} entities from {partitions} partitions, watermark {watermark}")
+            else:
+                print(f"{entity}: up to date (watermark {watermark})")
+    if failed:
+        raise SystemExit(1)